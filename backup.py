@@ -1,9 +1,15 @@
 from backup_funcs.archive import Archive
+from backup_funcs.retention import RetentionPolicy
+from backup_funcs.metrics import Metrics
+from backup_funcs.storage import open_remote
+from backup_funcs.watcher import ChangeJournal, Watcher
 from backup_funcs.misc import pretty_size
+from backup_funcs.logger import Logger
 from pathlib import Path
 import json
 import os
 import argparse
+import sys
 
 
 
@@ -17,16 +23,54 @@ if __name__ == "__main__":
     # config file by -c
     parser.add_argument('-c', '--config', type=str, default='backup_config.json', help='config file')
 
-    # do backup by default, can also do restore and cleanup_soft, cleanup_hard
+    # do backup by default, can also do restore and cleanup_soft, cleanup_hard, cleanup_retention
     # specify by --action -a
-    parser.add_argument('-a', '--action', type=str, default='backup', help='action to perform', choices=['backup', 'restore', 'cleanup_soft', 'cleanup_hard', 'info'])
+    parser.add_argument('-a', '--action', type=str, default='backup', help='action to perform', choices=['backup', 'restore', 'cleanup_soft', 'cleanup_hard', 'cleanup_retention', 'repack', 'gc', 'sync', 'watch', 'bench', 'info', 'browse', 'verify'])
 
     # set a flag to do hard remove, default it is false
     # specify by --hard_remove -r
     parser.add_argument('-r', '--hard_remove', action='store_true', help='delete inactive versions immediately instead of moving to history')
 
+    # force a full backup (calculate checksum of all files), by default only new or changed files are checksummed
+    # specify by --full -f
+    parser.add_argument('-f', '--full', action='store_true', help='calculate checksums of all files instead of reusing them for files with unchanged metadata')
+
+    # restore only some files, the filters can be combined
+    parser.add_argument('--prefix', type=str, default=None, help='restore files under this path')
+    parser.add_argument('--glob', type=str, default=None, help='restore files matching this pattern, e.g. "*/docs/*.pdf"')
+    parser.add_argument('--checksum', type=str, default=None, help='restore files with this content checksum')
+    parser.add_argument('--as_of', type=str, default=None, help='restore the files as they were at this iso timestamp, also from history')
+    # stream instead of writing to restore_dir
+    parser.add_argument('--stdout', action='store_true', help='write the content of the one selected file to stdout')
+    parser.add_argument('--tar', action='store_true', help='write a tar stream of the selected files to stdout')
+
+    # verify only the structure of the archive files (fast) instead of decrypting them, start over instead of resuming
+    parser.add_argument('--structural', action='store_true', help='verify only headers, chunk index and chunk lengths of the archive files')
+    parser.add_argument('--restart', action='store_true', help='start the verification over instead of resuming it')
+
+    # only report what gc would remove
+    parser.add_argument('--dry_run', action='store_true', help='with action gc, only report the unreferenced files instead of removing them')
+
+    # browse by http, or mount with fuse (needs fusepy)
+    parser.add_argument('--mount', type=str, default=None, help='mount the archive read only at this directory instead of serving http')
+
+    # benchmarks on a synthetic tree, no config needed
+    parser.add_argument('--shape', type=str, default='quick', help='with action bench, shape of the synthetic tree (size at scale 1): quick (200 MB), mixed (4.6 GB), tiny_files (1 GB), huge_files (2 GB), media (8 GB), duplicates (1.8 GB)')
+    parser.add_argument('--scale', type=float, default=1.0, help='with action bench, multiplies the number of files of the tree shape')
+    parser.add_argument('--bench_dir', type=str, default=None, help='with action bench, directory for the generated tree (kept and reused) and the runs')
+    parser.add_argument('--bench_out', type=str, default=None, help='with action bench, json lines file that the report is appended to')
+
 
     args = parser.parse_args()
+    if args.action == 'bench':
+        from bench import run_benchmarks
+        report = run_benchmarks(args.bench_dir, shape=args.shape, scale=args.scale, out_path=args.bench_out)
+        if args.bench_out is None:
+            print(json.dumps(report, indent=4))
+        sys.exit(0)
+    if args.stdout or args.tar:
+        # stdout is for the data
+        Logger.to_stderr = True
     config_file = Path(args.config)
     if not config_file.exists():
         raise ValueError('Config file does not exist')
@@ -38,15 +82,84 @@ if __name__ == "__main__":
     restore_dir = Path(os.path.expandvars(config['restore_dir'])).expanduser()
     backup_roots = [Path(os.path.expandvars(root)).expanduser() for root in config['backup_roots']]
     hard_remove = args.hard_remove
+    # periodic full backups to verify the incremental ones, set to null to disable
+    full_backup_every_n = config.get('full_backup_every_n', 10)
+    full_backup_max_age_days = config.get('full_backup_max_age_days', 30)
+    table_backend = config.get('table_backend', 'sqlite')
+    compression = config.get('compression', 'auto')
+    chunking_min_size = config.get('chunking_min_size', 16*1024*1024)
+    pack_max_file_size = config.get('pack_max_file_size', 1024*1024)
+    pack_size = config.get('pack_size', 128*1024*1024)
+    # restore files with the same content as hardlinks to one file instead of copies
+    restore_hardlinks = config.get('restore_hardlinks', False)
+    # history retention for cleanup_retention, e.g. {"keep_last": 3, "daily": 7, "weekly": 4, "monthly": 12, "yearly": -1}
+    retention = config.get('retention', {'yearly': -1})
+    # limit for reading archive files when verifying, in MB/s, null for no limit
+    verify_rate_limit_mb = config.get('verify_rate_limit_mb', None)
+    # read only browsing of the archive
+    browse_port = config.get('browse_port', 8080)
+    browse_cache_size = config.get('browse_cache_size', 256*1024*1024)
+    # only used for new archives, an existing archive keeps the algorithm it was created with
+    hash_algo = config.get('hash_algo', 'sha256')
+    # worker processes and threads per process, default cpu_count // 2 and 4
+    n_procs = config.get('n_procs', None)
+    n_threads_per_proc = config.get('n_threads_per_proc', None)
+    # metrics of each run as json lines and/or a prometheus textfile, progress log interval in seconds (null to disable)
+    metrics_path = config.get('metrics_path', None)
+    metrics_prometheus_path = config.get('metrics_prometheus_path', None)
+    progress_interval = config.get('progress_interval', 60)
+    # phases to profile with cProfile and tracemalloc, e.g. ["scan", "update"] or ["all"]
+    profile_phases = config.get('profile_phases', None)
+    profile_dir = config.get('profile_dir', table_dir / 'profiles')
+    # remote copy of file_dir, e.g. {"type": "s3", "bucket": "my-backups", "prefix": "laptop", "endpoint_url": null}
+    # or {"type": "local", "path": "/mnt/nas/backup"}, null to keep the archive files only locally
+    remote_config = config.get('remote', None)
+    # keep the uploaded archive files in file_dir, otherwise it only stages the files of a run
+    keep_local = config.get('keep_local', True)
+    # upload bandwidth cap in MB/s shared by all upload threads, null for no limit
+    upload_rate_limit_mb = config.get('upload_rate_limit_mb', None)
+    upload_threads = config.get('upload_threads', 4)
+    # change journal for action watch: "inotify", "sweep" (directory mtimes every watch_sweep_interval seconds) or "auto"
+    watch_mode = config.get('watch_mode', 'auto')
+    watch_sweep_interval = config.get('watch_sweep_interval', 300)
+    # skip listing directories whose mtime is unchanged since the last backup, for trees where files are not modified in place
+    dir_index = config.get('dir_index', False)
+    # plain size of the chunks of an archive blob in MB, the chunks of a large file are compressed and encrypted by
+    # pipeline_threads threads per worker process while it is read and written
+    blob_chunk_mb = config.get('blob_chunk_mb', 4)
+    pipeline_threads = config.get('pipeline_threads', 4)
+    # drop the files read and written by a run from the page cache (linux), so a backup does not push out everything else
+    drop_page_cache = config.get('drop_page_cache', False)
+
+    if args.action == 'watch':
+        # runs until stopped, e.g. as a service next to the scheduled backups
+        os.makedirs(table_dir, exist_ok=True)
+        Watcher(backup_roots, ChangeJournal(table_dir), mode=watch_mode, sweep_interval=watch_sweep_interval).run()
+        sys.exit(0)
 
     with open(key_path, 'rb') as f:
         key = f.read()
-    archiver = Archive(table_dir, file_dir, key)
+    metrics = Metrics(profile_phases=profile_phases, profile_dir=profile_dir, progress_interval=progress_interval)
+    remote = None
+    if remote_config is not None:
+        upload_rate_limit = upload_rate_limit_mb * 1024*1024 if upload_rate_limit_mb else None
+        os.makedirs(table_dir, exist_ok=True)
+        remote = open_remote(remote_config, table_dir / 'remote_listing.json', rate_limit=upload_rate_limit, n_threads=upload_threads)
+    archiver = Archive(table_dir, file_dir, key, table_backend=table_backend, compression=compression, chunking_min_size=chunking_min_size,
+                       pack_max_file_size=pack_max_file_size, pack_size=pack_size, n_procs=n_procs, n_threads_per_proc=n_threads_per_proc,
+                       hash_algo=hash_algo, metrics=metrics, remote=remote, keep_local=keep_local,
+                       dir_index=dir_index, blob_chunk_size=int(blob_chunk_mb*1024*1024), n_pipeline_threads=pipeline_threads,
+                       drop_page_cache=drop_page_cache)
 
     if args.action == 'backup':
-        archiver.backup(backup_roots, full=True, hard_remove=hard_remove)
+        full = args.full or archiver.full_backup_due(full_backup_every_n, full_backup_max_age_days)
+        archiver.backup(backup_roots, full=full, hard_remove=hard_remove)
     elif args.action == 'restore':
-        archiver.restore(restore_dir)
+        filters = {'prefix': args.prefix, 'pattern': args.glob, 'checksum': args.checksum, 'as_of': args.as_of}
+        if args.stdout or args.tar:
+            archiver.restore_stream(sys.stdout.buffer, tar=args.tar, **filters)
+        else:
+            archiver.restore(restore_dir, hardlink_duplicates=restore_hardlinks, **filters)
     elif args.action == 'cleanup_soft':
         print('Will prune history to keep at most 1 copy of each file per path per year. Continue? y/n')
         if input() == 'y':
@@ -55,8 +168,37 @@ if __name__ == "__main__":
         print('Will delete historical archive file entries completely. Continue? y/n')
         if input() == 'y':
             archiver.cleanup_delete_all_history()
+    elif args.action == 'cleanup_retention':
+        policy = RetentionPolicy.from_config(retention)
+        print(f'Will prune history to keep {policy} per path. Continue? y/n')
+        if input() == 'y':
+            archiver.cleanup_history(policy)
+    elif args.action == 'repack':
+        archiver.repack()
+    elif args.action == 'gc':
+        archiver.collect_garbage(dry_run=args.dry_run)
+    elif args.action == 'sync':
+        if remote is None:
+            raise ValueError('No remote configured')
+        archiver.sync_remote()
     elif args.action == 'info':
         archiver.info(True)
+    elif args.action == 'verify':
+        rate_limit = verify_rate_limit_mb * 1024*1024 if verify_rate_limit_mb else None
+        archiver.verify(deep=not args.structural, rate_limit=rate_limit, restart=args.restart)
+    elif args.action == 'browse':
+        from backup_funcs.browse import ArchiveView, serve_http, mount
+        view = ArchiveView(archiver, cache_size=browse_cache_size)
+        if args.mount is not None:
+            mount(view, args.mount)
+        else:
+            serve_http(view, port=browse_port)
+
+    if metrics_path is not None:
+        metrics.write_json_lines(Path(metrics_path).expanduser(), action=args.action)
+    if metrics_prometheus_path is not None:
+        metrics.write_prometheus(Path(metrics_prometheus_path).expanduser(), action=args.action)
+    archiver.close()
     
 
 
@@ -1,15 +1,28 @@
 from pathlib import Path
-from enum import Enum
 import datetime as dt
+import bisect
+import fnmatch
+import json
 import time
-from typing import Optional
+import stat
 import os
-import json
-import shutil
-from pydantic import BaseModel
 
-from .file_info import FileInfo
-from .crypto import ConcurrentEncryptor
+from .file_info import FileInfo, DEFAULT_HASH_ALGO, new_hasher
+from .models import BlobEvent, ArchiveLogEvent, ArchiveFilePointer, ArchiveEntry
+from .table import open_archive_table
+from .journal import Journal
+from .retention import RetentionPolicy
+from .crypto import BLOB_CHUNK_SIZE, ConcurrentEncryptor, Crypto, chunk_fpath, _verify_entries
+from .tarstream import TarStreamWriter, content_size
+from .blob_reader import open_blob
+from .packs import PackWriter, PackedBlob, pack_fpath, list_packs
+from .engine import ExecutionEngine, TaskQueue
+from .metrics import Metrics, count
+from .store import StoreQueue
+from .garbage import mark, shard_dirs, shard_live, sweep
+from .storage import Remote
+from .watcher import ChangeJournal, ChangeSet
+from .dir_index import DirIndex
 from .scanner import Scanner
 from .logger import Logger
 from .misc import pretty_size, pretty_time
@@ -17,147 +30,397 @@ from .misc import pretty_size, pretty_time
 logger = Logger()
 
 
-"""
-Event of the current state of a file, i.e. regarding checksum. A modified file will create one ADDED and one REMOVED event since a new state appears.
-"""
-class BlobEvent(Enum):
-    ADDED = 1 # added to path, can be part of creation, move or copy
-    REMOVED = 2 # removed from path, can be part of move, modification or deletion
-    
-
-class ArchiveLogEvent(BaseModel):
-    timestamp:str
-    event:str
-    path:Optional[str]
-
-    @classmethod
-    def from_event(cls, event:BlobEvent, path:str):
-        ts = dt.datetime.now().astimezone().isoformat()
-        return cls(timestamp=ts, event=event.name, path=Path(path).as_posix() if path is not None else None)
-
-
-class ArchiveFilePointer(BaseModel):
-    path:str
-    ino:int
-    mtime:float
-    size:int
-    
-
-
-class ArchiveEntry(BaseModel):
-    checksum:str
-    fptrs:list[ArchiveFilePointer]
-    log:list[ArchiveLogEvent]
-    arch_size:int
-
-    @classmethod
-    def from_checksum(cls, checksum): 
-        return cls(checksum=checksum, fptrs=[], log=[], arch_size=0)
-        
-
-
-
+def _parents(path):
+    # path and its parent directories, as posix strings
+    while True:
+        yield path
+        head, sep, _ = path.rpartition('/')
+        if not sep or head == path:
+            return
+        path = head or '/'
+        if path == '/':
+            yield path
+            return
+
+
+def _local_size(fpath):
+    # None if the file does not exist
+    try:
+        return os.path.getsize(fpath)
+    except FileNotFoundError:
+        return None
 
 
 """
 Archive class for storing and restoring files and keeping track of the backup archive
 """
 class Archive():
-    def __init__(self, table_dir, file_dir, key):
+    def __init__(self, table_dir, file_dir, key, table_backend='sqlite', compression='auto', chunking_min_size=16*1024*1024,
+                 pack_max_file_size=1024*1024, pack_size=128*1024*1024, n_procs=None, n_threads_per_proc=None, hash_algo=DEFAULT_HASH_ALGO,
+                 metrics:Metrics=None, remote:Remote=None, keep_local=True, dir_index=False, blob_chunk_size=BLOB_CHUNK_SIZE,
+                 n_pipeline_threads=4, drop_page_cache=False):
         self.table_dir = Path(table_dir)
         self.file_dir = Path(file_dir)
+        self.chunk_dir = self.file_dir / 'chunks' # content defined chunks of large files, deduplicated across files
+        self.chunking_min_size = chunking_min_size # files at least this large are stored as chunks, None to disable
+        self.pack_dir = self.file_dir / 'packs' # small files appended to pack files
+        self.pack_max_file_size = pack_max_file_size # files up to this size are packed, None to disable
+        self.pack_size = pack_size
+        self._pack_sizes = None # pack name : size, listed once per update
+        self.tmp_dir = self.file_dir / 'tmp' # blobs of new files before their checksum is known
+        self._dead_files = {} # shard dir : file names of dropped entries, removed once the table is stored
+        self.remote = remote # remote copy of file_dir, None to keep the archive files only locally
+        self.keep_local = keep_local # keep the local copies of uploaded archive files, otherwise file_dir is only a staging area
         
         if not file_dir.exists():
             os.makedirs(file_dir)
         if not table_dir.exists():
             os.makedirs(table_dir)
 
-        self.crypto = ConcurrentEncryptor(key=key)
+        self.table = open_archive_table(self.table_dir, table_backend)
+        self.journal = Journal(self.table_dir) # archive files stored by a backup run that is not in the table yet
+        self.changes = ChangeJournal(self.table_dir) # paths changed since the last backup, written by the watcher
+        self.use_dir_index = dir_index # skip listing directories that are unchanged since the last walk, see dir_index.py
         self.active = {} # checksum : ArchiveEntry
-        self.active_ino = {} # ino : checksum - indexed for fast lookup
+        self.active_ino = {} # (dev, ino) : checksum - indexed for fast lookup
         self.history = {} # checksum : ArchiveEntry
+        self.chunk_refs = {} # chunk checksum : number of references from active and history entries
+        self.size_partials = {} # file size : partial checksums of active and history entries, to find copies cheaply
+        self.hash_algo = hash_algo # the one recorded in the table wins, checksums of different algorithms never match
         self.backup_roots = [] # list of root paths to backup
+        self.last_full_backup = None # iso timestamp of the last backup that calculated all checksums
+        self.n_backups_since_full = 0
+        self.watch_session = None # session of the watcher whose changes the last backup has seen, see _take_changes()
+        self._changed = set() # checksums of entries added, modified or removed since the table was stored
+        self._path_index = None # sorted active paths and their checksums, built on first use
+        self._event_index = None # sorted paths of all entries and their events, built on first use
+        self._key = key
+        self._crypto = None # for decoding in this process, see _local_crypto()
+        self.drop_page_cache = drop_page_cache # keep the files of a run out of the page cache, see pipeline.py
+        self.metrics = metrics or Metrics() # shared with the engine, which merges the metrics of the workers
         
         self._load_archive_table()
+        new_hasher(self.hash_algo) # fail early if not available
+        self._replay_journal()
 
+        # worker processes are started on first use and kept for the whole run, see close()
+        self.engine = ExecutionEngine(key=key, n_procs=n_procs, n_threads_per_proc=n_threads_per_proc, compression=compression,
+                                      hash_algo=self.hash_algo, metrics=self.metrics, blob_chunk_size=blob_chunk_size,
+                                      n_pipeline_threads=n_pipeline_threads, drop_page_cache=drop_page_cache)
+        self.crypto = ConcurrentEncryptor(self.engine)
 
-    def _load_archive_table(self):
-        archive_path = self.table_dir / 'archive.json'
 
-        if not archive_path.exists():
-            return False
-        
-        with open(archive_path, 'r') as fin:
-            archive = json.load(fin)
-        
-        if not ('active' in archive and 'history' in archive and 'backup_roots' in archive):
+    def close(self):
+        self.engine.close()
+        self.journal.close()
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, *args):
+        self.close()
+
+
+    def _load_archive_table(self):
+        loaded = self.table.load()
+        if loaded is None:
             return False
         
-        _active = [ArchiveEntry(**entry) for entry in archive['active']]
-        _history = [ArchiveEntry(**entry) for entry in archive['history']]
-        self.backup_roots = [Path(root) for root in archive['backup_roots']]
+        _active, _history, meta = loaded
+        self.backup_roots = [Path(root) for root in meta['backup_roots']]
         self.active = {entry.checksum: entry for entry in _active}
         self.history = {entry.checksum: entry for entry in _history}
-        self.active_ino = {fptr.ino: entry.checksum for entry in _active for fptr in entry.fptrs}
+        self.active_ino = {(fptr.dev, fptr.ino): entry.checksum for entry in _active for fptr in entry.fptrs}
+        self.chunk_refs = {}
+        self.size_partials = {}
+        for entry in _active + _history:
+            self._add_chunk_refs(entry)
+            self._add_size_partial(entry)
+        # archives from before the algorithm was recorded use sha256
+        hash_algo = meta.get('hash_algo', DEFAULT_HASH_ALGO)
+        if hash_algo != self.hash_algo:
+            logger.warning(f'Archive checksums use {hash_algo}, ignoring configured hash algorithm {self.hash_algo}.')
+            self.hash_algo = hash_algo
+        backup_state = meta.get('backup_state', {})
+        self.last_full_backup = backup_state.get('last_full_backup', None)
+        self.n_backups_since_full = backup_state.get('n_backups_since_full', 0)
+        self.watch_session = backup_state.get('watch_session', None)
+        self._changed = set()
         return True
     
 
+    def _replay_journal(self):
+        # archive files stored by an interrupted backup are added as active entries, the next backup then
+        # finds them by metadata (or checksum) instead of storing them again
+        entries = self.journal.replay()
+        if len(entries) == 0:
+            return
+        n_added = 0
+        for entry in entries:
+            if entry.checksum in self.active or entry.checksum in self.history or not self._check_archive_entry(entry):
+                continue
+            self.active[entry.checksum] = entry
+            for fptr in entry.fptrs:
+                self.active_ino[(fptr.dev, fptr.ino)] = entry.checksum
+            self._add_chunk_refs(entry)
+            self._add_size_partial(entry)
+            self._changed.add(entry.checksum)
+            n_added += 1
+        logger.info(f'Recovered {n_added} archive files stored by an interrupted backup.')
+        self._store_archive_table()
+
+
     def _store_archive_table(self):
-        # checksum is in the entry so no need to store it twice
-        f_table = {
-            'active':  [entry.model_dump() for entry in self.active.values()],
-            'history': [entry.model_dump() for entry in self.history.values()],
+        meta = {
             'backup_roots': [root.as_posix() for root in self.backup_roots],
+            'hash_algo': self.hash_algo,
+            'backup_state': {
+                'last_full_backup': self.last_full_backup,
+                'n_backups_since_full': self.n_backups_since_full,
+                'watch_session': self.watch_session,
+            },
         }
-        archive_path = self.table_dir / 'archive.json'
-        backup_path = self.table_dir / 'archive.json.bak'
-        failed_path = self.table_dir / 'archive.json.failed'
-
-        # backup old archive table
-        if archive_path.exists():
-            shutil.copyfile(archive_path, backup_path)
-        
-        # serialize and store with json
-        with open(archive_path, 'w') as fout:
-            json.dump(f_table, fout)
-        
-        # validate that the files are stored correctly, i.e. try to load them again
-        success = False
-        try: 
-            success = self._load_archive_table()
-        except:
-            success = False
-        if not success:
-            # restore backup
-            if archive_path.exists():
-                shutil.copyfile(archive_path, failed_path)
-            if backup_path.exists():
-                shutil.copyfile(backup_path, archive_path)
-            raise ValueError('Could not store archive table correctly. Restoring backup.')
+        with self.metrics.phase('table_save'):
+            self.table.store(self.active, self.history, meta, changed=self._changed)
+        self._changed = set()
+        # everything stored so far is in the table now
+        self.journal.clear()
+        self._path_index = None
+        self._event_index = None
                 
 
     def _archived_fpath(self, checksum):
         return self.file_dir / checksum[:2] / (checksum+'.enc')
 
 
+    def _file_key(self, path):
+        # remote key of an archive file, its path relative to file_dir
+        return Path(path).relative_to(self.file_dir).as_posix()
+
+
 
     def _remove_file(self, checksum):
         arch_path = self._archived_fpath(checksum)
-        if os.path.exists(arch_path):
-            os.remove(arch_path)
+        self._dead_files.setdefault(arch_path.parent, set()).add(arch_path.name)
+
+
+    def _sweep_dead_files(self):
+        # remove the archive files of dropped entries, batched per shard on the worker pool. Files that are referenced
+        # again (e.g. a chunk shared with a file stored in the same run) are kept
+        tasks = []
+        for shard, names in self._dead_files.items():
+            names = {name for name in names if not self._is_referenced(name[:-len('.enc')])}
+            if len(names) > 0:
+                tasks.append((shard, names, None, False, 0))
+        self._dead_files = {}
+        if self.remote is not None:
+            self.remote.delete([self._file_key(shard / name) for shard, names, _, _, _ in tasks for name in names])
+        if len(tasks) == 0:
+            return
+        n_files, n_bytes, n_errs, _ = sweep(self.engine, tasks)
+        if n_errs > 0:
+            logger.warning(f'Could not remove {n_errs} archive files.')
+        logger.info(f'Removed {n_files} archive files ({pretty_size(n_bytes)}).')
+
+
+    def _is_referenced(self, checksum):
+        if checksum in self.chunk_refs:
+            return True
+        entry = self.active.get(checksum) or self.history.get(checksum)
+        return entry is not None and entry.pack is None and entry.chunks is None
     
 
+    def _has_file(self, path, expected_size=None):
+        # archive file stored locally or on the remote, an empty local chunk is one that was evicted (see _evict)
+        local_size = _local_size(path)
+        if local_size and (expected_size is None or local_size == expected_size):
+            return True
+        if self.remote is None:
+            return False
+        remote_size = self.remote.size(self._file_key(path))
+        return remote_size is not None and (expected_size is None or remote_size == expected_size)
+
+
     def _check_archive_file(self, checksum, expected_size):
-        arch_path = self._archived_fpath(checksum)
-        exists = arch_path.exists()
-        if exists:
-            if arch_path.stat().st_size == expected_size:
-                return True
-        return False
-        
+        return self._has_file(self._archived_fpath(checksum), expected_size)
+
+
+    def _chunk_fpaths(self, entry:ArchiveEntry):
+        return [chunk_fpath(self.chunk_dir, chunk_checksum) for chunk_checksum in entry.chunks]
+
+
+    def _check_archive_entry(self, entry:ArchiveEntry):
+        if entry.pack is not None:
+            if self._pack_sizes is None:
+                self._pack_sizes = self._list_packs()
+            return self._pack_sizes.get(entry.pack, 0) >= entry.pack_offset + entry.arch_size
+        if entry.chunks is None:
+            return self._check_archive_file(entry.checksum, entry.arch_size)
+        return all(self._has_file(chunk_path) for chunk_path in self._chunk_fpaths(entry))
+
+
+    def _list_packs(self):
+        # pack name : size, of the local packs and the ones only on the remote
+        pack_sizes = list_packs(self.pack_dir)
+        if self.remote is not None:
+            for key, size in self.remote.files_under(self._file_key(self.pack_dir) + '/').items():
+                pack_sizes.setdefault(key.rpartition('/')[2], size)
+        return pack_sizes
+
+
+    def _entry_fpaths(self, entry:ArchiveEntry):
+        # the archive files an entry is stored in
+        if entry.pack is not None:
+            return [pack_fpath(self.pack_dir, entry.pack)]
+        if entry.chunks is not None:
+            return self._chunk_fpaths(entry)
+        return [self._archived_fpath(entry.checksum)]
+
+
+    def _live_fpaths(self):
+        # the archive files of all entries
+        blobs, chunks, packs = mark(list(self.active.values()) + list(self.history.values()))
+        return ([self._archived_fpath(checksum) for checksum in blobs] + [chunk_fpath(self.chunk_dir, checksum) for checksum in chunks] +
+                [pack_fpath(self.pack_dir, name) for name in packs])
+
+
+    def _fetch(self, fpaths) -> list:
+        # downloads the archive files that are only on the remote, returns the downloaded paths
+        if self.remote is None:
+            return []
+        items = {}
+        for fpath in fpaths:
+            if fpath not in items and not _local_size(fpath):
+                key = self._file_key(fpath)
+                if key in self.remote:
+                    items[fpath] = key
+        if len(items) == 0:
+            return []
+        logger.info(f'Downloading {len(items)} archive files from the remote...')
+        failed = set(self.remote.download([(key, fpath) for fpath, key in items.items()]))
+        if len(failed) > 0:
+            logger.error(f'Could not download {len(failed)} archive files.')
+        return [fpath for fpath, key in items.items() if key not in failed]
+
+
+    def _upload(self, fpaths):
+        # uploads the archive files that are not on the remote yet, then drops the local copies unless keep_local
+        fpaths = list(dict.fromkeys(fpaths))
+        items = [(fpath, key) for fpath, key in ((fpath, self._file_key(fpath)) for fpath in fpaths) if key not in self.remote and _local_size(fpath)]
+        failed = self.remote.upload(items)
+        if len(failed) > 0:
+            logger.warning(f'Could not upload {len(failed)} archive files, they are kept locally. Run the sync action to upload them.')
+        if not self.keep_local:
+            self._evict([fpath for fpath in fpaths if self._file_key(fpath) in self.remote])
+
+
+    def _evict(self, fpaths):
+        # drops local copies of files on the remote. Chunks leave an empty file behind, so that the workers (which only
+        # look at the chunk dir) still skip storing a chunk again when it is part of another file
+        for fpath in fpaths:
+            try:
+                if Path(fpath).is_relative_to(self.chunk_dir):
+                    if os.path.getsize(fpath) > 0:
+                        open(fpath, 'wb').close()
+                else:
+                    os.remove(fpath)
+            except FileNotFoundError:
+                pass
+
+
+    def sync_remote(self):
+        # uploads all archive files that are not on the remote (after failed uploads, or a remote added to an existing
+        # archive) and drops local copies unless keep_local, e.g. files downloaded for browsing
+        self.remote.refresh()
+        self._upload(self._live_fpaths())
+
+
+    def _archived_src(self, entry:ArchiveEntry, fetch=True):
+        # source for restoring an entry: blob path, list of chunk paths or a blob in a pack,
+        # downloaded first if it is only on the remote (unless fetch is False)
+        if fetch:
+            self._fetch(self._entry_fpaths(entry))
+        if entry.pack is not None:
+            return PackedBlob(pack_fpath(self.pack_dir, entry.pack), entry.pack_offset, entry.arch_size)
+        if entry.chunks is not None:
+            return self._chunk_fpaths(entry)
+        return self._archived_fpath(entry.checksum)
+
+
+    def _local_crypto(self) -> Crypto:
+        if self._crypto is None:
+            self._crypto = Crypto(self._key, hash_algo=self.hash_algo, drop_page_cache=self.drop_page_cache)
+        return self._crypto
+
+
+    def open_blob(self, checksum, cache=None):
+        # seekable read only file object over the content of an active or history entry, which only decrypts
+        # the chunks a read touches (archive files from before format version 3 are decoded to a temporary file)
+        entry = self.active.get(checksum) or self.history.get(checksum)
+        if entry is None:
+            raise KeyError(f'Checksum not in archive: {checksum}')
+        return open_blob(self._local_crypto(), self._archived_src(entry), cache=cache, size=entry.size)
+
+
+    def _add_chunk_refs(self, entry:ArchiveEntry):
+        for chunk_checksum in entry.chunks or []:
+            self.chunk_refs[chunk_checksum] = self.chunk_refs.get(chunk_checksum, 0) + 1
+
+
+    def _remove_archived(self, entry:ArchiveEntry):
+        # remove the archive file of an entry that is dropped from the table, chunks only when no longer referenced
+        # and packed blobs when repacking
+        if entry.pack is not None:
+            return
+        if entry.chunks is None:
+            self._remove_file(entry.checksum)
+            return
+        for chunk_checksum in entry.chunks:
+            n_refs = self.chunk_refs.get(chunk_checksum, 0) - 1
+            if n_refs > 0:
+                self.chunk_refs[chunk_checksum] = n_refs
+                continue
+            self.chunk_refs.pop(chunk_checksum, None)
+            chunk_path = chunk_fpath(self.chunk_dir, chunk_checksum)
+            self._dead_files.setdefault(chunk_path.parent, set()).add(chunk_path.name)
+
+
+    def _reset_archived(self, entry:ArchiveEntry):
+        # for an entry whose archive file is missing or broken and will be stored again,
+        # so it is removed right away instead of after the table is stored
+        self._remove_archived(entry)
+        self._sweep_dead_files()
+        entry.chunks = None
+        entry.pack = None
+        entry.pack_offset = 0
+        entry.arch_size = 0
+
+
+
+    def _add_size_partial(self, entry:ArchiveEntry):
+        if entry.size is not None and entry.partial is not None:
+            self.size_partials.setdefault(entry.size, set()).add(entry.partial)
+
+
+    def _store_queue(self) -> StoreQueue:
+        is_known = lambda checksum: checksum in self.active or checksum in self.history
+        return StoreQueue(self.engine, self._archived_fpath, self.chunk_dir, self.pack_dir, self.tmp_dir, is_known=is_known,
+                          pack_size=self.pack_size, chunking_min_size=self.chunking_min_size, pack_max_file_size=self.pack_max_file_size,
+                          journal=self.journal)
 
 
-    def _update_archive(self, scanned_files_with_checksum:list[FileInfo], hard_remove=False):
+    def _clear_tmp_dir(self):
+        # leftovers of an interrupted backup
+        if self.tmp_dir.exists():
+            for fpath in self.tmp_dir.glob('*.tmp'):
+                os.remove(fpath)
+
+
+    def _update_archive(self, scanned_files_with_checksum:list[FileInfo], hard_remove=False, store_queue:StoreQueue=None):
+        self._pack_sizes = None
+        store_queue = store_queue or self._store_queue()
 
         scanned_chck2finfo = {}
         for finfo in scanned_files_with_checksum:
@@ -180,94 +443,129 @@ class Archive():
                 # add file to history and remove from active and active_ino
                 for fptr in entry.fptrs:
                     entry.log.append(ArchiveLogEvent.from_event(BlobEvent.REMOVED, fptr.path))
+                    if self.active_ino.get((fptr.dev, fptr.ino)) == checksum:
+                        self.active_ino.pop((fptr.dev, fptr.ino))
                 entry.fptrs = []
                 self.active.pop(entry.checksum)
-                self.history[entry.checksum] = entry
-                for fptr in entry.fptrs:
-                    self.active_ino.pop(fptr.ino)
+                self._changed.add(checksum)
                 if hard_remove:
-                    self._remove_file(checksum)
+                    self._remove_archived(entry)
+                else:
+                    self.history[entry.checksum] = entry
                 n_removed += 1
             else:
                 finfos = scanned_chck2finfo[entry.checksum]
                 # check if we have moved or copied the file
                 arch_paths = [os.path.normpath(fptr.path) for fptr in entry.fptrs]
                 curr_paths = [os.path.normpath(finfo.path) for finfo in finfos]
+                arch_path_set = set(arch_paths)
+                curr_path_set = set(curr_paths)
 
                 # log any changes
-                new_paths = [cpath for cpath in curr_paths if cpath not in arch_paths]
-                old_paths = [apath for apath in arch_paths if apath not in curr_paths]
+                new_paths = [cpath for cpath in curr_paths if cpath not in arch_path_set]
+                old_paths = [apath for apath in arch_paths if apath not in curr_path_set]
                 
-                if len(new_paths) == 0 and len(old_paths) == 0:
-                    # no change
-                    continue
-                
-                n_path_change += 1
+                if len(new_paths) > 0 or len(old_paths) > 0:
+                    n_path_change += 1
 
                 for path in new_paths:
                     entry.log.append(ArchiveLogEvent.from_event(BlobEvent.ADDED, path))
                 for path in old_paths:
                     entry.log.append(ArchiveLogEvent.from_event(BlobEvent.REMOVED, path))
 
-                # update file pointers
-                entry.fptrs = []
-                for finfo in finfos:
-                    entry.fptrs.append(ArchiveFilePointer(path=finfo.path.as_posix(), ino=finfo.ino, mtime=finfo.mtime, size=finfo.size))
-
-                # ino index does not need to be updated since we have not changed the file
+                # update file pointers - also without path change since mtime, ino etc. may differ 
+                # (e.g. touched or copied back) and the metadata must be current for incremental backups
+                fptrs = [ArchiveFilePointer(path=finfo.path.as_posix(), ino=finfo.ino, mtime=finfo.mtime, size=finfo.size, dev=finfo.dev) for finfo in finfos]
+                if fptrs == entry.fptrs:
+                    # no change
+                    continue
+                for fptr in entry.fptrs:
+                    if self.active_ino.get((fptr.dev, fptr.ino)) == checksum:
+                        self.active_ino.pop((fptr.dev, fptr.ino))
+                entry.fptrs = fptrs
+                for fptr in fptrs:
+                    self.active_ino[(fptr.dev, fptr.ino)] = checksum
+                self._changed.add(checksum)
 
         # add new files
         files_to_store = {} # checksum : entry
         for checksum, finfos in scanned_chck2finfo.items():
             if checksum in self.active:
-                if self._check_archive_file(checksum, self.active[checksum].arch_size):
+                if self._check_archive_entry(self.active[checksum]):
                     continue
                 else:
                     logger.warning(f'Archive file not exists or size mismatch from table: {checksum}')
                     n_errs += 1
+                    # store it again, file pointers and log are already up to date
+                    entry = self.active.pop(checksum)
+                    self._reset_archived(entry)
+                    self._changed.add(checksum)
+                    files_to_store[checksum] = entry
+                    continue
             
-            entry = ArchiveEntry.from_checksum(checksum)
+            # a file that is back with a content from history can reuse the archived file
+            entry = self.history.pop(checksum, None)
+            revived = entry is not None and self._check_archive_entry(entry)
+            if entry is None:
+                entry = ArchiveEntry.from_checksum(checksum)
+            elif not revived:
+                self._reset_archived(entry)
             for finfo in finfos:
-                entry.fptrs.append(ArchiveFilePointer(path=finfo.path.as_posix(), ino=finfo.ino, mtime=finfo.mtime, size=finfo.size))
+                entry.fptrs.append(ArchiveFilePointer(path=finfo.path.as_posix(), ino=finfo.ino, mtime=finfo.mtime, size=finfo.size, dev=finfo.dev))
                 entry.log.append(ArchiveLogEvent.from_event(BlobEvent.ADDED, finfo.path))
+            entry.size = finfos[0].size
+            entry.partial = entry.partial or next((finfo.partial for finfo in finfos if finfo.partial is not None), None)
+            self._add_size_partial(entry)
+            self._changed.add(checksum)
             
-            files_to_store[checksum] = entry
+            if revived:
+                count('dedup_hits')
+                self.active[checksum] = entry
+                for fptr in entry.fptrs:
+                    self.active_ino[(fptr.dev, fptr.ino)] = checksum
+                n_added += 1
+                continue
 
-        # store new files
-        logger.info(f'Storing {len(files_to_store)} new archive files...')
+            files_to_store[checksum] = entry
 
-        # prepare folders and srcdst_path_pairs
-        srcdst_path_pairs = []
+        # store new files, some may already have been stored while scanning
+        n_early = sum([1 for checksum in files_to_store if checksum in store_queue])
+        logger.info(f'Storing {len(files_to_store)} new archive files ({n_early} already queued while scanning)...')
         for checksum, entry in files_to_store.items():
-            arch_path = self._archived_fpath(checksum)
-            src_path = entry.fptrs[0].path
-            srcdst_path_pairs.append((src_path, arch_path))
-            if not arch_path.parent.exists():
-                os.makedirs(arch_path.parent)
-
-        # store files
-        self.crypto.store_files(srcdst_path_pairs)
+            store_queue.add(checksum, entry.fptrs[0].path, entry.fptrs[0].size)
+        stored = store_queue.finish()
         
         # update archive table
         for checksum, entry in files_to_store.items():
-            entry.arch_size = self._archived_fpath(checksum).stat().st_size
+            if stored.get(checksum) is None:
+                logger.warning(f'Could not store archive file: {checksum}')
+                n_errs += 1
+                continue
+            # arch_size of a chunked entry is the size of the chunks that it added to the archive
+            entry.arch_size, entry.chunks, entry.pack, entry.pack_offset = stored[checksum]
+            self._add_chunk_refs(entry)
             self.active[checksum] = entry
-            for finfo in finfos:
-                self.active_ino[finfo.ino] = checksum
+            self._changed.add(checksum)
+            for fptr in entry.fptrs:
+                self.active_ino[(fptr.dev, fptr.ino)] = checksum
             n_added += 1
         
         logger.info(f'Added {n_added} files, removed {n_removed} files, changed path for {n_path_change} files, {n_errs} errors.')
 
 
         self._store_archive_table()
+        self._sweep_dead_files()
 
 
             
     def _get_checksum_from_meta(self, finfo:FileInfo):
-        checksum = self.active_ino.get(finfo.ino, None)
+        # keyed on device and inode since inodes are only unique within a filesystem, 
+        # hardlinks share the key but are told apart by the path
+        checksum = self.active_ino.get((finfo.dev, finfo.ino), None)
         if checksum is not None:
             for loc in self.active[checksum].fptrs:
-                if ((loc.path == finfo.path) and
+                if ((loc.path == finfo.path.as_posix()) and
+                    (loc.dev == finfo.dev) and
                     (loc.ino == finfo.ino) and
                     (loc.mtime == finfo.mtime) and
                     (loc.size == finfo.size)):
@@ -275,6 +573,124 @@ class Archive():
         return None
     
 
+    def _is_moved(self, finfo:FileInfo) -> bool:
+        # same inode, mtime and size as an archived file but another path - most likely renamed or moved
+        checksum = self.active_ino.get((finfo.dev, finfo.ino), None)
+        if checksum is None:
+            return False
+        return any([loc.dev == finfo.dev and loc.ino == finfo.ino and loc.mtime == finfo.mtime and loc.size == finfo.size
+                    for loc in self.active[checksum].fptrs])
+
+
+    def _dir_index(self, reuse=True) -> DirIndex:
+        # the files of the active entries per directory, which the index reuses for unchanged directories
+        known_files = {}
+        if reuse:
+            for entry in self.active.values():
+                for fptr in entry.fptrs:
+                    if fptr.parent is not None:
+                        known_files.setdefault(fptr.parent, []).append((fptr.name, fptr.size, fptr.mtime, fptr.ino, fptr.dev))
+        return DirIndex(self.table_dir, known_files=known_files, reuse=reuse)
+
+
+    def _take_changes(self, max_heartbeat_age=120) -> ChangeSet:
+        # the paths changed since the last backup, None if the journal may be incomplete: no watcher, or it was
+        # restarted, is not responding or watches other roots since then
+        state = self.changes.read_state()
+        if state is None:
+            return None
+        records = self.changes.take()
+        roots = sorted([root.as_posix() for root in self.backup_roots])
+        alive = time.time() - state['heartbeat'] < max_heartbeat_age and sorted(state['roots']) == roots
+        complete = alive and state['session'] == self.watch_session
+        self.watch_session = state['session'] if alive else None
+        changes = ChangeSet(records)
+        if not complete or changes.overflow:
+            return None
+        return changes
+
+
+    def _iter_changed_tree(self, scanner:Scanner, changes:ChangeSet):
+        # file infos of all files under the backup roots without walking them: files in directories without changes
+        # are taken from the table, changed files are stat'ed and changed directories are listed or walked again
+        roots = {root.as_posix() for root in self.backup_roots}
+        dir_states = {} # directory : 'clean', 'list', 'walk' or 'outside' (not under a backup root)
+
+        def dir_state(dir_path):
+            state = dir_states.get(dir_path)
+            if state is None:
+                state = 'outside'
+                if dir_path is not None:
+                    walk = False
+                    for parent in _parents(dir_path):
+                        walk = walk or parent in changes.dirs
+                        if parent in roots:
+                            state = 'walk' if walk else ('list' if dir_path in changes.lists else 'clean')
+                            break
+                dir_states[dir_path] = state
+            return state
+
+        n_reused = 0
+        for entry in self.active.values():
+            for fptr in entry.fptrs:
+                if dir_state(fptr.parent) == 'clean' and fptr.path not in changes.files:
+                    n_reused += 1
+                    count('files_found')
+                    count('bytes_found', fptr.size)
+                    yield FileInfo.from_meta(fptr.path, fptr.mtime, fptr.size, fptr.ino, fptr.dev)
+        self.metrics.merge({'files_reused_journal': n_reused})
+
+        # only the outermost changed directories are walked
+        for dir_path in changes.dirs:
+            head = dir_path.rpartition('/')[0] or None
+            if dir_state(head) != 'walk' and dir_state(dir_path) == 'walk' and os.path.isdir(dir_path):
+                yield from scanner.iter_directory_tree(dir_path, with_checksum=False)
+        for dir_path in changes.lists:
+            if dir_state(dir_path) == 'list':
+                yield from self._list_files(dir_path)
+        for path in changes.files:
+            if dir_state(path.rpartition('/')[0] or None) == 'clean':
+                try:
+                    fstat = os.stat(path)
+                except OSError:
+                    # removed
+                    continue
+                if stat.S_ISREG(fstat.st_mode):
+                    count('files_found')
+                    count('bytes_found', fstat.st_size)
+                    yield FileInfo(path, fstat=fstat)
+
+
+    def _list_files(self, dir_path):
+        # the files directly in a directory, new subdirectories are recorded as changed directories themselves
+        try:
+            with os.scandir(dir_path) as it:
+                for entry in it:
+                    try:
+                        if not entry.is_dir():
+                            fstat = entry.stat()
+                            count('files_found')
+                            count('bytes_found', fstat.st_size)
+                            yield FileInfo(entry.path, fstat=fstat)
+                    except OSError as e:
+                        logger.warning(f'Could not stat file, skipping: {entry.path} ({e})')
+        except OSError as e:
+            logger.warning(f'Could not list directory, skipping: {dir_path} ({e})')
+
+
+    def full_backup_due(self, every_n_backups=None, max_age_days=None) -> bool:
+        # a full backup recalculates all checksums and thereby verifies the metadata shortcut
+        if self.last_full_backup is None:
+            return True
+        if every_n_backups is not None and self.n_backups_since_full + 1 >= every_n_backups:
+            return True
+        if max_age_days is not None:
+            age = dt.datetime.now().astimezone() - dt.datetime.fromisoformat(self.last_full_backup)
+            if age >= dt.timedelta(days=max_age_days):
+                return True
+        return False
+
+
     def backup(self, backup_roots, full=True, hard_remove=False):
         t0 = time.time()
         if full:
@@ -303,111 +719,475 @@ class Archive():
             logger.info(f'Backup root kept since last backup: {root}')
 
         self.backup_roots = backup_roots
-
-        scanner = Scanner()
-        for root in self.backup_roots:
-            scanner.scan_directory_tree(root, with_checksum=full)
-        total_size = sum([finfo.size for finfo in scanner.files])
-        logger.info(f'Scanned {len(scanner.files)} files with total size {pretty_size(total_size)}.')
-
+        # with a watcher running, a backup that reuses checksums only scans the paths that changed since the last
+        # backup. A full backup walks the whole tree, so the periodic full backups also reconcile the change journal
+        changes = self._take_changes()
+        if changes is not None and full:
+            changes = None
+
+        # files that are most likely archived already (same metadata, or same inode under another path) are only
+        # hashed, in a full backup to verify the metadata. All other files are read once to get the checksum
+        # and the compressed and encrypted blob, which is discarded if the content is archived after all.
+        self._clear_tmp_dir()
+        dir_index = None
+        if self.use_dir_index and changes is None:
+            dir_index = self._dir_index(reuse=not full)
+        scanner = Scanner(self.engine, dir_index=dir_index)
+        store_queue = self._store_queue()
         finfo_with_checksum = []
-        if full:
-            finfo_with_checksum = scanner.files
-        else:
-            # get checksums lazily first (if everything else compares)
-            finfo_with_checksum = []
-            paths_without_checksum = []
-            for finfo in scanner.files:
+        n_meta = 0
+        n_hashed = 0
+
+        def route(finfos):
+            nonlocal n_meta, n_hashed
+            for finfo in finfos:
+                scanner.files.append(finfo)
                 checksum = self._get_checksum_from_meta(finfo)
-                if checksum is None:
-                    paths_without_checksum.append(finfo.path)
-                else:
+                if checksum is not None and not full:
                     finfo.checksum = checksum
                     finfo_with_checksum.append(finfo)
+                    n_meta += 1
+                    count('bytes_skipped_meta', finfo.size)
+                elif checksum is not None or self._is_moved(finfo):
+                    n_hashed += 1
+                    yield finfo
+                else:
+                    # the partial checksum is only calculated if a copy is possible, i.e. there is an archived file of the same size
+                    store_queue.ingest(finfo, self.size_partials.get(finfo.size))
+
+        self.metrics.start_progress()
+        with self.metrics.phase('scan'):
+            if changes is not None:
+                logger.info(f'Scanning {len(changes.files)} changed files and {len(changes.dirs) + len(changes.lists)} changed directories from the change journal...')
+                finfo_with_checksum.extend(scanner.iter_with_checksums(route(self._iter_changed_tree(scanner, changes))))
+            else:
+                for root in self.backup_roots:
+                    finfo_with_checksum.extend(scanner.iter_with_checksums(route(scanner.iter_directory_tree(root, with_checksum=False))))
+            ingested = store_queue.drain()
+        finfo_with_checksum.extend(ingested)
+        self.metrics.merge({'files_skipped_meta': n_meta, 'files_hashed_only': n_hashed, 'files_ingested': len(ingested)})
 
-            # get checksums for files without checksum
-            logger.info(f'Calculating checksum for {len(paths_without_checksum)} files...')
-            finfo_with_checksum2 = scanner.create_file_entries(paths_without_checksum, with_checksum=True)
-            finfo_with_checksum.extend(finfo_with_checksum2)
+        total_size = sum([finfo.size for finfo in scanner.files])
+        logger.info(f'Scanned {len(scanner.files)} files with total size {pretty_size(total_size)}.')
+        logger.info(f'Reused checksum from metadata for {n_meta} files, calculated checksum for {n_hashed} files, '
+                    f'read {len(ingested)} new or changed files once for checksum and archive file.')
 
+        if full:
+            self.last_full_backup = dt.datetime.now().astimezone().isoformat()
+            self.n_backups_since_full = 0
+        else:
+            self.n_backups_since_full += 1
 
         logger.info('Updating archive...')
-        self._update_archive(finfo_with_checksum, hard_remove=hard_remove)
+        with self.metrics.phase('update'):
+            self._update_archive(finfo_with_checksum, hard_remove=hard_remove, store_queue=store_queue)
+            if hard_remove:
+                self.repack()
+        # the table is stored, so are the changes taken from the journal
+        self.changes.commit()
+        if dir_index is not None:
+            dir_index.store()
+        if self.remote is not None:
+            with self.metrics.phase('upload'):
+                stored = [self.active.get(checksum) or self.history.get(checksum) for checksum, result in store_queue.results.items() if result is not None]
+                self._upload([fpath for entry in stored if entry is not None for fpath in self._entry_fpaths(entry)])
+        self.metrics.stop_progress()
 
         t = time.time() - t0
+        self.metrics.merge({'backup_wall_seconds': t})
+        self.metrics.log_summary()
         logger.info(f'Done backup. Time spent: {pretty_time(t)}.')
         return self.info(log=True)
 
 
 
-    def cleanup_delete_all_history(self):
-        logger.info(f'Removing all files from archive history...')
-        removed_size = sum([self.history[checksum].arch_size for checksum in self.history.keys()])
-        to_remove = list(self.history.keys())
+    def _remove_history(self, to_remove):
+        removed_size = 0
         for checksum in to_remove:
-            self.history.pop(checksum)
-            self._remove_file(checksum)
-        
+            entry = self.history.pop(checksum)
+            removed_size += entry.arch_size
+            self._remove_archived(entry)
+            self._changed.add(checksum)
         self._store_archive_table()
+        self._sweep_dead_files()
+        self.repack()
+        return removed_size
+
+
+    def cleanup_delete_all_history(self):
+        logger.info(f'Removing all files from archive history...')
+        removed_size = self._remove_history(list(self.history.keys()))
         logger.info(f'Removed all files from history ({pretty_size(removed_size)}).')
         return self.info(log=True)
     
 
-    def cleanup_keep_latest_per_path_each_year(self):
-        # save last entry each year for each path
-        # group checkusums by path
-        path2checksums = {}
-        for checksum, entry in self.history.items():
-            for log in entry.log:
-                path2checksums.setdefault(log.path, set()).add(checksum)
-        
-        
-        to_keep = []
-        for _, checksums in path2checksums.items():
-            # keep latest entry for each year for each path
-            curr_year = dt.datetime.now().year
-            checksum2ts = { checksum: dt.datetime.fromisoformat(log.timestamp) for checksum in checksums for log in self.history[checksum].log  }
-            for year in range(curr_year, 2000, -1):
-                ts_in_year = [ts for ts in checksum2ts.values() if ts.year == year]
-                if len(ts_in_year) == 0:
-                    continue
-                latest_ts = max(ts_in_year)
-                latest_checksum = [checksum for checksum, ts in checksum2ts.items() if ts.year == year and ts == latest_ts][0]
-                to_keep.append(latest_checksum)
-
+    def cleanup_history(self, policy:RetentionPolicy):
+        # keep the history entries selected by the retention policy, remove the rest
+        to_keep = policy.select(self.history)
         to_remove = [checksum for checksum in self.history.keys() if checksum not in to_keep]
-        logger.info(f'Removing {len(to_remove)} files from archive history...')
-        removed_size = sum([self.history[checksum].arch_size for checksum in to_remove])
-        for checksum in to_remove:
-            self.history.pop(checksum)
-            self._remove_file(checksum)
-        
-        self._store_archive_table()
-        logger.info(f'Removed {len(to_remove)} files from history ({pretty_size(removed_size)}). Kept {len(to_keep)} files in history.')
+        logger.info(f'Removing {len(to_remove)} files from archive history (keeping {policy})...')
+        removed_size = self._remove_history(to_remove)
+        logger.info(f'Removed {len(to_remove)} files from history ({pretty_size(removed_size)}). Kept {len(self.history)} files in history.')
         return self.info(log=True)
 
 
-    def restore(self, restore_base_path):
-        logger.info(f'Restoring all files into: {restore_base_path}')
+    def cleanup_keep_latest_per_path_each_year(self):
+        # save last entry each year for each path
+        return self.cleanup_history(RetentionPolicy(yearly=-1))
+
+
+    def repack(self, min_dead_ratio=0.25):
+        # reclaim space from removed blobs in pack files by copying the live blobs to new packs. Only packs where at
+        # least min_dead_ratio of the bytes is removed data are rewritten, so a run does not rewrite the whole archive;
+        # the live blobs of all of them go to the same new packs, which combines the small ones
+        pack_sizes = self._list_packs()
+        pack2entries = {}
+        for entry in list(self.active.values()) + list(self.history.values()):
+            if entry.pack is not None:
+                pack2entries.setdefault(entry.pack, []).append(entry)
+
+        to_delete = [name for name in pack_sizes if name not in pack2entries]
+        to_repack = []
+        for name, entries in pack2entries.items():
+            size = pack_sizes.get(name, 0)
+            if size == 0:
+                logger.warning(f'Pack file missing: {name}')
+                continue
+            live_size = sum([entry.arch_size for entry in entries])
+            if (size - live_size) / size >= min_dead_ratio:
+                to_repack.append(name)
+
+        reclaimed_size = sum([pack_sizes[name] for name in to_delete])
+        if len(to_repack) > 0:
+            logger.info(f'Repacking {len(to_repack)} pack files...')
+            self._fetch([pack_fpath(self.pack_dir, name) for name in to_repack])
+            repacked = []
+            with PackWriter(self.pack_dir, self.pack_size) as pack_writer:
+                for name in to_repack:
+                    # the entries only move once all live blobs of the pack are copied, a pack that can not be
+                    # read is kept as it is
+                    moved = []
+                    try:
+                        with open(pack_fpath(self.pack_dir, name), 'rb') as fin:
+                            for entry in sorted(pack2entries[name], key=lambda entry: entry.pack_offset):
+                                fin.seek(entry.pack_offset)
+                                blob = fin.read(entry.arch_size)
+                                if len(blob) < entry.arch_size:
+                                    raise ValueError('pack file is truncated')
+                                moved.append((entry, pack_writer.add(blob)))
+                    except (OSError, ValueError) as e:
+                        logger.warning(f'Could not repack pack file {name}, keeping it ({e})')
+                        continue
+                    for entry, location in moved:
+                        entry.pack, entry.pack_offset, entry.arch_size = location
+                        self._changed.add(entry.checksum)
+                    repacked.append(name)
+                    reclaimed_size += pack_sizes[name]
+            reclaimed_size -= sum([size for name, size in list_packs(self.pack_dir).items() if name in pack_writer.written_packs])
+            # the table must point to the new packs before the old ones are deleted
+            self._store_archive_table()
+            if self.remote is not None:
+                self._upload([pack_fpath(self.pack_dir, name) for name in pack_writer.written_packs])
+            to_delete.extend(repacked)
+
+        for name in to_delete:
+            if os.path.exists(pack_fpath(self.pack_dir, name)):
+                os.remove(pack_fpath(self.pack_dir, name))
+        if self.remote is not None:
+            self.remote.delete([self._file_key(pack_fpath(self.pack_dir, name)) for name in to_delete])
+        logger.info(f'Removed {len(to_delete)} pack files, reclaimed {pretty_size(max(0, reclaimed_size))}.')
+
+
+    def collect_garbage(self, dry_run=False, min_tmp_age=3600) -> dict:
+        # remove archive files, chunks and packs that no table entry refers to, and temporary files older than
+        # min_tmp_age seconds. With dry_run only report what would be removed
+        blobs, chunks, packs = mark(list(self.active.values()) + list(self.history.values()))
+        logger.info(f'Marked {len(blobs)} archive files, {len(chunks)} chunks and {len(packs)} packs as live, sweeping{" (dry run)" if dry_run else ""}...')
+        tasks = [(shard, None, live, dry_run, min_tmp_age) for shard, live in shard_live(shard_dirs(self.file_dir), blobs)]
+        tasks += [(shard, None, live, dry_run, min_tmp_age) for shard, live in shard_live(shard_dirs(self.chunk_dir), chunks)]
+        tasks.append((self.tmp_dir, None, set(), dry_run, min_tmp_age))
+        n_files, n_bytes, n_errs, n_found = sweep(self.engine, tasks)
+
+        orphan_packs = {name: size for name, size in list_packs(self.pack_dir).items() if name not in packs}
+        for name in orphan_packs:
+            if not dry_run:
+                os.remove(pack_fpath(self.pack_dir, name))
+        report = {
+            'n_orphans': n_files + len(orphan_packs),
+            'orphan_size': n_bytes + sum(orphan_packs.values()),
+            'n_missing': len(blobs) + len(chunks) - n_found,
+            'n_errors': n_errs,
+        }
+        if self.remote is not None:
+            # the remote listing is refreshed, files uploaded by anything else than this archive would be orphans
+            self.remote.refresh()
+            live_keys = {self._file_key(fpath) for fpath in self._live_fpaths()}
+            orphan_keys = {key: size for key, size in self.remote.files_under('').items() if key not in live_keys}
+            if not dry_run:
+                self.remote.delete(list(orphan_keys))
+            report['n_orphans'] += len(orphan_keys)
+            report['orphan_size'] += sum(orphan_keys.values())
+            report['n_missing_remote'] = len([key for key in live_keys if key not in self.remote])
+            if not self.keep_local:
+                # the local files are only a staging area
+                report['n_missing'] = report['n_missing_remote']
+        verb = 'Would remove' if dry_run else 'Removed'
+        logger.info(f"{verb} {report['n_orphans']} unreferenced files ({pretty_size(report['orphan_size'])}), {n_errs} errors.")
+        if report['n_missing'] > 0:
+            logger.warning(f"{report['n_missing']} archive files or chunks referenced by the table are missing, run a backup to store them again.")
+        if report.get('n_missing_remote', 0) > 0 and self.keep_local:
+            logger.warning(f"{report['n_missing_remote']} archive files are not on the remote, run the sync action to upload them.")
+        return report
+
+
+    def _load_verify_checkpoint(self, mode, restart):
+        checkpoint_path = self.table_dir / 'verify_checkpoint.json'
+        if checkpoint_path.exists() and not restart:
+            with open(checkpoint_path) as f:
+                checkpoint = json.load(f)
+            if checkpoint.get('mode') == mode:
+                logger.info(f"Resuming {mode} verification started {checkpoint['started']}, {checkpoint['n_checked']} files already checked.")
+                return checkpoint
+        return {'mode': mode, 'started': dt.datetime.now().astimezone().isoformat(), 'cursor': '', 'n_checked': 0, 'errors': {}}
+
+
+    def _store_verify_checkpoint(self, checkpoint):
+        checkpoint_path = self.table_dir / 'verify_checkpoint.json'
+        tmp_path = checkpoint_path.with_suffix('.tmp')
+        with open(tmp_path, 'w') as f:
+            json.dump(checkpoint, f)
+        os.replace(tmp_path, checkpoint_path)
+
+
+    def verify(self, deep=True, rate_limit=None, restart=False, checkpoint_every=30, batch_bytes=64*1024*1024, batch_files=256) -> dict:
+        # deep decrypts all archive files and compares the content with the checksum, otherwise only the structure
+        # (header, chunk index and chunk lengths) is checked. Entries are checked in checksum order and the progress
+        # is checkpointed in the table dir, so an interrupted run continues where it stopped (restart to start over).
+        # rate_limit in bytes per second of archive data read, None for no limit
+        mode = 'deep' if deep else 'structural'
+        checkpoint = self._load_verify_checkpoint(mode, restart)
+        entries = sorted([entry for entry in list(self.active.values()) + list(self.history.values()) if entry.checksum > checkpoint['cursor']],
+                         key=lambda entry: entry.checksum)
+        logger.info(f'Verifying {len(entries)} archive files ({mode})...')
+
+        # batches of about equal size, the structural check only reads a few blocks per blob
+        batches = []
+        batch, batch_size = [], 0
+        for entry in entries:
+            batch.append(entry)
+            batch_size += (entry.size or entry.arch_size) if deep else 4096
+            if batch_size >= batch_bytes or len(batch) >= batch_files or entry is entries[-1]:
+                batches.append((batch, batch_size))
+                batch, batch_size = [], 0
 
-        # prepare folders and srcdst_path_pairs
-        srcdst_path_pairs = []
-        for checksum, entry in self.active.items():
-            arch_path = self._archived_fpath(checksum)
-            for fptr in entry.fptrs:
-                dst_path = Path(fptr.path)
-                dst_path = Path(restore_base_path) / dst_path.absolute().as_posix().replace(':','_')
-                srcdst_path_pairs.append((arch_path, dst_path))
-                if not dst_path.parent.exists():
-                    os.makedirs(dst_path.parent)
+        t0 = time.time()
+        t_checkpoint = t0
+        n_bytes = 0
+        done = {} # batch number : last checksum, for batches finished out of order
+        next_batch = 0
+        batch_fpaths = {} # batch number : archive files of the batch, to drop the downloaded ones once checked
+        in_use = {} # archive file : batches in flight that read it
+        fetched = set()
+
+        def handle(tag, results, error):
+            nonlocal next_batch, t_checkpoint
+            batch_no, checksums = tag
+            if error is not None:
+                results = [f'{type(error).__name__}: {error}']*len(checksums)
+            for checksum, problem in zip(checksums, results):
+                if problem is not None:
+                    logger.error(f'Archive file damaged: {checksum} ({problem})')
+                    checkpoint['errors'][checksum] = problem
+            checkpoint['n_checked'] += len(checksums)
+            for fpath in batch_fpaths.pop(batch_no, []):
+                in_use[fpath] -= 1
+                if in_use[fpath] == 0:
+                    del in_use[fpath]
+                    if fpath in fetched and not self.keep_local:
+                        self._evict([fpath])
+                        fetched.discard(fpath)
+            # the cursor only moves past batches that are done, all before it are checked
+            done[batch_no] = checksums[-1]
+            while next_batch in done:
+                checkpoint['cursor'] = done.pop(next_batch)
+                next_batch += 1
+            if time.time() - t_checkpoint >= checkpoint_every:
+                self._store_verify_checkpoint(checkpoint)
+                t_checkpoint = time.time()
+                logger.info(f"Checked {checkpoint['n_checked']} archive files, {len(checkpoint['errors'])} damaged.")
+
+        tasks = TaskQueue(self.engine)
+        for batch_no, (batch, batch_size) in enumerate(batches):
+            if rate_limit:
+                # wait until the data read so far is within the limit
+                wait = n_bytes / rate_limit - (time.time() - t0)
+                if wait > 0:
+                    time.sleep(wait)
+            if self.remote is not None:
+                batch_fpaths[batch_no] = list(dict.fromkeys(fpath for entry in batch for fpath in self._entry_fpaths(entry)))
+                fetched.update(self._fetch(batch_fpaths[batch_no]))
+                for fpath in batch_fpaths[batch_no]:
+                    in_use[fpath] = in_use.get(fpath, 0) + 1
+            items = [(entry.checksum, self._archived_src(entry, fetch=False), entry.chunks) for entry in batch]
+            tasks.put(_verify_entries, (items, deep), tag=(batch_no, [entry.checksum for entry in batch]))
+            n_bytes += batch_size
+            for done_task in tasks.completed():
+                handle(*done_task)
+        for done_task in tasks.drain():
+            handle(*done_task)
+
+        checkpoint_path = self.table_dir / 'verify_checkpoint.json'
+        if checkpoint_path.exists():
+            os.remove(checkpoint_path)
+        n_errors = len(checkpoint['errors'])
+        logger.info(f"Verified {checkpoint['n_checked']} archive files ({mode}) in {pretty_time(time.time() - t0)}, {n_errors} damaged.")
+        return {'mode': mode, 'n_checked': checkpoint['n_checked'], 'n_errors': n_errors, 'errors': checkpoint['errors']}
+
+
+    def _get_path_index(self):
+        # (sorted paths, checksums) of the active entries
+        if self._path_index is None:
+            pairs = sorted([(fptr.path, checksum) for checksum, entry in self.active.items() for fptr in entry.fptrs])
+            self._path_index = ([path for path, _ in pairs], [checksum for _, checksum in pairs])
+        return self._path_index
+
+
+    def _get_event_index(self):
+        # (sorted paths, path : [(posix time, event code, checksum)] sorted by time) from the logs of all entries
+        if self._event_index is None:
+            path_events = {}
+            for checksum, entry in list(self.active.items()) + list(self.history.items()):
+                for event in entry.log:
+                    if event.path is None:
+                        continue
+                    path_events.setdefault(event.path, []).append((event.time, event.code, checksum))
+            for events in path_events.values():
+                events.sort()
+            self._event_index = (sorted(path_events.keys()), path_events)
+        return self._event_index
+
+
+    def log_dates(self) -> list:
+        # sorted dates (local time) with any logged change, e.g. for browsing the archive as it was each day
+        _, path_events = self._get_event_index()
+        return sorted({dt.datetime.fromtimestamp(time).date() for events in path_events.values() for time, _, _ in events})
+
+
+    def _iter_prefix(self, sorted_paths, prefix):
+        # indexes of the sorted paths that start with prefix
+        i = bisect.bisect_left(sorted_paths, prefix)
+        while i < len(sorted_paths) and sorted_paths[i].startswith(prefix):
+            yield i
+            i += 1
+
+
+    def select(self, prefix=None, pattern=None, checksum=None, as_of=None) -> list:
+        # (path, entry) of the files matching all given filters. Without as_of from the active entries, with as_of 
+        # (iso timestamp or datetime) the files as they were at that time, rebuilt from the logs of all entries
+        if prefix is not None:
+            prefix = Path(prefix).absolute().as_posix()
+        if pattern is not None:
+            # paths are absolute, relative patterns match anywhere
+            pattern = pattern if pattern.startswith('/') or pattern.startswith('*') else '*/' + pattern
+            # the part before the first wildcard narrows down the index
+            literal = pattern[:min([pattern.find(c) for c in '*?[' if c in pattern] + [len(pattern)])]
+            if prefix is None or literal.startswith(prefix):
+                prefix = literal
+            elif not prefix.startswith(literal):
+                return []
+        prefix = prefix or ''
+
+        selected = []
+        if as_of is None:
+            paths, checksums = self._get_path_index()
+            for i in self._iter_prefix(paths, prefix):
+                selected.append((paths[i], checksums[i]))
+        else:
+            if isinstance(as_of, str):
+                as_of = dt.datetime.fromisoformat(as_of)
+            as_of = as_of.astimezone() # naive is local time
+            paths, path_events = self._get_event_index()
+            for i in self._iter_prefix(paths, prefix):
+                events = path_events[paths[i]]
+                # last event up to as_of decides if the path was there and with which content
+                k = bisect.bisect_right(events, (as_of.timestamp(), float('inf'))) - 1
+                if k >= 0 and events[k][1] == BlobEvent.ADDED.value:
+                    selected.append((paths[i], events[k][2]))
+
+        result = []
+        for path, path_checksum in selected:
+            if checksum is not None and path_checksum != checksum:
+                continue
+            if pattern is not None and not fnmatch.fnmatchcase(path, pattern):
+                continue
+            entry = self.active.get(path_checksum) or self.history.get(path_checksum)
+            if entry is not None:
+                result.append((path, entry))
+        return result
+
+
+    def _restore_fpath(self, restore_base_path, path):
+        # the absolute path is appended below the restore path, with the ":" of a drive replaced by "_"
+        rel_path = Path(path).absolute().as_posix().replace(':','_').lstrip('/')
+        return Path(restore_base_path) / rel_path
+
+
+    def restore(self, restore_base_path, hardlink_duplicates=False, prefix=None, pattern=None, checksum=None, as_of=None):
+        logger.info(f'Restoring into: {restore_base_path}')
+
+        # (path, entry) of all active files or the selected ones
+        if prefix is None and pattern is None and checksum is None and as_of is None:
+            selected = [(fptr.path, entry) for entry in self.active.values() for fptr in entry.fptrs]
+        else:
+            selected = self.select(prefix=prefix, pattern=pattern, checksum=checksum, as_of=as_of)
+            logger.info(f'Selected {len(selected)} files.')
+
+        # one task per archive blob with all its paths, so that each blob is decrypted and decompressed once
+        checksum2paths = {}
+        for path, entry in selected:
+            checksum2paths.setdefault(entry.checksum, (entry, []))[1].append(self._restore_fpath(restore_base_path, path))
+        fetched = self._fetch([fpath for entry, _ in checksum2paths.values() for fpath in self._entry_fpaths(entry)])
+        src_dsts_pairs = []
+        for entry, dst_paths in checksum2paths.values():
+            for dst_path in dst_paths:
+                os.makedirs(dst_path.parent, exist_ok=True)
+            src_dsts_pairs.append((self._archived_src(entry, fetch=False), dst_paths))
+        n_files = sum([len(dst_paths) for _, dst_paths in src_dsts_pairs])
         
-        logger.info(f'Restoring {len(srcdst_path_pairs)} files...')
+        logger.info(f'Restoring {n_files} files from {len(src_dsts_pairs)} archive files...')
         
         # restore files
-        self.crypto.restore_files(srcdst_path_pairs)
-
-        total_size = sum([fptr.size for entry in self.active.values() for fptr in entry.fptrs])
-        logger.info(f'Restored {len(srcdst_path_pairs)} files, {pretty_size(total_size)}.')
+        self.crypto.restore_files(src_dsts_pairs, hardlink=hardlink_duplicates)
+        if not self.keep_local:
+            self._evict(fetched)
+
+        total_size = sum([dst_path.stat().st_size for _, dst_paths in src_dsts_pairs for dst_path in dst_paths if dst_path.exists()])
+        logger.info(f'Restored {n_files} files, {pretty_size(total_size)}.')
+
+
+    def restore_stream(self, out, tar=False, prefix=None, pattern=None, checksum=None, as_of=None):
+        # writes the content of one selected file, or a tar stream of all selected files, to the binary file object
+        # out (e.g. sys.stdout.buffer) without using temporary space
+        selected = self.select(prefix=prefix, pattern=pattern, checksum=checksum, as_of=as_of)
+        crypto = self._local_crypto()
+        if not tar:
+            if len(selected) != 1:
+                raise ValueError(f'Streaming without tar needs exactly one selected file, got {len(selected)}')
+            crypto.restore_to(self._archived_src(selected[0][1]), out)
+            out.flush()
+            return
+
+        logger.info(f'Streaming {len(selected)} files as tar...')
+        with TarStreamWriter(out) as tar_writer:
+            for path, entry in selected:
+                fptr = next((fptr for fptr in entry.fptrs if fptr.path == path), None)
+                size = fptr.size if fptr is not None else entry.size
+                mtime = fptr.mtime if fptr is not None else time.time()
+                src = self._archived_src(entry)
+                if size is None:
+                    # history entry from before the size was recorded, decode it once to get the size
+                    size = content_size(lambda fout: crypto.restore_to(src, fout))
+                tar_writer.add(path, size, mtime, lambda fout: crypto.restore_to(src, fout))
 
 
     def info(self, log=False) -> dict:
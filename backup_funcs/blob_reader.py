@@ -0,0 +1,270 @@
+import io
+import os
+import bisect
+import tempfile
+import threading
+from collections import OrderedDict
+
+from .crypto import Crypto, HEADER_SIZE, MAGIC
+from .packs import PackedBlob
+
+
+
+"""
+Least recently used cache of decrypted chunks, bounded by the total size of the cached data. Shared by the readers
+of e.g. the archive browser, keyed by (blob path, blob offset, chunk number). It also keeps the plain sizes of
+the chunk files of chunked files (see ConcatReader), up to max_sizes of them.
+"""
+class ChunkCache():
+    def __init__(self, max_bytes=256*1024*1024, max_sizes=1000000):
+        self.max_bytes = max_bytes
+        self.n_bytes = 0
+        self.max_sizes = max_sizes
+        self._chunks = OrderedDict()
+        self._sizes = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get_size(self, key):
+        with self._lock:
+            size = self._sizes.get(key)
+            if size is not None:
+                self._sizes.move_to_end(key)
+            return size
+
+    def put_size(self, key, size):
+        with self._lock:
+            self._sizes[key] = size
+            if len(self._sizes) > self.max_sizes:
+                self._sizes.popitem(last=False)
+
+    def get(self, key):
+        with self._lock:
+            data = self._chunks.get(key)
+            if data is not None:
+                self._chunks.move_to_end(key)
+            return data
+
+    def put(self, key, data):
+        if len(data) > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._chunks:
+                return
+            self._chunks[key] = data
+            self.n_bytes += len(data)
+            while self.n_bytes > self.max_bytes:
+                _, evicted = self._chunks.popitem(last=False)
+                self.n_bytes -= len(evicted)
+
+
+
+"""
+Read only, seekable file object over the plain content of a version 3 archive blob (see crypto.py). Only the chunks
+that a read touches are decrypted, the last one is cached so that small sequential reads don't decrypt it again.
+The blob can be a whole file or a range inside a pack file.
+"""
+class BlobReader(io.RawIOBase):
+    def __init__(self, crypto:Crypto, path, offset=0, length=None, cache:ChunkCache=None):
+        super().__init__()
+        self._fin = open(path, 'rb')
+        try:
+            end = offset + length if length is not None else os.fstat(self._fin.fileno()).st_size
+            self._header, self._codec, self._cipher, self._chunk_index = crypto.read_blob_index(self._fin, offset, end)
+        except:
+            self._fin.close()
+            raise
+        self._crypto = crypto
+        self._plain_offsets = [plain_offset for plain_offset, _, _, _ in self._chunk_index]
+        self.size = sum([plain_size for _, plain_size, _, _ in self._chunk_index])
+        self._pos = 0
+        self._cached = (None, b'') # chunk number, plain data
+        self._cache = cache
+        self._cache_key = (os.fspath(path), offset)
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self._pos
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_SET:
+            pos = offset
+        elif whence == io.SEEK_CUR:
+            pos = self._pos + offset
+        elif whence == io.SEEK_END:
+            pos = self.size + offset
+        else:
+            raise ValueError(f'Invalid whence: {whence}')
+        if pos < 0:
+            raise ValueError('Negative seek position')
+        self._pos = pos
+        return pos
+
+    def _chunk(self, i) -> bytes:
+        if self._cached[0] != i:
+            data = self._cache.get(self._cache_key + (i,)) if self._cache is not None else None
+            if data is None:
+                _, _, record_offset, record_size = self._chunk_index[i]
+                self._fin.seek(record_offset)
+                record = self._fin.read(record_size)
+                data = self._crypto.decrypt_chunk(self._header, self._codec, self._cipher, record, i, i == len(self._chunk_index) - 1)
+                if self._cache is not None:
+                    self._cache.put(self._cache_key + (i,), data)
+            self._cached = (i, data)
+        return self._cached[1]
+
+    def readinto(self, b):
+        if self._pos >= self.size:
+            return 0
+        i = bisect.bisect_right(self._plain_offsets, self._pos) - 1
+        # skip empty chunks
+        while self._chunk_index[i][1] == 0:
+            i += 1
+        data = self._chunk(i)
+        start = self._pos - self._plain_offsets[i]
+        n = min(len(b), len(data) - start)
+        b[:n] = data[start:start+n]
+        self._pos += n
+        return n
+
+    def close(self):
+        if not self.closed:
+            self._fin.close()
+        super().close()
+
+
+
+"""
+Seekable concatenation of parts, for files stored as content defined chunks. Only the part that a read is in is
+open: open_part(part) opens it when a read or seek reaches it and the previous one is closed, so a file of
+thousands of chunks does not hold a file descriptor per chunk. The plain size of a part is known once it was
+opened (kept in the cache for the next reader of the same chunk), so with the total size given a read from the
+start never opens a part before it gets to it, and a seek only opens the parts before it one at a time.
+"""
+class ConcatReader(io.RawIOBase):
+    def __init__(self, parts, open_part, size=None, cache:ChunkCache=None):
+        super().__init__()
+        self._parts = parts
+        self._open_part = open_part
+        self._size = size
+        self._cache = cache
+        self._offsets = [0] # start offsets of the parts with known size, and the end of the last one
+        self._current = (None, None) # part number, open reader
+        self._pos = 0
+
+    @property
+    def size(self) -> int:
+        if self._size is None:
+            while len(self._offsets) <= len(self._parts):
+                self._add_offset()
+            self._size = self._offsets[-1]
+        return self._size
+
+    def _reader(self, i):
+        if self._current[0] != i:
+            self._close_current()
+            self._current = (i, self._open_part(self._parts[i]))
+        return self._current[1]
+
+    def _close_current(self):
+        reader = self._current[1]
+        self._current = (None, None)
+        if reader is not None:
+            reader.close()
+
+    def _add_offset(self):
+        # size of the next part, from the cache or by opening it
+        i = len(self._offsets) - 1
+        key = os.fspath(self._parts[i])
+        part_size = self._cache.get_size(key) if self._cache is not None else None
+        if part_size is None:
+            part_size = self._reader(i).seek(0, io.SEEK_END)
+            if self._cache is not None:
+                self._cache.put_size(key, part_size)
+        self._offsets.append(self._offsets[-1] + part_size)
+
+    def _locate(self, pos):
+        # number of the part with pos, None at the end
+        if self._size is not None and pos >= self._size:
+            return None
+        while self._offsets[-1] <= pos and len(self._offsets) <= len(self._parts):
+            self._add_offset()
+        if pos >= self._offsets[-1]:
+            return None
+        # the last part starting at or before pos, which is not empty since a later part starts after pos
+        return bisect.bisect_right(self._offsets, pos) - 1
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self._pos
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_END:
+            pos = self.size + offset
+        else:
+            pos = {io.SEEK_SET: 0, io.SEEK_CUR: self._pos}[whence] + offset
+        if pos < 0:
+            raise ValueError('Negative seek position')
+        self._pos = pos
+        return pos
+
+    def readinto(self, b):
+        while True:
+            i = self._locate(self._pos)
+            if i is None:
+                return 0
+            reader = self._reader(i)
+            reader.seek(self._pos - self._offsets[i])
+            data = reader.read(len(b))
+            n = len(data)
+            if n:
+                b[:n] = data
+                self._pos += n
+                return n
+            # the part is shorter than its size, go on with the next one
+            self._pos = self._offsets[i+1]
+
+    def close(self):
+        if not self.closed:
+            self._close_current()
+        super().close()
+
+
+
+def _is_indexed_blob(path, offset=0) -> bool:
+    with open(path, 'rb') as fin:
+        fin.seek(offset)
+        header = fin.read(HEADER_SIZE)
+    return header[:len(MAGIC)] == MAGIC and len(header) == HEADER_SIZE and header[len(MAGIC)] >= 3
+
+
+def open_raw_blob(crypto:Crypto, src, cache:ChunkCache=None, size=None):
+    # raw seekable reader for src as from Archive._archived_src, blobs without chunk index 
+    # (older format versions) are decoded into a spooled temporary file. size is the plain size if known, e.g.
+    # from the archive entry, so that a chunked file does not need to open its chunks to know it
+    if isinstance(src, (list, tuple)) and not isinstance(src, PackedBlob):
+        return ConcatReader(list(src), lambda chunk_path: open_raw_blob(crypto, chunk_path, cache=cache), size=size, cache=cache)
+    path, offset, length = (src.pack_path, src.offset, src.length) if isinstance(src, PackedBlob) else (src, 0, None)
+    if _is_indexed_blob(path, offset):
+        return BlobReader(crypto, path, offset=offset, length=length, cache=cache)
+    spooled = tempfile.SpooledTemporaryFile(max_size=64*1024*1024)
+    crypto.restore_to(src, spooled)
+    spooled.seek(0)
+    return spooled
+
+
+def open_blob(crypto:Crypto, src, buffer_size=1024*1024, cache:ChunkCache=None, size=None):
+    # buffered reader so that read(n) returns n bytes unless at the end
+    raw = open_raw_blob(crypto, src, cache=cache, size=size)
+    if isinstance(raw, io.RawIOBase):
+        return io.BufferedReader(raw, buffer_size=buffer_size)
+    return raw
@@ -0,0 +1,294 @@
+import datetime as dt
+import html
+import mimetypes
+import re
+import threading
+import urllib.parse
+from collections import namedtuple
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+from .archive import Archive
+from .blob_reader import ChunkCache
+from .logger import Logger
+
+# optional, for mounting the archive view
+try:
+    import fuse
+except ImportError:
+    fuse = None
+
+logger = Logger()
+
+
+ArchivedFile = namedtuple('ArchivedFile', ['entry', 'size', 'mtime'])
+
+
+
+"""
+Read only virtual view of the archive:
+    /current/<path>             the active files
+    /snapshots/<date>/<path>    the files as they were at the end of each day with changes, rebuilt from the logs
+The directory trees are built on first use from the archive table, file contents are decrypted on demand
+with the decrypted chunks kept in a shared LRU cache.
+"""
+class ArchiveView():
+    def __init__(self, archive:Archive, cache_size=256*1024*1024):
+        self.archive = archive
+        self.cache = ChunkCache(cache_size)
+        self._trees = {} # 'current' or snapshot date : tree
+        self._sizes = {} # checksum : size, of entries from before the size was recorded
+        self._snapshots = None
+        self._lock = threading.Lock()
+
+    def snapshots(self) -> list[str]:
+        if self._snapshots is None:
+            self._snapshots = [date.isoformat() for date in self.archive.log_dates()]
+        return self._snapshots
+
+    def _build_tree(self, selected) -> dict:
+        # nested dicts for directories with ArchivedFile leaves
+        tree = {}
+        for path, entry in selected:
+            parts = [part for part in path.split('/') if part]
+            if len(parts) == 0:
+                continue
+            node = tree
+            for part in parts[:-1]:
+                node = node.setdefault(part, {})
+                if not isinstance(node, dict):
+                    break
+            else:
+                fptr = next((fptr for fptr in entry.fptrs if fptr.path == path), None)
+                size = fptr.size if fptr is not None else entry.size
+                mtime = fptr.mtime if fptr is not None else None
+                node[parts[-1]] = ArchivedFile(entry, size, mtime)
+        return tree
+
+    def _tree(self, name) -> dict:
+        with self._lock:
+            if name not in self._trees:
+                if name == 'current':
+                    selected = self.archive.select()
+                else:
+                    # end of the day in local time
+                    as_of = dt.datetime.combine(dt.date.fromisoformat(name), dt.time.max).astimezone()
+                    selected = self.archive.select(as_of=as_of)
+                self._trees[name] = self._build_tree(selected)
+            return self._trees[name]
+
+    def lookup(self, path):
+        # directory as dict (name : dict or ArchivedFile), ArchivedFile, or None if not found
+        parts = [part for part in path.split('/') if part]
+        if len(parts) == 0:
+            return {'current': {}, 'snapshots': {}}
+        if parts[0] == 'current':
+            node = self._tree('current')
+            parts = parts[1:]
+        elif parts[0] == 'snapshots':
+            if len(parts) == 1:
+                return {name: {} for name in self.snapshots()}
+            if parts[1] not in self.snapshots():
+                return None
+            node = self._tree(parts[1])
+            parts = parts[2:]
+        else:
+            return None
+        for part in parts:
+            if not isinstance(node, dict) or part not in node:
+                return None
+            node = node[part]
+        return node
+
+    def listdir(self, path) -> list:
+        # [(name, is_dir, size, mtime)], None if path is not a directory
+        node = self.lookup(path)
+        if not isinstance(node, dict):
+            return None
+        return [(name, isinstance(child, dict), None if isinstance(child, dict) else self.file_size(child),
+                 None if isinstance(child, dict) else child.mtime) for name, child in sorted(node.items())]
+
+    def file_size(self, archived_file:ArchivedFile) -> int:
+        if archived_file.size is not None:
+            return archived_file.size
+        # entry from before the size was recorded, the chunk index knows it. Kept, as e.g. fuse asks on every getattr
+        checksum = archived_file.entry.checksum
+        size = self._sizes.get(checksum)
+        if size is None:
+            with self.open_file(archived_file) as f:
+                size = f.seek(0, 2)
+            self._sizes[checksum] = size
+        return size
+
+    def open_file(self, archived_file:ArchivedFile):
+        return self.archive.open_blob(archived_file.entry.checksum, cache=self.cache)
+
+    def open(self, path):
+        node = self.lookup(path)
+        if not isinstance(node, ArchivedFile):
+            raise FileNotFoundError(path)
+        return self.open_file(node)
+
+
+
+# ------------------------------------ http
+
+
+_RANGE = re.compile(r'bytes=(\d*)-(\d*)', re.ASCII)
+
+
+def _parse_range(range_header, size):
+    # (start, end) of a single byte range as "bytes=0-99", "bytes=100-" or "bytes=-100", which can be outside the
+    # file (the caller answers 416). None for several ranges or a malformed header, which is ignored as http allows
+    match = _RANGE.fullmatch(range_header.strip())
+    if match is None:
+        return None
+    first, last = match.groups()
+    if first:
+        start = int(first)
+        if last and int(last) < start:
+            return None
+        return start, min(int(last), size - 1) if last else size - 1
+    if last:
+        # the last bytes, none is not satisfiable
+        return max(0, size - int(last)) if int(last) > 0 else size, size - 1
+    return None
+
+
+class _BrowseHandler(BaseHTTPRequestHandler):
+    view:ArchiveView = None
+
+    def log_message(self, format, *args):
+        logger.info(f'browse: {self.address_string()} {format % args}')
+
+    def do_GET(self):
+        path = urllib.parse.unquote(urllib.parse.urlsplit(self.path).path)
+        node = self.view.lookup(path)
+        if node is None:
+            self.send_error(404)
+        elif isinstance(node, dict):
+            if not path.endswith('/'):
+                self.send_response(301)
+                self.send_header('Location', urllib.parse.quote(path) + '/')
+                self.end_headers()
+                return
+            self._send_listing(path)
+        else:
+            self._send_file(path, node)
+
+    def _send_listing(self, path):
+        rows = []
+        for name, is_dir, size, mtime in self.view.listdir(path):
+            href = urllib.parse.quote(name) + ('/' if is_dir else '')
+            info = '' if is_dir else f'{size} bytes'
+            if mtime is not None:
+                info += f', {dt.datetime.fromtimestamp(mtime).isoformat(timespec="seconds")}'
+            rows.append(f'<li><a href="{href}">{html.escape(name)}{"/" if is_dir else ""}</a> {info}</li>')
+        body = (f'<html><head><meta charset="utf-8"><title>{html.escape(path)}</title></head><body>'
+                f'<h3>{html.escape(path)}</h3><ul><li><a href="../">../</a></li>{"".join(rows)}</ul></body></html>').encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/html; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _send_file(self, path, archived_file):
+        size = self.view.file_size(archived_file)
+        start, end = 0, size - 1
+        status = 200
+        range_header = self.headers.get('Range')
+        byte_range = _parse_range(range_header, size) if range_header is not None else None
+        if byte_range is not None:
+            # single range, e.g. to seek in a video or resume a download
+            start, end = byte_range
+            if start > end or start >= size:
+                self.send_response(416)
+                self.send_header('Content-Range', f'bytes */{size}')
+                self.end_headers()
+                return
+            status = 206
+        self.send_response(status)
+        self.send_header('Content-Type', mimetypes.guess_type(path)[0] or 'application/octet-stream')
+        self.send_header('Content-Length', str(end - start + 1))
+        self.send_header('Accept-Ranges', 'bytes')
+        if status == 206:
+            self.send_header('Content-Range', f'bytes {start}-{end}/{size}')
+        self.end_headers()
+        with self.view.open_file(archived_file) as f:
+            f.seek(start)
+            remaining = end - start + 1
+            while remaining > 0:
+                data = f.read(min(remaining, 1024*1024))
+                if not data:
+                    break
+                self.wfile.write(data)
+                remaining -= len(data)
+
+
+def serve_http(view:ArchiveView, host='127.0.0.1', port=8080):
+    handler = type('BrowseHandler', (_BrowseHandler,), {'view': view})
+    server = ThreadingHTTPServer((host, port), handler)
+    logger.info(f'Browsing archive at http://{host}:{port}/ (read only), stop with ctrl+c')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+
+# ------------------------------------ fuse
+
+
+if fuse is not None:
+    import errno
+    import stat
+
+    class _ArchiveFuse(fuse.Operations):
+        def __init__(self, view:ArchiveView):
+            self.view = view
+            self._open = {} # file handle : file object
+            self._next_fh = 0
+            self._lock = threading.Lock()
+
+        def getattr(self, path, fh=None):
+            node = self.view.lookup(path)
+            if node is None:
+                raise fuse.FuseOSError(errno.ENOENT)
+            if isinstance(node, dict):
+                return {'st_mode': stat.S_IFDIR | 0o555, 'st_nlink': 2}
+            mtime = node.mtime or 0
+            return {'st_mode': stat.S_IFREG | 0o444, 'st_nlink': 1, 'st_size': self.view.file_size(node),
+                    'st_mtime': mtime, 'st_atime': mtime, 'st_ctime': mtime}
+
+        def readdir(self, path, fh):
+            entries = self.view.listdir(path)
+            if entries is None:
+                raise fuse.FuseOSError(errno.ENOTDIR)
+            return ['.', '..'] + [name for name, _, _, _ in entries]
+
+        def open(self, path, flags):
+            node = self.view.lookup(path)
+            if node is None or isinstance(node, dict):
+                raise fuse.FuseOSError(errno.ENOENT)
+            with self._lock:
+                self._next_fh += 1
+                self._open[self._next_fh] = (self.view.open_file(node), threading.Lock())
+                return self._next_fh
+
+        def read(self, path, size, offset, fh):
+            f, lock = self._open[fh]
+            with lock:
+                f.seek(offset)
+                return f.read(size)
+
+        def release(self, path, fh):
+            f, _ = self._open.pop(fh)
+            f.close()
+
+
+def mount(view:ArchiveView, mountpoint):
+    if fuse is None:
+        raise RuntimeError('Mounting needs the fusepy package, use the http browser instead')
+    logger.info(f'Mounting archive read only at {mountpoint}, unmount to stop')
+    fuse.FUSE(_ArchiveFuse(view), str(mountpoint), foreground=True, ro=True, nothreads=False)
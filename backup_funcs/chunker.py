@@ -0,0 +1,74 @@
+import hashlib
+import numpy as np
+
+
+
+"""
+Content defined chunking with a gear rolling hash (as in FastCDC).
+The 32 bit gear hash h_i = (h_{i-1} << 1) + G[b_i] only depends on the last 32 bytes, so it is calculated for a
+whole buffer at once with numpy by doubling the window: h_2w(i) = h_w(i) + (h_w(i-w) << w).
+A chunk ends after byte i if the high bits of h_i selected by the mask are zero, but not before min_size
+and at latest at max_size. Since min_size > 32 the boundaries only depend on the content of the chunk itself,
+so an insert or delete only changes the chunks around it.
+"""
+GEAR = np.array([int.from_bytes(hashlib.sha256(bytes([i])).digest()[:4], 'little') for i in range(256)], dtype=np.uint32)
+WINDOW = 32
+
+DEFAULT_AVG_SIZE = 2*1024*1024
+DEFAULT_MIN_SIZE = DEFAULT_AVG_SIZE // 4
+DEFAULT_MAX_SIZE = DEFAULT_AVG_SIZE * 4
+
+
+def _gear_hash(data) -> np.ndarray:
+    arr = np.frombuffer(data, dtype=np.uint8)
+    h = GEAR[arr]
+    w = 1
+    while w < WINDOW and w < len(h):
+        shifted = h[:-w] << np.uint32(w)
+        h[w:] += shifted
+        w *= 2
+    return h
+
+
+def _boundary_mask(avg_size) -> np.uint32:
+    bits = max(1, int(avg_size).bit_length() - 1)
+    return np.uint32(((1 << bits) - 1) << (32 - bits))
+
+
+def iter_chunks(in_file_obj, avg_size=DEFAULT_AVG_SIZE, min_size=None, max_size=None, read_size=None):
+    min_size = min_size or avg_size // 4
+    max_size = max_size or avg_size * 4
+    read_size = read_size or max_size * 2
+    if min_size <= WINDOW or max_size < min_size:
+        raise ValueError('Invalid chunk sizes')
+    mask = _boundary_mask(avg_size)
+
+    pending = b''
+    eof = False
+    while not eof:
+        data = in_file_obj.read(read_size)
+        eof = not data
+        buf = pending + data if pending else data
+        if len(buf) == 0:
+            break
+
+        # candidate chunk ends (index of the last byte in the chunk)
+        candidates = np.flatnonzero((_gear_hash(buf) & mask) == 0)
+        start = 0
+        while True:
+            lo = start + min_size - 1
+            hi = start + max_size - 1
+            i = np.searchsorted(candidates, lo)
+            if i < len(candidates) and candidates[i] <= hi:
+                end = int(candidates[i]) + 1
+            elif hi < len(buf):
+                end = hi + 1
+            else:
+                # undecided until more data is read (or last chunk at eof)
+                break
+            yield buf[start:end]
+            start = end
+        pending = buf[start:]
+
+    if pending:
+        yield pending
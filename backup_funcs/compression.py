@@ -0,0 +1,103 @@
+import threading
+import zlib
+import lzma
+
+# optional codecs, used when installed
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+try:
+    import lz4.frame as lz4_frame
+except ImportError:
+    lz4_frame = None
+
+
+
+"""
+Compression codec identified by the id that is stored in the blob header. Ids must never be reused.
+"""
+class Codec():
+    def __init__(self, codec_id, name, compress, decompress):
+        self.codec_id = codec_id
+        self.name = name
+        self.compress = compress
+        self.decompress = decompress
+
+    def __repr__(self):
+        return f'{self.name} ({self.codec_id})'
+
+
+CODEC_NONE = 0
+CODEC_ZLIB = 1 # zlib level 6, all zlib levels decompress the same way
+CODEC_ZLIB_FAST = 2
+CODEC_ZLIB_BEST = 3
+CODEC_LZMA = 4
+CODEC_ZSTD = 5
+CODEC_LZ4 = 6
+
+CODECS = {
+    CODEC_NONE: Codec(CODEC_NONE, 'none', lambda data: data, lambda data: data),
+    CODEC_ZLIB: Codec(CODEC_ZLIB, 'zlib', lambda data: zlib.compress(data, 6), zlib.decompress),
+    CODEC_ZLIB_FAST: Codec(CODEC_ZLIB_FAST, 'zlib-fast', lambda data: zlib.compress(data, 1), zlib.decompress),
+    CODEC_ZLIB_BEST: Codec(CODEC_ZLIB_BEST, 'zlib-best', lambda data: zlib.compress(data, 9), zlib.decompress),
+    CODEC_LZMA: Codec(CODEC_LZMA, 'lzma', lambda data: lzma.compress(data, preset=6), lzma.decompress),
+}
+if zstandard is not None:
+    # zstd frames written by compress() contain the content size so they can be decompressed without a limit,
+    # compressor objects must not be shared between threads so each thread has its own
+    _zstd_local = threading.local()
+
+    def _zstd_compress(data):
+        compressor = getattr(_zstd_local, 'compressor', None)
+        if compressor is None:
+            compressor = _zstd_local.compressor = zstandard.ZstdCompressor(level=3)
+        return compressor.compress(data)
+
+    CODECS[CODEC_ZSTD] = Codec(CODEC_ZSTD, 'zstd', _zstd_compress, lambda data: zstandard.ZstdDecompressor().decompress(data))
+if lz4_frame is not None:
+    CODECS[CODEC_LZ4] = Codec(CODEC_LZ4, 'lz4', lz4_frame.compress, lz4_frame.decompress)
+
+CODEC_NAMES = {codec.name: codec for codec in CODECS.values()}
+
+
+# file types that are already compressed, lower case with dot as in FileInfo.ext. Not pdf, which often holds
+# uncompressed text streams, the sample decides for those
+INCOMPRESSIBLE_EXTS = {
+    '.jpg', '.jpeg', '.png', '.gif', '.webp', '.heic', '.heif', '.avif', '.jxl',
+    '.mp4', '.m4v', '.mkv', '.mov', '.avi', '.webm', '.wmv', '.flv',
+    '.mp3', '.m4a', '.aac', '.ogg', '.opus', '.flac', '.wma',
+    '.zip', '.gz', '.tgz', '.bz2', '.xz', '.txz', '.zst', '.lz4', '.7z', '.rar', '.cab',
+    '.jar', '.apk', '.docx', '.xlsx', '.pptx', '.odt', '.ods', '.odp', '.epub',
+    '.dmg', '.enc', '.gpg',
+}
+
+SAMPLE_SIZE = 64*1024
+MIN_SAMPLE_RATIO = 0.9 # samples that do not compress below this ratio with fast zlib are stored uncompressed
+
+
+def get_codec(codec_id) -> Codec:
+    if codec_id not in CODECS:
+        raise ValueError(f'Unsupported compression codec: {codec_id} (zstd and lz4 require the zstandard and lz4 packages)')
+    return CODECS[codec_id]
+
+
+def default_codec(compression='auto') -> Codec:
+    if compression == 'auto':
+        return CODECS.get(CODEC_ZSTD, CODECS[CODEC_ZLIB])
+    if compression not in CODEC_NAMES:
+        raise ValueError(f'Unknown or not installed compression codec: {compression}, available: {list(CODEC_NAMES.keys())}')
+    return CODEC_NAMES[compression]
+
+
+def choose_codec(ext, first_chunk, compression='auto') -> Codec:
+    # known compressed formats are not compressed again, otherwise a quick test compress of the beginning
+    codec = default_codec(compression)
+    if codec.codec_id == CODEC_NONE:
+        return codec
+    if ext is not None and ext.lower() in INCOMPRESSIBLE_EXTS:
+        return CODECS[CODEC_NONE]
+    sample = first_chunk[:SAMPLE_SIZE]
+    if len(sample) > 0 and len(zlib.compress(sample, 1)) > MIN_SAMPLE_RATIO * len(sample):
+        return CODECS[CODEC_NONE]
+    return codec
@@ -3,12 +3,29 @@ import base64
 from cryptography.fernet import Fernet
 from cryptography.hazmat.primitives import hashes
 from cryptography.hazmat.primitives.kdf.pbkdf2 import PBKDF2HMAC
+from cryptography.hazmat.primitives.kdf.hkdf import HKDF
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+from cryptography.exceptions import InvalidTag
 import gzip
+import io
 import os
-from multiprocessing import Pool
-from multiprocessing.pool import ThreadPool
+import threading
+import uuid
+from pathlib import Path
 from functools import partial
 
+from .compression import choose_codec, get_codec
+from .file_info import DEFAULT_HASH_ALGO, new_hasher, file_checksum, file_checksum_partial
+from .chunker import iter_chunks
+from .packs import PackedBlob
+from .engine import ExecutionEngine, worker_state, worker_threads
+from .misc import link_or_clone_file
+from .metrics import count, timed
+from .pipeline import AdvisedReader, drop_cache, ordered_map
+from .logger import Logger
+
+logger = Logger()
+
 
 
 def key_from_password_and_salt(password, salt):
@@ -28,95 +45,606 @@ class SrcDstPathPair():
 
 
 
+"""
+Encrypts and restores files in batches on the worker processes of the execution engine. The workers keep their
+Crypto object between tasks and only send back compact results (archive sizes, chunk lists, pack blobs).
+"""
 class ConcurrentEncryptor():
-    def __init__(self, n_procs=None, n_threads_per_proc=None, key=None):
-        self.key = key
-        self.n_procs = max(1, os.cpu_count() // 2 if n_procs is None else n_procs)
-        self.n_threads_per_proc = max(1, 4 if n_threads_per_proc is None else n_threads_per_proc)
+    def __init__(self, engine:ExecutionEngine, batch_files=64):
+        self.engine = engine
+        self.batch_files = batch_files
+
+    def _batches(self, items):
+        return [items[i:i+self.batch_files] for i in range(0, len(items), self.batch_files)]
         
-    def store_files(self, srcdst_path_pairs, key=None, chunk_size=16*1024*1024):
-        key = key or self.key
+    def store_files(self, srcdst_path_pairs, chunk_size=None):
+        # returns the archive size of each file in order, None if it could not be stored
+        results = self.engine.map(partial(_store_files, chunk_size=chunk_size), self._batches(srcdst_path_pairs))
+        return [item for sublist in results for item in sublist]
+
+    def store_chunked_files(self, src_chunkdir_pairs, avg_chunk_size=2*1024*1024):
+        # returns (checksum, chunk checksums, stored size, partial checksum) for each pair in order, None if it could not be stored
+        results = self.engine.map(partial(_store_chunked_files, avg_chunk_size=avg_chunk_size), [[pair] for pair in src_chunkdir_pairs])
+        return [item for sublist in results for item in sublist]
+
+    def encrypt_files(self, src_paths, batch_size=256):
+        # yields the encrypted blob of each file in order (None if it could not be read), for small files that are appended to pack files
+        batches = [src_paths[i:i+batch_size] for i in range(0, len(src_paths), batch_size)]
+        for blobs in self.engine.imap(_encrypt_files, batches):
+            yield from blobs
+
+    def restore_files(self, src_dsts_pairs, hardlink=False):
+        # each archive blob is decoded once into the first destination, the other destinations are copies of that
+        # (reflinks where the filesystem supports it) or hardlinks
+        self.engine.map(partial(_restore_files, hardlink=hardlink), self._batches(src_dsts_pairs))
+
+
+def _worker_crypto():
+    # one Crypto object per worker process, created on first use
+    state = worker_state()
+    if 'crypto' not in state:
+        state['crypto'] = Crypto(state['key'], compression=state.get('compression', 'auto'),
+                                 hash_algo=state.get('hash_algo', DEFAULT_HASH_ALGO),
+                                 chunk_size=state.get('blob_chunk_size', BLOB_CHUNK_SIZE),
+                                 drop_page_cache=state.get('drop_page_cache', False))
+    return state['crypto']
+
+def _store_file(srcdst_path_pair, chunk_size=None):
+    src_path, dst_path = srcdst_path_pair
+    try:
+        os.makedirs(os.path.dirname(dst_path), exist_ok=True)
+        _worker_crypto().store_file(src_path, dst_path, chunk_size=chunk_size)
+        return os.path.getsize(dst_path)
+    except OSError as e:
+        logger.error(f'Could not store file: {src_path} ({e})')
+        return None
+
+def _store_files(srcdst_path_pairs, chunk_size=None):
+    return worker_threads().map(partial(_store_file, chunk_size=chunk_size), srcdst_path_pairs)
+
+def _store_chunked_file(src_chunkdir_pair, avg_chunk_size=2*1024*1024):
+    try:
+        return _worker_crypto().store_chunked_file(src_chunkdir_pair[0], src_chunkdir_pair[1], avg_chunk_size=avg_chunk_size)
+    except OSError as e:
+        logger.error(f'Could not store file: {src_chunkdir_pair[0]} ({e})')
+        return None
+
+def _store_chunked_files(src_chunkdir_pairs, avg_chunk_size=2*1024*1024):
+    return worker_threads().map(partial(_store_chunked_file, avg_chunk_size=avg_chunk_size), src_chunkdir_pairs)
+
+def _encrypt_file(src_path):
+    try:
+        return _worker_crypto().encrypt_file(src_path)
+    except OSError as e:
+        logger.error(f'Could not store file: {src_path} ({e})')
+        return None
+
+def _encrypt_files(src_paths):
+    return worker_threads().map(_encrypt_file, src_paths)
+
+def _ingest_file(src_candidates_pair, tmp_dir, chunk_size=None):
+    try:
+        return _worker_crypto().ingest_file(src_candidates_pair[0], tmp_dir, chunk_size=chunk_size, candidates=src_candidates_pair[1])
+    except OSError as e:
+        logger.error(f'Could not store file: {src_candidates_pair[0]} ({e})')
+        return None
+
+def _ingest_files(src_candidates_pairs, tmp_dir, chunk_size=None):
+    return worker_threads().map(partial(_ingest_file, tmp_dir=tmp_dir, chunk_size=chunk_size), src_candidates_pairs)
+
+def _ingest_small_file(src_candidates_pair):
+    try:
+        return _worker_crypto().ingest_small_file(src_candidates_pair[0], candidates=src_candidates_pair[1])
+    except OSError as e:
+        logger.error(f'Could not store file: {src_candidates_pair[0]} ({e})')
+        return None
+
+def _ingest_small_files(src_candidates_pairs):
+    return worker_threads().map(_ingest_small_file, src_candidates_pairs)
+
+def _ingest_chunked_file(src_candidates_pair, chunk_dir, avg_chunk_size=2*1024*1024):
+    try:
+        return _worker_crypto().ingest_chunked_file(src_candidates_pair[0], chunk_dir, avg_chunk_size=avg_chunk_size,
+                                                    candidates=src_candidates_pair[1])
+    except OSError as e:
+        logger.error(f'Could not store file: {src_candidates_pair[0]} ({e})')
+        return None
+
+def _ingest_chunked_files(src_candidates_pairs, chunk_dir, avg_chunk_size=2*1024*1024):
+    return worker_threads().map(partial(_ingest_chunked_file, chunk_dir=chunk_dir, avg_chunk_size=avg_chunk_size), src_candidates_pairs)
 
-        n_paths = len(srcdst_path_pairs)
-        n_paths_per_proc = n_paths // self.n_procs
-        _srcdst_path_pairs = [srcdst_path_pairs[i*n_paths_per_proc:(i+1)*n_paths_per_proc] for i in range(self.n_procs-1)]
-        _srcdst_path_pairs.append(srcdst_path_pairs[(self.n_procs-1)*n_paths_per_proc:])
+def _restore_file(srcdst_path_pair):
+    crypto = _worker_crypto()
+    with open(srcdst_path_pair[1], 'wb') as fout:
+        crypto.restore_to(srcdst_path_pair[0], fout)
+        if crypto.drop_page_cache:
+            drop_cache(fout, sync=True)
 
+def _restore_file_copies(src_dsts_pair, hardlink=False):
+    src, dst_paths = src_dsts_pair
+    try:
+        _restore_file((src, dst_paths[0]))
+        for dst_path in dst_paths[1:]:
+            link_or_clone_file(dst_paths[0], dst_path, hardlink=hardlink)
+    except (OSError, ValueError, InvalidTag) as e:
+        logger.error(f'Could not restore file: {dst_paths[0]} ({e})')
+        return False
+    return True
 
-        _p_store_files = partial(_store_files, key=key, chunk_size=chunk_size, n_threads=self.n_threads_per_proc)
-        with Pool(self.n_procs) as pool:
-            pool.map(_p_store_files, _srcdst_path_pairs)
+def _restore_files(src_dsts_pairs, hardlink=False):
+    return worker_threads().map(partial(_restore_file_copies, hardlink=hardlink), src_dsts_pairs)
 
-    def restore_files(self, srcdst_path_pairs, key=None):
-        key = key or self.key
+def _verify_entry(item, deep=True):
+    # item is (checksum, src, chunk checksums or None), returns None if ok or the problem
+    checksum, src, chunk_checksums = item
+    crypto = _worker_crypto()
+    try:
+        if deep:
+            crypto.check_content(src, checksum, chunk_checksums)
+        else:
+            for blob_src in (src if isinstance(src, list) else [src]):
+                crypto.check_structure(blob_src)
+    except (OSError, ValueError, InvalidTag) as e:
+        return f'{type(e).__name__}: {e}' if str(e) else type(e).__name__
+    return None
 
-        n_paths = len(srcdst_path_pairs)
-        n_paths_per_proc = n_paths // self.n_procs
-        _srcdst_path_pairs = [srcdst_path_pairs[i*n_paths_per_proc:(i+1)*n_paths_per_proc] for i in range(self.n_procs-1)]
-        _srcdst_path_pairs.append(srcdst_path_pairs[(self.n_procs-1)*n_paths_per_proc:])
+def _verify_entries(items, deep=True):
+    return worker_threads().map(partial(_verify_entry, deep=deep), items)
 
-        _p_restore_files = partial(_restore_files, key=key, n_threads=self.n_threads_per_proc)
-        with Pool(self.n_procs) as pool:
-            pool.map(_p_restore_files, _srcdst_path_pairs)
 
 
-def _store_file(srcdst_path_pair, key, chunk_size=16*1024*1024):
-    crypto = Crypto(key)
-    crypto.store_file(srcdst_path_pair[0], srcdst_path_pair[1], chunk_size=chunk_size)
 
-def _store_files(srcdst_path_pairs, key, chunk_size=16*1024*1024, n_threads=4):
-    _p_store_file = partial(_store_file, key=key, chunk_size=chunk_size)
-    with ThreadPool(n_threads) as pool:
-        pool.map(_p_store_file, srcdst_path_pairs)
 
-def _restore_file(srcdst_path_pair, key):
-    crypto = Crypto(key)
-    crypto.restore_file(srcdst_path_pair[0], srcdst_path_pair[1])
+"""
+Blob format version 3:
+    header: MAGIC (4 bytes) | version (1 byte) | codec (1 byte) | salt (16 bytes)
+    chunks: length (4 byte little endian unsigned integer) | AES-GCM ciphertext with tag
+    trailer: AES-GCM encrypted chunk index | length of the encrypted index (4 byte little endian unsigned integer)
+Each chunk is compressed once with the codec from the header (see compression.py) and then encrypted with a per blob key derived from the key and the salt. 
+The nonce is the chunk index and a flag for the last chunk so chunks can't be reordered or the blob truncated 
+unnoticed. The header is authenticated as associated data.
+The chunk index holds the plain size and the record size (length field and ciphertext) of each chunk, so a reader
+can seek to any position and decrypt only the chunks it needs (see blob_reader.py).
+Version 2 is the same without the trailer, version 1 is the original format: gzip stream of length prefixed 
+fernet tokens of gzip compressed chunks.
+"""
+MAGIC = b'BNJA'
+FORMAT_VERSION = 3
+INDEX_ENTRY = struct.Struct('<II') # plain size, record size
+TRAILER_NONCE = struct.pack('>QI', 2**64 - 1, 2) # never used by a chunk
+SALT_SIZE = 16
+HEADER_SIZE = len(MAGIC) + 2 + SALT_SIZE
+GZIP_MAGIC = b'\x1f\x8b'
+BLOB_CHUNK_SIZE = 4*1024*1024 # default plain size of the chunks of a blob, they are compressed and encrypted in parallel
 
-def _restore_files(srcdst_path_pairs, key, n_threads=4):
-    _p_restore_file = partial(_restore_file, key=key)
-    with ThreadPool(n_threads) as pool:
-        pool.map(_p_restore_file, srcdst_path_pairs)
 
+PARTIAL_SIZE = 256*1024 # chunk size of file_checksum_partial
 
 
+class _HashingWriter():
+    # file object that only calculates the checksum of what is written to it
+    def __init__(self, algo=DEFAULT_HASH_ALGO):
+        self.checksum = new_hasher(algo)
+
+    def write(self, data):
+        self.checksum.update(data)
+        return len(data)
+
+
+class _TeeWriter():
+    def __init__(self, *outs):
+        self.outs = outs
+
+    def write(self, data):
+        for out in self.outs:
+            out.write(data)
+        return len(data)
+
+
+class _HashingReader():
+    # file object wrapper that calculates the checksum of everything read through it,
+    # and the same partial checksum as file_checksum_partial from the data passing by
+    def __init__(self, fin, algo=DEFAULT_HASH_ALGO):
+        self.fin = fin
+        self.checksum = new_hasher(algo)
+        fsize = os.fstat(fin.fileno()).st_size
+        self._partial = None
+        if fsize > 3*PARTIAL_SIZE:
+            self._partial = new_hasher(algo)
+            middle = (fsize - PARTIAL_SIZE)//2
+            self._ranges = [(0, PARTIAL_SIZE), (middle, middle + PARTIAL_SIZE), (fsize - PARTIAL_SIZE, fsize)]
+        self._pos = 0
+
+    def read(self, size=-1):
+        data = self.fin.read(size)
+        self.checksum.update(data)
+        if self._partial is not None:
+            view = memoryview(data)
+            for start, end in self._ranges:
+                lo = max(start, self._pos)
+                hi = min(end, self._pos + len(data))
+                if lo < hi:
+                    self._partial.update(view[lo-self._pos:hi-self._pos])
+        self._pos += len(data)
+        return data
+
+    @property
+    def partial(self) -> str:
+        # small files are read whole by file_checksum_partial
+        return self.checksum.hexdigest() if self._partial is None else self._partial.hexdigest()
+
+
+def write_atomic(dst_path, write, drop_page_cache=False):
+    # the file only appears under its name once it is complete and on disk, write gets the open temporary file
+    tmp_path = Path(f'{dst_path}.{os.getpid()}.{threading.get_ident()}.tmp')
+    try:
+        with open(tmp_path, 'wb') as fout:
+            write(fout)
+            fout.flush()
+            os.fsync(fout.fileno())
+            if drop_page_cache:
+                drop_cache(fout)
+        os.replace(tmp_path, dst_path)
+    except BaseException:
+        if tmp_path.exists():
+            os.remove(tmp_path)
+        raise
+
+
+def _chunk_nonce(index, final):
+    return struct.pack('>QI', index, 1 if final else 0)
+
+
+def chunk_fpath(chunk_dir, chunk_checksum):
+    return Path(chunk_dir) / chunk_checksum[:2] / (chunk_checksum+'.enc')
+
 
 
 class Crypto:    
-    def __init__(self, key):
+    def __init__(self, key, compression='auto', hash_algo=DEFAULT_HASH_ALGO, chunk_size=BLOB_CHUNK_SIZE, drop_page_cache=False):
         self.fernet = Fernet(key)
+        self.master_key = base64.urlsafe_b64decode(key)
+        self.compression = compression # codec name for compressible data or 'auto'
+        self.hash_algo = hash_algo # for the file and chunk checksums
+        self.chunk_size = chunk_size # of the chunks of a blob, see encrypt()
+        self.drop_page_cache = drop_page_cache # drop the files read and the blobs written from the page cache, see pipeline.py
 
-    def store_file(self, src_path, dst_path, chunk_size=16*1024*1024):
+    def _reader(self, fin):
+        return AdvisedReader(fin, drop_cache=self.drop_page_cache)
+
+    def _blob_cipher(self, salt):
+        blob_key = HKDF(algorithm=hashes.SHA256(), length=32, salt=salt, info=b'backup-ninja blob').derive(self.master_key)
+        return AESGCM(blob_key)
+
+    def store_file(self, src_path, dst_path, chunk_size=None):
         with open(src_path, 'rb') as fin:
-            with gzip.open(dst_path, mode='wb') as fout:
-                self.encrypt(fin, fout, chunk_size)
+            # same extension as FileInfo.ext
+            write_atomic(dst_path, lambda fout: self.encrypt(self._reader(fin), fout, chunk_size, ext=Path(src_path).suffix),
+                         drop_page_cache=self.drop_page_cache)
+
+    def encrypt_file(self, src_path, chunk_size=None) -> bytes:
+        out = io.BytesIO()
+        with open(src_path, 'rb') as fin:
+            self.encrypt(fin, out, chunk_size, ext=Path(src_path).suffix)
+        return out.getvalue()
+
+    def hash_if_copy(self, src_path, candidates):
+        # if the partial checksum is one of the candidates (archived files of the same size) the file is
+        # probably a copy and is only hashed, returns (checksum, partial checksum) or None
+        if not candidates:
+            return None
+        partial_checksum = file_checksum_partial(src_path, chunkSize=PARTIAL_SIZE, algo=self.hash_algo)
+        if partial_checksum not in candidates:
+            return None
+        if os.path.getsize(src_path) <= 3*PARTIAL_SIZE:
+            return partial_checksum, partial_checksum
+        return file_checksum(src_path, algo=self.hash_algo), partial_checksum
 
-    def restore_file(self, src_path, dst_path):
-        with gzip.open(src_path, 'rb') as fin:
-            with open(dst_path, 'wb') as fout:
-                self.decrypt(fin, fout)
+    def ingest_file(self, src_path, tmp_dir, chunk_size=None, candidates=None):
+        # checksum, compress and encrypt in one read into a temporary blob that the caller renames 
+        # to its content address or discards, returns (checksum, tmp path, archive size, partial checksum)
+        # with tmp path and archive size None if the file was only hashed
+        copy = self.hash_if_copy(src_path, candidates)
+        if copy is not None:
+            return copy[0], None, None, copy[1]
+        tmp_path = Path(tmp_dir) / f'{uuid.uuid4().hex}.tmp'
+        try:
+            with open(src_path, 'rb') as fin:
+                reader = _HashingReader(self._reader(fin), self.hash_algo)
+                with open(tmp_path, 'wb') as fout:
+                    self.encrypt(reader, fout, chunk_size, ext=Path(src_path).suffix)
+                    fout.flush()
+                    os.fsync(fout.fileno())
+                    if self.drop_page_cache:
+                        drop_cache(fout)
+        except:
+            if tmp_path.exists():
+                os.remove(tmp_path)
+            raise
+        return reader.checksum.hexdigest(), tmp_path, os.path.getsize(tmp_path), reader.partial
 
-    def encrypt(self, in_file_obj, out_file_obj, chunk_size=16*1024*1024):
+    def ingest_small_file(self, src_path, chunk_size=None, candidates=None):
+        # as ingest_file but into memory for pack files, returns (checksum, blob or None, partial checksum)
+        copy = self.hash_if_copy(src_path, candidates)
+        if copy is not None:
+            return copy[0], None, copy[1]
+        out = io.BytesIO()
+        with open(src_path, 'rb') as fin:
+            reader = _HashingReader(self._reader(fin), self.hash_algo)
+            self.encrypt(reader, out, chunk_size, ext=Path(src_path).suffix)
+        return reader.checksum.hexdigest(), out.getvalue(), reader.partial
+
+    def ingest_chunked_file(self, src_path, chunk_dir, avg_chunk_size=2*1024*1024, candidates=None):
+        # as store_chunked_file, returns (checksum, chunk checksums or None, stored size or None, partial checksum)
+        copy = self.hash_if_copy(src_path, candidates)
+        if copy is not None:
+            return copy[0], None, None, copy[1]
+        return self.store_chunked_file(src_path, chunk_dir, avg_chunk_size=avg_chunk_size)
+
+    def restore_to(self, src, out_file_obj):
+        # src as from Archive._archived_src: PackedBlob, list of chunk paths in order, or the blob path
+        if isinstance(src, PackedBlob):
+            # ranged read of a blob inside a pack file
+            with open(src.pack_path, 'rb') as fin:
+                fin.seek(src.offset)
+                blob = fin.read(src.length)
+            if len(blob) < src.length:
+                raise ValueError('Archive blob is truncated')
+            self.decrypt(io.BytesIO(blob), out_file_obj)
+        elif isinstance(src, (list, tuple)):
+            # the chunks are decrypted in parallel and written in order
+            for data in ordered_map(self._decrypt_chunk_file, src):
+                out_file_obj.write(data)
+        else:
+            with open(src, 'rb') as fin:
+                legacy = fin.read(len(GZIP_MAGIC)) == GZIP_MAGIC
+                fin.seek(0)
+                if legacy:
+                    with gzip.open(fin, 'rb') as fin_gz:
+                        self.decrypt_legacy(fin_gz, out_file_obj)
+                else:
+                    self.decrypt(fin, out_file_obj)
+                if self.drop_page_cache:
+                    drop_cache(fin)
+
+    def check_structure(self, src):
+        # cheap check of a single blob (path or PackedBlob) that only reads the header, the chunk index and
+        # the chunk length fields, raises ValueError if the blob is damaged
+        path, start, length = (src.pack_path, src.offset, src.length) if isinstance(src, PackedBlob) else (src, 0, None)
+        with open(path, 'rb') as fin:
+            end = start + length if length is not None else fin.seek(0, os.SEEK_END)
+            fin.seek(start)
+            magic = fin.read(len(MAGIC))
+            if magic[:len(GZIP_MAGIC)] == GZIP_MAGIC:
+                # legacy blob, the chunks are inside the gzip stream
+                return
+            fin.seek(start)
+            version, _, _ = self._open_header(fin.read(HEADER_SIZE))
+            if version == 3:
+                records = [(record_offset, record_size) for _, _, record_offset, record_size in self.read_blob_index(fin, start, end)[3]]
+            else:
+                records = []
+                record_offset = start + HEADER_SIZE
+                while record_offset < end:
+                    fin.seek(record_offset)
+                    length_bytes = fin.read(4)
+                    if len(length_bytes) < 4:
+                        raise ValueError('Archive blob is truncated')
+                    records.append((record_offset, 4 + struct.unpack('<I', length_bytes)[0]))
+                    record_offset += records[-1][1]
+                if record_offset != end or len(records) == 0:
+                    raise ValueError('Archive blob is truncated')
+            for record_offset, record_size in records:
+                fin.seek(record_offset)
+                length_bytes = fin.read(4)
+                if len(length_bytes) < 4 or 4 + struct.unpack('<I', length_bytes)[0] != record_size:
+                    raise ValueError('Chunk length does not match the chunk index')
+
+    def check_content(self, src, checksum, chunk_checksums=None):
+        # decodes the archived content and compares it with its checksum (and the chunks with theirs),
+        # raises ValueError on a mismatch and InvalidTag if a blob was modified
+        content = _HashingWriter(self.hash_algo)
+        if chunk_checksums is not None:
+            if len(chunk_checksums) != len(src):
+                raise ValueError('Chunk list does not match')
+            for chunk_path, chunk_checksum in zip(src, chunk_checksums):
+                chunk = _HashingWriter(self.hash_algo)
+                with open(chunk_path, 'rb') as fin:
+                    self.decrypt(fin, _TeeWriter(content, chunk))
+                if chunk.checksum.hexdigest() != chunk_checksum:
+                    raise ValueError(f'Checksum mismatch for chunk {chunk_checksum}')
+        else:
+            self.restore_to(src, content)
+        if content.checksum.hexdigest() != checksum:
+            raise ValueError('Checksum mismatch')
+
+    def restore_file(self, src_path, dst_path, offset=0, length=None):
+        src = PackedBlob(src_path, offset, length) if length is not None else src_path
+        with open(dst_path, 'wb') as fout:
+            self.restore_to(src, fout)
+
+    def store_chunked_file(self, src_path, chunk_dir, avg_chunk_size=2*1024*1024):
+        # split the file in content defined chunks and store the ones not already in chunk_dir,
+        # returns (file checksum, chunk checksums, stored size, partial checksum) - the file is only read once
+        ext = Path(src_path).suffix
+
+        def store_chunk(chunk):
+            # on the pipeline threads while the file is read and chunked, returns (chunk checksum, stored size)
+            chunk_checksum = new_hasher(self.hash_algo)
+            chunk_checksum.update(chunk)
+            chunk_checksum = chunk_checksum.hexdigest()
+            dst_path = chunk_fpath(chunk_dir, chunk_checksum)
+            if dst_path.exists():
+                return chunk_checksum, 0
+            os.makedirs(dst_path.parent, exist_ok=True)
+            # other workers and threads may store the same chunk, the temporary name is per thread
+            write_atomic(dst_path, lambda fout: self.encrypt(io.BytesIO(chunk), fout, chunk_size=len(chunk) or 1, ext=ext),
+                         drop_page_cache=self.drop_page_cache)
+            return chunk_checksum, dst_path.stat().st_size
+
+        chunk_checksums = []
+        stored_size = 0
+        with open(src_path, 'rb') as fin:
+            reader = _HashingReader(self._reader(fin), self.hash_algo)
+            for chunk_checksum, size in ordered_map(store_chunk, iter_chunks(reader, avg_size=avg_chunk_size)):
+                chunk_checksums.append(chunk_checksum)
+                stored_size += size
+        return reader.checksum.hexdigest(), chunk_checksums, stored_size, reader.partial
+
+    def restore_chunked_file(self, chunk_paths, dst_path):
+        with open(dst_path, 'wb') as fout:
+            self.restore_to(list(chunk_paths), fout)
+
+    def _decrypt_chunk_file(self, chunk_path) -> bytes:
+        out = io.BytesIO()
+        with open(chunk_path, 'rb') as fin:
+            self.decrypt(fin, out)
+            if self.drop_page_cache:
+                drop_cache(fin)
+        return out.getvalue()
+
+    def encrypt(self, in_file_obj, out_file_obj, chunk_size=None, ext=None):
+        # the chunks are read and written in order on this thread and compressed and encrypted in parallel on
+        # the pipeline threads (see pipeline.py), a blob of one chunk is done on this thread
+        chunk_size = chunk_size or self.chunk_size
         # Assert that we can write the chunk size to the file
-        # Each encrypted chunk may be larger than the read one, but not more that 4x
         # (each chunk size is defined by a 4 byte unsigned integer => MAX 2**32 = 4GB)
         if chunk_size > 2**30:
             raise ValueError("Chunck size to large")
         
-        # check the size of the file to be able to report progress
+        with timed('read'):
+            first_chunk = in_file_obj.read(chunk_size)
+        codec = choose_codec(ext, first_chunk, self.compression)
+
+        salt = os.urandom(SALT_SIZE)
+        header = MAGIC + bytes([FORMAT_VERSION, codec.codec_id]) + salt
+        cipher = self._blob_cipher(salt)
+        out_file_obj.write(header)
+
+        def read_chunks():
+            # read one chunk ahead to know which one is the last, an empty file gets one empty chunk
+            index = 0
+            chunk = first_chunk
+            while True:
+                with timed('read'):
+                    next_chunk = in_file_obj.read(chunk_size) if chunk else b''
+                final = not next_chunk
+                yield index, chunk, final
+                if final:
+                    return
+                chunk = next_chunk
+                index += 1
+
+        def seal(item):
+            index, chunk, final = item
+            with timed('compress'):
+                compressed = codec.compress(chunk)
+            with timed('encrypt'):
+                enc = cipher.encrypt(_chunk_nonce(index, final), compressed, header)
+            return len(chunk), enc
+
+        chunk_index = []
+        for plain_size, enc in ordered_map(seal, read_chunks()):
+            with timed('write'):
+                out_file_obj.write(struct.pack('<I', len(enc)))  # little endian unsigned integer
+                out_file_obj.write(enc)
+            count('bytes_read', plain_size)
+            count('bytes_written', 4 + len(enc))
+            chunk_index.append(INDEX_ENTRY.pack(plain_size, 4 + len(enc)))
+
+        trailer = cipher.encrypt(TRAILER_NONCE, b''.join(chunk_index), header)
+        out_file_obj.write(trailer)
+        out_file_obj.write(struct.pack('<I', len(trailer)))
+
+
+    def _open_header(self, header):
+        # returns (version, codec, cipher) for a blob header
+        if len(header) < HEADER_SIZE or header[:len(MAGIC)] != MAGIC:
+            raise ValueError('Not an archive blob')
+        version = header[len(MAGIC)]
+        if version not in (2, 3):
+            raise ValueError(f'Unsupported blob format version: {version}')
+        return version, get_codec(header[len(MAGIC)+1]), self._blob_cipher(header[len(MAGIC)+2:])
+
+
+    def read_blob_index(self, fin, start, end):
+        # reads the header and chunk index of the version 3 blob in fin[start:end], 
+        # returns (header, codec, cipher, [(plain offset, plain size, record offset, record size)])
+        fin.seek(start)
+        header = fin.read(HEADER_SIZE)
+        version, codec, cipher = self._open_header(header)
+        if version != 3:
+            raise ValueError(f'Blob format version {version} has no chunk index')
+        fin.seek(end - 4)
+        trailer_size_bytes = fin.read(4)
+        if len(trailer_size_bytes) < 4:
+            raise ValueError('Archive blob is truncated')
+        trailer_size = struct.unpack('<I', trailer_size_bytes)[0]
+        if start + HEADER_SIZE + trailer_size + 4 > end:
+            raise ValueError('Archive blob is truncated')
+        fin.seek(end - 4 - trailer_size)
+        raw_index = cipher.decrypt(TRAILER_NONCE, fin.read(trailer_size), header)
+
+        chunk_index = []
+        plain_offset = 0
+        record_offset = start + HEADER_SIZE
+        for plain_size, record_size in INDEX_ENTRY.iter_unpack(raw_index):
+            chunk_index.append((plain_offset, plain_size, record_offset, record_size))
+            plain_offset += plain_size
+            record_offset += record_size
+        if record_offset != end - 4 - trailer_size:
+            raise ValueError('Archive blob does not match its chunk index')
+        return header, codec, cipher, chunk_index
+
+
+    def decrypt_chunk(self, header, codec, cipher, record, index, final) -> bytes:
+        # record as in the chunk index: length field and ciphertext
+        if len(record) < 4 or struct.unpack('<I', record[:4])[0] != len(record) - 4:
+            raise ValueError('Archive blob is truncated')
+        return codec.decompress(cipher.decrypt(_chunk_nonce(index, final), record[4:], header))
+
+
+    def decrypt(self, in_file_obj, out_file_obj):
+        # in_file_obj must be seekable and hold the whole blob from its current position
+        start = in_file_obj.tell()
+        header = in_file_obj.read(HEADER_SIZE)
+        version, codec, cipher = self._open_header(header)
+        if version == 3:
+            end = in_file_obj.seek(0, os.SEEK_END)
+            header, codec, cipher, chunk_index = self.read_blob_index(in_file_obj, start, end)
+            in_file_obj.seek(start + HEADER_SIZE)
+
+            def read_records():
+                for index, (_, _, _, record_size) in enumerate(chunk_index):
+                    yield index, in_file_obj.read(record_size)
+
+            def open_record(item):
+                index, record = item
+                return self.decrypt_chunk(header, codec, cipher, record, index, index == len(chunk_index) - 1)
+
+            # decrypted in parallel and written in order as in encrypt()
+            for data in ordered_map(open_record, read_records()):
+                out_file_obj.write(data)
+            return
+
+        # version 2, the end of the blob marks the last chunk
+        index = 0
+        chunk_size_bytes = in_file_obj.read(4)
         while True:
-            chunk = in_file_obj.read(chunk_size)
-            if not chunk:
-                break
-            chunk = gzip.compress(chunk)
-            chunk = self.fernet.encrypt(chunk)
-            out_file_obj.write(struct.pack('<I', len(chunk)))  # little endian unsigned integer
-            out_file_obj.write(chunk)
-            if len(chunk) < chunk_size:
+            if len(chunk_size_bytes) < 4:
+                raise ValueError('Archive blob is truncated')
+            chunkSize = struct.unpack('<I', chunk_size_bytes)[0]
+            chunk = in_file_obj.read(chunkSize)
+            chunk_size_bytes = in_file_obj.read(4)
+            final = not chunk_size_bytes
+            dec = cipher.decrypt(_chunk_nonce(index, final), chunk, header)
+            out_file_obj.write(codec.decompress(dec))
+            if final:
                 break
-            
+            index += 1
 
-    def decrypt(self, in_file_obj, out_file_obj):
+
+    def decrypt_legacy(self, in_file_obj, out_file_obj):
         while True:
             chunk_size_bytes = in_file_obj.read(4)
             if not chunk_size_bytes:
@@ -126,4 +654,3 @@ class Crypto:
             dec = self.fernet.decrypt(chunk)
             dec = gzip.decompress(dec)
             out_file_obj.write(dec)
-        
@@ -0,0 +1,111 @@
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+from pathlib import Path
+
+from .file_info import FileInfo
+from .logger import Logger
+
+logger = Logger()
+
+
+
+def fingerprint(files) -> bytes:
+    # of the files directly in a directory, as (name, size, mtime, ino, dev)
+    hasher = hashlib.blake2b(digest_size=16)
+    for name, size, mtime, ino, dev in sorted(files):
+        hasher.update(f'{name}\0{size}\0{mtime!r}\0{ino}\0{dev}\n'.encode('utf-8', 'surrogateescape'))
+    return hasher.digest()
+
+
+
+"""
+Directory index of the last walk, in table_dir/dir_index.db: per directory its mtime, when it was listed, the
+number of entries (files and subdirectories), a fingerprint of its files (name, size, mtime, inode) and the names
+of its subdirectories. The files themselves are the ones in the archive table.
+A directory whose mtime has not changed since it was listed has the same entries (creating, removing or renaming
+an entry changes the mtime of its directory), so the walk does not list it again but takes its subdirectories from
+the index and its files from the table - if they still match the fingerprint and count, otherwise (e.g. a file that
+could not be stored) the directory is listed. Directories listed within mtime_granularity seconds of their mtime
+are listed again next time, as a change in the same tick would not show in the mtime.
+Files modified in place do not change the mtime of their directory, so only use the index where files are replaced
+rather than rewritten (photos, media, old projects) - or rely on the periodic full backups, which list every
+directory and stat every file.
+"""
+class DirIndex():
+    def __init__(self, table_dir, known_files:dict=None, reuse=True, mtime_granularity=2):
+        self.db_path = Path(table_dir) / 'dir_index.db'
+        self.known_files = known_files or {} # directory : [(name, size, mtime, ino, dev)] of the archive table
+        self.reuse = reuse # False to only record the listings, e.g. in full backups
+        self.mtime_granularity_ns = int(mtime_granularity * 1e9)
+        self.dirs = {} # directory : (mtime_ns, listed_ns, n_entries, fingerprint, subdirs joined by \0)
+        self._listed = {} # rows of the directories listed in this walk
+        self._seen = set()
+        self._lock = threading.Lock()
+        self.n_reused = 0
+        self._load()
+
+    def _connect(self):
+        con = sqlite3.connect(self.db_path)
+        con.execute('CREATE TABLE IF NOT EXISTS dirs (path TEXT PRIMARY KEY, mtime_ns INTEGER NOT NULL, listed_ns INTEGER NOT NULL, '
+                    'n_entries INTEGER NOT NULL, fingerprint BLOB NOT NULL, subdirs TEXT NOT NULL)')
+        return con
+
+    def _load(self):
+        if not self.db_path.exists():
+            return
+        con = self._connect()
+        try:
+            for path, *row in con.execute('SELECT path, mtime_ns, listed_ns, n_entries, fingerprint, subdirs FROM dirs'):
+                self.dirs[path] = tuple(row)
+        finally:
+            con.close()
+
+    def lookup(self, dir_path, dir_stat):
+        # (subdirectory paths, file infos) if the directory is unchanged since it was listed, else None
+        self._seen.add(dir_path)
+        if not self.reuse:
+            return None
+        row = self.dirs.get(dir_path)
+        if row is None:
+            return None
+        mtime_ns, listed_ns, n_entries, fp, subdirs = row
+        if dir_stat.st_mtime_ns != mtime_ns or mtime_ns + self.mtime_granularity_ns >= listed_ns:
+            return None
+        files = self.known_files.get(dir_path, [])
+        subdirs = subdirs.split('\0') if subdirs else []
+        if len(files) + len(subdirs) != n_entries or fingerprint(files) != fp:
+            return None
+        with self._lock:
+            self.n_reused += 1
+        return ([os.path.join(dir_path, name) for name in subdirs],
+                [FileInfo.from_meta(os.path.join(dir_path, name), mtime, size, ino, dev) for name, size, mtime, ino, dev in files])
+
+    def record(self, dir_path, dir_stat, listed_ns, subdir_names, finfos):
+        # a directory listed in this walk
+        files = [(finfo.name, finfo.size, finfo.mtime, finfo.ino, finfo.dev) for finfo in finfos]
+        row = (dir_stat.st_mtime_ns, listed_ns, len(files) + len(subdir_names), fingerprint(files), '\0'.join(subdir_names))
+        with self._lock:
+            self._listed[dir_path] = row
+
+    def store(self):
+        # after a complete walk: the listed directories are updated and the ones not seen anymore dropped
+        t0 = time.time()
+        removed = [(path,) for path in self.dirs if path not in self._seen]
+        con = self._connect()
+        try:
+            with con:
+                con.executemany('DELETE FROM dirs WHERE path = ?', removed)
+                con.executemany('INSERT OR REPLACE INTO dirs (path, mtime_ns, listed_ns, n_entries, fingerprint, subdirs) VALUES (?, ?, ?, ?, ?, ?)',
+                                [(path, *row) for path, row in self._listed.items()])
+        finally:
+            con.close()
+        for (path,) in removed:
+            del self.dirs[path]
+        self.dirs.update(self._listed)
+        logger.info(f'Directory index: reused {self.n_reused} directories, listed {len(self._listed)}, stored in {time.time() - t0:.1f} s.')
+        self._listed = {}
+        self._seen = set()
+        self.n_reused = 0
@@ -0,0 +1,134 @@
+import os
+import queue
+import threading
+from functools import partial
+from multiprocessing import Pool
+from multiprocessing.pool import ThreadPool
+
+from .metrics import Metrics, take_stats
+
+
+# state of a worker process, set once by the pool initializer and kept between tasks (cipher contexts, thread pool)
+_worker_state = {}
+
+
+def _init_worker(state, n_threads):
+    # forked workers start with a copy of the parent's counters, they are counted by the parent already
+    take_stats()
+    _worker_state.update(state)
+    _worker_state['threads'] = ThreadPool(n_threads)
+    # a pipeline pool of the parent has no threads after the fork
+    _worker_state.pop('pipeline_threads', None)
+
+
+def worker_state() -> dict:
+    return _worker_state
+
+
+def _run_task(func, args):
+    # the metrics counted by the task's threads go back with the result
+    result = func(*args)
+    return result, take_stats()
+
+
+def worker_threads() -> ThreadPool:
+    # also works when a task function is called directly in the main process
+    if 'threads' not in _worker_state:
+        _worker_state['threads'] = ThreadPool(4)
+    return _worker_state['threads']
+
+
+def pipeline_threads():
+    # threads for the chunks of one large file (see pipeline.py), apart from worker_threads() whose tasks wait on them,
+    # None if disabled
+    if 'pipeline_threads' not in _worker_state:
+        n_threads = _worker_state.get('n_pipeline_threads', 4)
+        _worker_state['pipeline_threads'] = ThreadPool(n_threads) if n_threads > 0 else None
+    return _worker_state['pipeline_threads']
+
+
+"""
+Long lived pool of worker processes with a thread pool in each, created once per archive run and shared by
+the scan, store and restore phases. Tasks are module level functions working on batches that use worker_state()
+and worker_threads(). The metrics the tasks count (see metrics.py) are merged into engine.metrics.
+"""
+class ExecutionEngine():
+    def __init__(self, key=None, n_procs=None, n_threads_per_proc=None, compression='auto', hash_algo='sha256', metrics:Metrics=None,
+                 blob_chunk_size=16*1024*1024, n_pipeline_threads=4, drop_page_cache=False):
+        self.n_procs = max(1, os.cpu_count() // 2 if n_procs is None else n_procs)
+        self.n_threads_per_proc = max(1, 4 if n_threads_per_proc is None else n_threads_per_proc)
+        self._state = {'key': key, 'compression': compression, 'hash_algo': hash_algo, 'blob_chunk_size': blob_chunk_size,
+                       'n_pipeline_threads': n_pipeline_threads, 'drop_page_cache': drop_page_cache}
+        self._pool = None
+        self.metrics = metrics or Metrics()
+
+    @property
+    def pool(self):
+        if self._pool is None:
+            self._pool = Pool(self.n_procs, initializer=_init_worker, initargs=(self._state, self.n_threads_per_proc))
+        return self._pool
+
+    def _unwrap(self, result_stats):
+        result, stats = result_stats
+        self.metrics.merge(stats)
+        return result
+
+    def map(self, func, batches) -> list:
+        if len(batches) == 0:
+            return []
+        return [self._unwrap(result) for result in self.pool.starmap(_run_task, [(func, (batch,)) for batch in batches])]
+
+    def imap(self, func, batches):
+        for result in self.pool.imap(partial(_run_task, func), [(batch,) for batch in batches]):
+            yield self._unwrap(result)
+
+    def close(self):
+        if self._pool is not None:
+            self._pool.close()
+            self._pool.join()
+            self._pool = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+
+"""
+Bounded queue of tasks submitted to the engine. put() blocks while max_in_flight tasks are running, finished tasks
+are returned as (tag, result, error) by completed() (without blocking) and drain() (waits for all).
+Several queues can share the engine so that e.g. checksum and store tasks overlap.
+"""
+class TaskQueue():
+    def __init__(self, engine:ExecutionEngine, max_in_flight=None):
+        self.engine = engine
+        self._in_flight = threading.BoundedSemaphore(max_in_flight or 2*engine.n_procs)
+        self._done = queue.Queue()
+        self.n_submitted = 0
+        self.n_completed = 0
+
+    def _on_result(self, tag, result):
+        self._done.put((tag, self.engine._unwrap(result), None))
+        self._in_flight.release()
+
+    def _on_error(self, tag, error):
+        self._done.put((tag, None, error))
+        self._in_flight.release()
+
+    def put(self, func, args, tag=None):
+        self._in_flight.acquire()
+        self.engine.pool.apply_async(_run_task, (func, args), callback=lambda result: self._on_result(tag, result),
+                                     error_callback=lambda error: self._on_error(tag, error))
+        self.n_submitted += 1
+
+    def completed(self):
+        while not self._done.empty():
+            self.n_completed += 1
+            yield self._done.get()
+
+    def drain(self):
+        while self.n_completed < self.n_submitted:
+            self.n_completed += 1
+            yield self._done.get()
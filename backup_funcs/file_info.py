@@ -1,22 +1,78 @@
 from pathlib import Path
 import os 
+import mmap
 import hashlib
+import threading
+
+from .metrics import count, timed
+
+# optional, much faster than sha256 on cpus without sha instructions
+try:
+    import blake3
+except ImportError:
+    blake3 = None
+
+
+
+# hash algorithms for the file checksums, the one of an archive is recorded in its table and never changes
+HASH_ALGOS = {
+    'sha256': hashlib.sha256,
+    'blake2b': lambda: hashlib.blake2b(digest_size=32),
+}
+if blake3 is not None:
+    HASH_ALGOS['blake3'] = blake3.blake3
+DEFAULT_HASH_ALGO = 'sha256'
+
+
+def new_hasher(algo=DEFAULT_HASH_ALGO):
+    if algo not in HASH_ALGOS:
+        raise ValueError(f'Hash algorithm not available: {algo} (available: {", ".join(HASH_ALGOS)})')
+    return HASH_ALGOS[algo]()
 
 
 
 
 class FileInfo():
-    def __init__(self, path, calculate_checksum=False):
-        self.path = Path(path)
-        fstat = self.path.stat()
+    # one per scanned file, so kept small: the path as a string and name, ext and Path made on access
+    __slots__ = ('_path', 'mtime', 'size', 'ino', 'dev', 'checksum', 'partial')
+
+    def __init__(self, path, calculate_checksum=False, fstat=None):
+        self._path = os.fspath(path)
+        # stat result can be passed from e.g. os.scandir to avoid a second stat call
+        fstat = fstat or os.stat(self._path)
         
         self.mtime = fstat.st_mtime
         self.size = fstat.st_size
         self.ino = fstat.st_ino
-        self.name = self.path.name
-        self.ext = self.path.suffix
+        self.dev = fstat.st_dev
         
-        self.checksum = file_checksum(self.path) if calculate_checksum else None
+        self.checksum = file_checksum(self._path) if calculate_checksum else None
+        self.partial = None # checksum of the start, middle and end, see file_checksum_partial
+
+    @classmethod
+    def from_meta(cls, path, mtime, size, ino, dev):
+        # without stat, for files known to be unchanged (e.g. from the archive table)
+        finfo = cls.__new__(cls)
+        finfo._path = os.fspath(path)
+        finfo.mtime = mtime
+        finfo.size = size
+        finfo.ino = ino
+        finfo.dev = dev
+        finfo.checksum = None
+        finfo.partial = None
+        return finfo
+
+    @property
+    def path(self) -> Path:
+        return Path(self._path)
+
+    @property
+    def name(self) -> str:
+        return os.path.basename(self._path)
+
+    @property
+    def ext(self) -> str:
+        return Path(self._path).suffix
             
 
     def __repr__(self):
@@ -27,26 +83,53 @@ class FileInfo():
 # ------------------------------------
 
 
-def file_checksum(fpath, chunkSize=1024*1024) -> str:
-    checksum = hashlib.sha256()
-    with open(fpath, 'rb') as f:
+_read_buffers = threading.local() # one reused read buffer per thread
+
+
+def _read_buffer(size) -> memoryview:
+    buf = getattr(_read_buffers, 'buf', None)
+    if buf is None or len(buf) != size:
+        buf = memoryview(bytearray(size))
+        _read_buffers.buf = buf
+    return buf
+
+
+def file_checksum(fpath, chunkSize=1024*1024, algo=DEFAULT_HASH_ALGO, mmap_min_size=16*1024*1024) -> str:
+    checksum = new_hasher(algo)
+    with open(fpath, 'rb') as f, timed('hash'):
+        fsize = os.fstat(f.fileno()).st_size
+        count('bytes_hashed', fsize)
+        if fsize >= mmap_min_size:
+            # large files are hashed straight from the page cache without copying, in slices so
+            # that the hash (which releases the gil) does not fault in the whole file at once
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                view = memoryview(mm)
+                try:
+                    for start in range(0, len(view), 8*chunkSize):
+                        checksum.update(view[start:start+8*chunkSize])
+                finally:
+                    view.release()
+            return checksum.hexdigest()
+
+        buf = _read_buffer(chunkSize)
         while True:
-            data = f.read(chunkSize)
-            if not data:
+            n = f.readinto(buf)
+            if not n:
                 break
-            checksum.update(data)
+            checksum.update(buf[:n])
     return checksum.hexdigest()
 
 
-def file_checksum_partial(fpath, chunkSize=256*1024) -> str:
-    checksum = hashlib.sha256()
+def file_checksum_partial(fpath, chunkSize=256*1024, algo=DEFAULT_HASH_ALGO) -> str:
+    # cheap first pass to tell files of the same size apart, equal to file_checksum for files up to 3*chunkSize
+    checksum = new_hasher(algo)
     fsize = os.path.getsize(fpath)
     with open(fpath, 'rb') as f:
         # read one chunk each at beginning, middle and end of file
         if fsize <= 3*chunkSize:
             data = f.read()
             checksum.update(data)
-            return checksum.digest()
+            return checksum.hexdigest()
         else:
             # chunk at beginning of file
             data = f.read(chunkSize)
@@ -62,4 +145,3 @@ def file_checksum_partial(fpath, chunkSize=256*1024) -> str:
             data = f.read(chunkSize)   
             checksum.update(data)                             
     return checksum.hexdigest()
-
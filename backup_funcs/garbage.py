@@ -0,0 +1,97 @@
+import os
+import time
+from pathlib import Path
+
+from .engine import ExecutionEngine, worker_threads
+
+
+
+"""
+Garbage collection of archive files. The mark phase collects the blobs, chunks and packs that the table entries
+refer to. The sweep phase runs one task per shard directory (the two first characters of the checksum) on the
+worker pool: each task lists its shard once with os.scandir and removes either the given file names (files of
+entries dropped from the table) or every archive file that is not live (orphans, e.g. from a crash or an old bug),
+together with temporary files left behind by interrupted writes. A dry run only sums up what would be removed.
+"""
+def mark(entries) -> tuple[set, set, set]:
+    # checksums of live blobs and chunks, and names of live packs
+    blobs, chunks, packs = set(), set(), set()
+    for entry in entries:
+        if entry.pack is not None:
+            packs.add(entry.pack)
+        elif entry.chunks is not None:
+            chunks.update(entry.chunks)
+        else:
+            blobs.add(entry.checksum)
+    return blobs, chunks, packs
+
+
+def shard_dirs(root) -> list[Path]:
+    # the shard directories of the blobs or chunks under root
+    if not os.path.exists(root):
+        return []
+    with os.scandir(root) as it:
+        return [Path(entry.path) for entry in it if entry.is_dir() and len(entry.name) == 2 and all(c in '0123456789abcdef' for c in entry.name)]
+
+
+def shard_live(shards, live:set) -> list[tuple]:
+    # (shard dir, live checksums in the shard) for sweeping the orphans of each shard
+    shard2live = {}
+    for checksum in live:
+        shard2live.setdefault(checksum[:2], set()).add(checksum)
+    return [(shard, shard2live.get(shard.name, set())) for shard in shards]
+
+
+def _sweep_shard(task) -> tuple:
+    # task is (shard dir, file names to remove or None, live checksums, dry run, min age of temporary files in seconds)
+    # returns (files removed, bytes removed, errors, live files found)
+    shard_dir, names, live, dry_run, min_tmp_age = task
+    n_files, n_bytes, n_errs, n_found = 0, 0, 0, 0
+    now = time.time()
+    try:
+        it = os.scandir(shard_dir)
+    except FileNotFoundError:
+        return n_files, n_bytes, n_errs, n_found
+    with it:
+        for entry in it:
+            try:
+                if not entry.is_file():
+                    continue
+                if names is not None:
+                    if entry.name not in names:
+                        continue
+                elif entry.name.endswith('.enc'):
+                    if entry.name[:-len('.enc')] in live:
+                        n_found += 1
+                        continue
+                elif entry.name.endswith('.tmp'):
+                    # may belong to a backup that is running right now
+                    if now - entry.stat().st_mtime < min_tmp_age:
+                        continue
+                else:
+                    continue
+                size = entry.stat().st_size
+                if not dry_run:
+                    os.remove(entry.path)
+                n_files += 1
+                n_bytes += size
+            except FileNotFoundError:
+                continue
+            except OSError:
+                n_errs += 1
+    return n_files, n_bytes, n_errs, n_found
+
+
+def _sweep_shards(tasks) -> list[tuple]:
+    return worker_threads().map(_sweep_shard, tasks)
+
+
+def sweep(engine:ExecutionEngine, tasks:list[tuple]) -> tuple:
+    # runs the shard tasks on the worker pool, returns the summed (files removed, bytes removed, errors, live files found)
+    n_batches = 4*engine.n_procs
+    batches = [tasks[i::n_batches] for i in range(n_batches) if len(tasks[i::n_batches]) > 0]
+    totals = [0, 0, 0, 0]
+    for results in engine.map(_sweep_shards, batches):
+        for result in results:
+            totals = [total + value for total, value in zip(totals, result)]
+    return tuple(totals)
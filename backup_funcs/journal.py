@@ -0,0 +1,50 @@
+import json
+import os
+from pathlib import Path
+
+from .models import ArchiveEntry, ArchiveEntryModel
+
+
+
+"""
+Write-ahead journal of the archive files stored during a backup run, as json lines in the table dir. A record is
+appended (and fsync'd) once its archive file is durable, the journal is cleared when the archive table is stored.
+If a run is interrupted the next run replays the journal into the table, so the stored files are not stored again.
+"""
+class Journal():
+    def __init__(self, table_dir):
+        self.journal_path = Path(table_dir) / 'journal.jsonl'
+        self._fout = None
+
+    def append(self, entries:list[ArchiveEntry]):
+        if len(entries) == 0:
+            return
+        if self._fout is None:
+            self._fout = open(self.journal_path, 'a')
+        for entry in entries:
+            self._fout.write(entry.to_model().model_dump_json() + '\n')
+        self._fout.flush()
+        os.fsync(self._fout.fileno())
+
+    def replay(self) -> list[ArchiveEntry]:
+        if not self.journal_path.exists():
+            return []
+        entries = []
+        with open(self.journal_path) as fin:
+            for line in fin:
+                try:
+                    entries.append(ArchiveEntry.from_model(ArchiveEntryModel.model_validate_json(line)))
+                except ValueError:
+                    # last line cut off by the crash
+                    break
+        return entries
+
+    def clear(self):
+        self.close()
+        if self.journal_path.exists():
+            os.remove(self.journal_path)
+
+    def close(self):
+        if self._fout is not None:
+            self._fout.close()
+            self._fout = None
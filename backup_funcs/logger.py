@@ -1,13 +1,17 @@
 import datetime as dt
+import sys
 
 
 class Logger():
+    # set to True when stdout is used for data, e.g. a restore stream
+    to_stderr = False
+
     def __init__(self):
         pass
     
     def _log(self, level, msg):
         timestamp = dt.datetime.now().astimezone().isoformat()
-        print(f'{level} {timestamp}: {msg}')
+        print(f'{level} {timestamp}: {msg}', file=sys.stderr if Logger.to_stderr else sys.stdout)
 
     def info(self, msg):
         self._log('INFO', msg)
@@ -0,0 +1,181 @@
+import cProfile
+import datetime as dt
+import json
+import os
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager
+from pathlib import Path
+
+from .logger import Logger
+from .misc import pretty_size, pretty_time
+
+logger = Logger()
+
+
+# counters of the threads of this process, each thread only adds to its own dict so counting needs no lock
+_local = threading.local()
+_thread_stats = [] # [(stats, taken so far)] of all threads that counted something
+_thread_stats_lock = threading.Lock()
+
+
+def _stats() -> dict:
+    stats = getattr(_local, 'stats', None)
+    if stats is None:
+        stats = _local.stats = {}
+        with _thread_stats_lock:
+            _thread_stats.append((stats, {}))
+    return stats
+
+
+def count(name, value=1):
+    # add to a counter of the calling thread, timers are counters in seconds named <phase>_seconds
+    stats = _stats()
+    stats[name] = stats.get(name, 0) + value
+
+
+class timed():
+    # with timed('compress'): ... adds the time spent to compress_seconds of the calling thread
+    def __init__(self, phase):
+        self.name = phase + '_seconds'
+
+    def __enter__(self):
+        self.t0 = time.perf_counter()
+        return self
+
+    def __exit__(self, *args):
+        count(self.name, time.perf_counter() - self.t0)
+
+
+def take_stats() -> dict:
+    # what the threads of this process counted since the last call, summed
+    total = {}
+    with _thread_stats_lock:
+        for stats, taken in _thread_stats:
+            current = stats.copy()
+            for name, value in current.items():
+                delta = value - taken.get(name, 0)
+                if delta:
+                    total[name] = total.get(name, 0) + delta
+            taken.update(current)
+    return total
+
+
+
+"""
+Metrics of a run: counters (bytes_read, bytes_written, bytes_hashed, files_skipped_meta, dedup_hits, ...) and timers
+in seconds. <phase>_seconds is the time summed over all threads doing it (walk, stat, hash, read, compress, encrypt,
+write), so it can be more than the wall time, and <phase>_wall_seconds the wall time of a phase of the run (scan,
+update, table_save). Worker processes count into their own per thread stats, which the engine sends back with each
+task result and merges here (see engine._run_task). A phase can be profiled with cProfile and tracemalloc (in this
+process), the profiles are written to profile_dir. Progress with an estimated time left is logged every
+progress_interval seconds while a backup runs.
+"""
+class Metrics():
+    def __init__(self, profile_phases=None, profile_dir=None, progress_interval=None):
+        self.values = {}
+        self.profile_phases = set(profile_phases or []) # phase names, or 'all'
+        self.profile_dir = Path(profile_dir) if profile_dir is not None else Path('.')
+        self.progress_interval = progress_interval
+        self._lock = threading.Lock() # the task callbacks and the progress thread both merge
+        self._profiling = False
+        self._progress_stop = None
+
+    def merge(self, stats:dict):
+        with self._lock:
+            for name, value in stats.items():
+                self.values[name] = self.values.get(name, 0) + value
+
+    def collect(self) -> dict:
+        # adds what the threads of this process counted, the workers' stats are merged when their tasks finish
+        self.merge(take_stats())
+        return dict(self.values)
+
+    @contextmanager
+    def phase(self, name):
+        # wall time of a phase, profiled if asked for (not nested, the outermost profiled phase wins)
+        profile = not self._profiling and (name in self.profile_phases or 'all' in self.profile_phases)
+        if profile:
+            self._profiling = True
+            started_tracing = not tracemalloc.is_tracing()
+            if started_tracing:
+                tracemalloc.start()
+            tracemalloc.reset_peak()
+            profiler = cProfile.Profile()
+            profiler.enable()
+        t0 = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.merge({f'{name}_wall_seconds': time.perf_counter() - t0})
+            if profile:
+                profiler.disable()
+                self.merge({f'{name}_peak_traced_bytes': tracemalloc.get_traced_memory()[1]})
+                snapshot = tracemalloc.take_snapshot()
+                if started_tracing:
+                    tracemalloc.stop()
+                self._profiling = False
+                self._write_profile(name, profiler, snapshot)
+
+    def _write_profile(self, name, profiler, snapshot, n_top=30):
+        os.makedirs(self.profile_dir, exist_ok=True)
+        prefix = self.profile_dir / f'{name}-{dt.datetime.now().strftime("%Y%m%dT%H%M%S")}'
+        profiler.dump_stats(f'{prefix}.prof')
+        with open(f'{prefix}.tracemalloc.txt', 'w') as fout:
+            for stat in snapshot.statistics('lineno')[:n_top]:
+                fout.write(f'{stat}\n')
+        logger.info(f'Profile of {name} written to {prefix}.prof (cProfile) and {prefix}.tracemalloc.txt')
+
+    def start_progress(self):
+        if self.progress_interval is None or self._progress_stop is not None:
+            return
+        self._progress_stop = threading.Event()
+        t0 = time.perf_counter()
+
+        def reporter(stop):
+            while not stop.wait(self.progress_interval):
+                self._log_progress(time.perf_counter() - t0)
+
+        threading.Thread(target=reporter, args=(self._progress_stop,), daemon=True).start()
+
+    def stop_progress(self):
+        if self._progress_stop is not None:
+            self._progress_stop.set()
+            self._progress_stop = None
+
+    def _log_progress(self, elapsed):
+        values = self.collect()
+        n_done = values.get('bytes_read', 0) + values.get('bytes_hashed', 0)
+        # files with unchanged metadata are not read, the walk may still find more so the estimate can grow
+        n_todo = values.get('bytes_found', 0) - values.get('bytes_skipped_meta', 0) - n_done
+        rate = n_done / elapsed if elapsed > 0 else 0
+        eta = f', about {pretty_time(n_todo / rate)} left' if rate > 0 and n_todo > 0 else ''
+        logger.info(f"Progress: found {values.get('files_found', 0)} files ({pretty_size(values.get('bytes_found', 0))}), "
+                    f"read {pretty_size(n_done)} at {pretty_size(rate)}/s, wrote {pretty_size(values.get('bytes_written', 0))}{eta}.")
+
+    def log_summary(self):
+        values = self.collect()
+        timers = ', '.join(f'{name[:-len("_seconds")]} {pretty_time(value)}' for name, value in sorted(values.items()) if name.endswith('_seconds'))
+        logger.info(f'Time per phase: {timers}.')
+
+    def write_json_lines(self, path, **info):
+        # one json object per run, appended
+        record = {'timestamp': dt.datetime.now().astimezone().isoformat(), **info, **self.collect()}
+        with open(path, 'a') as fout:
+            fout.write(json.dumps(record) + '\n')
+
+    def write_prometheus(self, path, **labels):
+        # textfile for the node_exporter textfile collector, replaced atomically so it is never read half written
+        label_str = ','.join(f'{key}="{value}"' for key, value in labels.items())
+        label_str = '{' + label_str + '}' if label_str else ''
+        values = {**self.collect(), 'last_run_timestamp_seconds': time.time()}
+        lines = []
+        for name, value in sorted(values.items()):
+            metric = f'backup_ninja_{name}'
+            lines.append(f'# TYPE {metric} gauge')
+            lines.append(f'{metric}{label_str} {value}')
+        tmp_path = f'{path}.{os.getpid()}.tmp'
+        with open(tmp_path, 'w') as fout:
+            fout.write('\n'.join(lines) + '\n')
+        os.replace(tmp_path, path)
@@ -1,5 +1,15 @@
+import os
+import shutil
 import numpy as np
 
+# posix only, used for reflinks
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+FICLONE = 0x40049409 # linux ioctl to share the data blocks of a file (btrfs, xfs, ...)
+
 
 def pretty_size(size_bytes:int):
     if size_bytes == 0:
@@ -21,3 +31,44 @@ def pretty_time(seconds:float):
     else:
         return f'{seconds/60/60/24:.2f} d'
 
+
+
+def clone_file(src_path, dst_path):
+    # copy a file as cheap as the filesystem allows: reflink, then in kernel copy_file_range, then a plain copy
+    with open(src_path, 'rb') as fin, open(dst_path, 'wb') as fout:
+        if fcntl is not None:
+            try:
+                fcntl.ioctl(fout.fileno(), FICLONE, fin.fileno())
+                return
+            except OSError:
+                pass
+        if hasattr(os, 'copy_file_range'):
+            try:
+                remaining = os.fstat(fin.fileno()).st_size
+                while remaining > 0:
+                    n = os.copy_file_range(fin.fileno(), fout.fileno(), remaining)
+                    if n == 0:
+                        break
+                    remaining -= n
+                if remaining == 0:
+                    return
+            except OSError:
+                pass
+            # start over with a plain copy
+            fin.seek(0)
+            fout.seek(0)
+            fout.truncate()
+        shutil.copyfileobj(fin, fout, 1024*1024)
+
+
+def link_or_clone_file(src_path, dst_path, hardlink=False):
+    if hardlink:
+        try:
+            if os.path.lexists(dst_path):
+                os.remove(dst_path)
+            os.link(src_path, dst_path)
+            return
+        except OSError:
+            # e.g. not supported by the filesystem, fall back to a copy
+            pass
+    clone_file(src_path, dst_path)
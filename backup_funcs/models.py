@@ -0,0 +1,227 @@
+from pathlib import Path
+from enum import Enum
+import datetime as dt
+import sys
+from typing import Optional
+from pydantic import BaseModel
+
+
+
+"""
+Event of the current state of a file, i.e. regarding checksum. A modified file will create one ADDED and one REMOVED event since a new state appears.
+"""
+class BlobEvent(Enum):
+    ADDED = 1 # added to path, can be part of creation, move or copy
+    REMOVED = 2 # removed from path, can be part of move, modification or deletion
+
+
+_EVENT_NAMES = {event.value: event.name for event in BlobEvent}
+_EVENT_CODES = {event.name: event.value for event in BlobEvent}
+_TIMEZONES = {} # utc offset in minutes : timezone
+
+
+
+# ------------------------------------ json schema, for the json table and the journal
+
+
+class ArchiveLogEventModel(BaseModel):
+    timestamp:str
+    event:str
+    path:Optional[str]
+
+
+class ArchiveFilePointerModel(BaseModel):
+    path:str
+    ino:int
+    mtime:float
+    size:int
+    dev:int = 0 # not stored in older tables, such pointers will never match on metadata
+
+
+class ArchiveEntryModel(BaseModel):
+    checksum:str
+    fptrs:list[ArchiveFilePointerModel]
+    log:list[ArchiveLogEventModel]
+    arch_size:int
+    chunks:Optional[list[str]] = None
+    pack:Optional[str] = None
+    pack_offset:int = 0
+    size:Optional[int] = None
+    partial:Optional[str] = None
+
+
+
+# ------------------------------------ in memory
+
+
+"""
+The archive table is kept in memory as compact records with __slots__ instead of pydantic models, for archives
+with millions of files. Paths are split in an interned parent directory (shared by all files in it) and a name,
+events keep the time as a float and the event as a small int, and chunk lists are packed 32 byte digests.
+The attributes read as before (path, timestamp, event and chunks as strings), converting on access.
+Pydantic models are only used at the json boundary, see to_model() and from_model().
+"""
+_last_split = (None, (None, None)) # the file pointer and events of an entry mostly have the same path
+
+def _split_path(path):
+    global _last_split
+    if path is None:
+        return None, None
+    last_path, split = _last_split
+    if path == last_path:
+        return split
+    head, sep, name = path.rpartition('/')
+    split = (sys.intern(head) if sep else None), name
+    _last_split = (path, split)
+    return split
+
+
+def _join_path(head, name):
+    if name is None:
+        return None
+    return name if head is None else head + '/' + name
+
+
+def _timezone(offset_minutes):
+    tz = _TIMEZONES.get(offset_minutes)
+    if tz is None:
+        tz = _TIMEZONES[offset_minutes] = dt.timezone(dt.timedelta(minutes=offset_minutes))
+    return tz
+
+
+class ArchiveLogEvent():
+    __slots__ = ('time', 'tz', 'code', '_dir', '_name')
+
+    def __init__(self, time:float, tz:int, code:int, path:Optional[str]):
+        self.time = time # posix timestamp
+        self.tz = tz # utc offset in minutes where the event was logged
+        self.code = code # BlobEvent value
+        self._dir, self._name = _split_path(path)
+
+    @classmethod
+    def from_event(cls, event:BlobEvent, path:str):
+        now = dt.datetime.now().astimezone()
+        return cls(now.timestamp(), int(now.utcoffset().total_seconds()) // 60, event.value, Path(path).as_posix() if path is not None else None)
+
+    @classmethod
+    def from_timestamp(cls, timestamp:str, event:str, path:Optional[str]):
+        time = dt.datetime.fromisoformat(timestamp)
+        if time.tzinfo is None:
+            time = time.astimezone()
+        return cls(time.timestamp(), int(time.utcoffset().total_seconds()) // 60, _EVENT_CODES[event], path)
+
+    @property
+    def path(self) -> Optional[str]:
+        return _join_path(self._dir, self._name)
+
+    @property
+    def event(self) -> str:
+        return _EVENT_NAMES[self.code]
+
+    @property
+    def datetime(self) -> dt.datetime:
+        return dt.datetime.fromtimestamp(self.time, _timezone(self.tz))
+
+    @property
+    def timestamp(self) -> str:
+        return self.datetime.isoformat()
+
+    def to_row(self) -> list:
+        return [self.time, self.tz, self.code, self.path]
+
+    @classmethod
+    def from_row(cls, row):
+        # [time, tz, code, path], or a dict with an iso timestamp from tables before the compact format
+        if isinstance(row, dict):
+            return cls.from_timestamp(row['timestamp'], row['event'], row['path'])
+        return cls(*row)
+
+
+class ArchiveFilePointer():
+    __slots__ = ('_dir', '_name', 'ino', 'mtime', 'size', 'dev')
+
+    def __init__(self, path:str, ino:int, mtime:float, size:int, dev:int=0):
+        self._dir, self._name = _split_path(path)
+        self.ino = ino
+        self.mtime = mtime
+        self.size = size
+        self.dev = dev # 0 in older tables, such pointers will never match on metadata
+
+    @property
+    def path(self) -> str:
+        return _join_path(self._dir, self._name)
+
+    @property
+    def parent(self) -> Optional[str]:
+        # the directory as posix string, None for a bare file name
+        return self._dir
+
+    @property
+    def name(self) -> str:
+        return self._name
+
+    def __eq__(self, other):
+        if not isinstance(other, ArchiveFilePointer):
+            return NotImplemented
+        return (self._name, self._dir, self.ino, self.mtime, self.size, self.dev) == (other._name, other._dir, other.ino, other.mtime, other.size, other.dev)
+
+    def __repr__(self):
+        return f'ArchiveFilePointer({self.path}, ino={self.ino}, mtime={self.mtime}, size={self.size}, dev={self.dev})'
+
+
+class ArchiveEntry():
+    __slots__ = ('checksum', 'fptrs', 'log', 'arch_size', '_chunks', 'pack', 'pack_offset', 'size', 'partial')
+
+    def __init__(self, checksum:str, fptrs:list, log:list, arch_size:int, chunks:Optional[list[str]]=None, pack:Optional[str]=None,
+                 pack_offset:int=0, size:Optional[int]=None, partial:Optional[str]=None):
+        self.checksum = checksum
+        self.fptrs = fptrs
+        self.log = log
+        self.arch_size = arch_size
+        self.chunks = chunks # checksums of the content defined chunks for large files, None if stored as one blob
+        self.pack = pack # pack file name for small files appended to a pack file, arch_size bytes from pack_offset
+        self.pack_offset = pack_offset
+        self.size = size # size of the file content, None for entries from before it was recorded
+        self.partial = partial # partial checksum (start, middle and end) to find copies of the file without reading it all
+
+    @classmethod
+    def from_checksum(cls, checksum):
+        return cls(checksum=checksum, fptrs=[], log=[], arch_size=0)
+
+    @property
+    def chunks(self) -> Optional[list[str]]:
+        chunks = self._chunks
+        if chunks is None or isinstance(chunks, list):
+            return chunks
+        return [chunks[i:i+32].hex() for i in range(0, len(chunks), 32)]
+
+    @chunks.setter
+    def chunks(self, chunks:Optional[list[str]]):
+        if chunks is not None and all(len(chunk) == 64 for chunk in chunks):
+            chunks = b''.join(bytes.fromhex(chunk) for chunk in chunks)
+        self._chunks = chunks
+
+    def data(self) -> dict:
+        # the fields besides checksum, arch_size and file pointers, with compact events, for the sqlite table
+        return {'log': [event.to_row() for event in self.log], 'chunks': self.chunks, 'pack': self.pack,
+                'pack_offset': self.pack_offset, 'size': self.size, 'partial': self.partial}
+
+    @classmethod
+    def from_data(cls, checksum, arch_size, fptrs, data:dict):
+        log = [ArchiveLogEvent.from_row(row) for row in data.pop('log', [])]
+        return cls(checksum=checksum, fptrs=fptrs, log=log, arch_size=arch_size, **data)
+
+    def to_model(self) -> ArchiveEntryModel:
+        return ArchiveEntryModel(
+            checksum=self.checksum, arch_size=self.arch_size, chunks=self.chunks, pack=self.pack, pack_offset=self.pack_offset,
+            size=self.size, partial=self.partial,
+            fptrs=[ArchiveFilePointerModel(path=fptr.path, ino=fptr.ino, mtime=fptr.mtime, size=fptr.size, dev=fptr.dev) for fptr in self.fptrs],
+            log=[ArchiveLogEventModel(timestamp=event.timestamp, event=event.event, path=event.path) for event in self.log])
+
+    @classmethod
+    def from_model(cls, model:ArchiveEntryModel):
+        return cls(
+            checksum=model.checksum, arch_size=model.arch_size, chunks=model.chunks, pack=model.pack, pack_offset=model.pack_offset,
+            size=model.size, partial=model.partial,
+            fptrs=[ArchiveFilePointer(path=fptr.path, ino=fptr.ino, mtime=fptr.mtime, size=fptr.size, dev=fptr.dev) for fptr in model.fptrs],
+            log=[ArchiveLogEvent.from_timestamp(event.timestamp, event.event, event.path) for event in model.log])
@@ -0,0 +1,71 @@
+from pathlib import Path
+from collections import namedtuple
+import os
+import uuid
+
+
+"""
+Pack files hold many small archive blobs appended after each other. A pack is never modified after it is written,
+space from removed blobs is reclaimed by repacking the live blobs into new packs.
+The pack index (checksum -> pack, offset, length) is kept in the archive table entries.
+"""
+PackedBlob = namedtuple('PackedBlob', ['pack_path', 'offset', 'length'])
+
+
+def pack_fpath(pack_dir, pack_name):
+    return Path(pack_dir) / pack_name
+
+
+def list_packs(pack_dir) -> dict:
+    # pack name : size
+    if not os.path.exists(pack_dir):
+        return {}
+    with os.scandir(pack_dir) as it:
+        return {entry.name: entry.stat().st_size for entry in it if entry.is_file() and entry.name.endswith('.pack')}
+
+
+
+class PackWriter():
+    def __init__(self, pack_dir, max_pack_size=128*1024*1024):
+        self.pack_dir = Path(pack_dir)
+        self.max_pack_size = max_pack_size
+        self.pack_name = None
+        self._fout = None
+        self._size = 0
+        self.written_packs = []
+
+    def _new_pack(self):
+        self.close()
+        os.makedirs(self.pack_dir, exist_ok=True)
+        self.pack_name = f'pack-{uuid.uuid4().hex}.pack'
+        self._fout = open(pack_fpath(self.pack_dir, self.pack_name), 'wb')
+        self._size = 0
+        self.written_packs.append(self.pack_name)
+
+    def add(self, blob:bytes):
+        # returns (pack name, offset, length)
+        if self._fout is None or (self._size > 0 and self._size + len(blob) > self.max_pack_size):
+            self._new_pack()
+        offset = self._size
+        self._fout.write(blob)
+        self._size += len(blob)
+        return self.pack_name, offset, len(blob)
+
+    def sync(self):
+        # make the blobs added so far durable
+        if self._fout is not None:
+            self._fout.flush()
+            os.fsync(self._fout.fileno())
+
+    def close(self):
+        if self._fout is not None:
+            self._fout.flush()
+            os.fsync(self._fout.fileno())
+            self._fout.close()
+            self._fout = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
@@ -0,0 +1,102 @@
+import os
+import threading
+from collections import deque
+
+from .engine import pipeline_threads, worker_state
+
+
+# page cache hints, posix_fadvise is not available on macos and windows where they are skipped
+_fadvise = getattr(os, 'posix_fadvise', None)
+_local = threading.local()
+
+
+def _fileno(file_obj):
+    try:
+        return file_obj.fileno()
+    except (AttributeError, OSError, ValueError):
+        # e.g. BytesIO
+        return None
+
+
+def advise(file_obj, advice_name, offset=0, length=0):
+    # advice_name as in the os module, e.g. 'POSIX_FADV_SEQUENTIAL', length 0 for the rest of the file
+    fd = _fileno(file_obj)
+    if _fadvise is None or fd is None:
+        return
+    try:
+        _fadvise(fd, offset, length, getattr(os, advice_name))
+    except OSError:
+        pass
+
+
+def drop_cache(file_obj, sync=False):
+    # drops the pages of a file that was read or written once (a backup source or archive blob) from the page cache,
+    # dirty pages are only dropped once they are on disk, so written files are synced first
+    if _fadvise is None or _fileno(file_obj) is None:
+        return
+    if sync:
+        file_obj.flush()
+        os.fdatasync(file_obj.fileno())
+    advise(file_obj, 'POSIX_FADV_DONTNEED')
+
+
+
+"""
+Input file read from start to end in blocks: the kernel is told to read ahead aggressively and to start reading the
+next block while the current one is processed, and with drop_cache the blocks that were read are dropped from the
+page cache again so that a backup does not push out the pages of everything else.
+"""
+class AdvisedReader():
+    def __init__(self, fin, drop_cache=False):
+        self.fin = fin
+        self.drop_cache = drop_cache
+        self._pos = fin.tell()
+        advise(fin, 'POSIX_FADV_SEQUENTIAL')
+
+    def read(self, size=-1):
+        start = self._pos
+        data = self.fin.read(size)
+        self._pos += len(data)
+        if size is not None and size > 0 and len(data) == size:
+            advise(self.fin, 'POSIX_FADV_WILLNEED', self._pos, size)
+        if self.drop_cache and len(data) > 0:
+            advise(self.fin, 'POSIX_FADV_DONTNEED', start, len(data))
+        return data
+
+    def fileno(self):
+        return self.fin.fileno()
+
+
+
+def _run(func, item):
+    _local.in_pipeline = True
+    return func(item)
+
+
+def ordered_map(func, items, max_ahead=None):
+    # func(item) on the pipeline threads with at most max_ahead items in flight, the results are yielded in order.
+    # items is consumed on the calling thread and the caller writes the results, so reading, the work on the chunks
+    # (compression, encryption and hashing release the gil) and writing overlap. A single item, or items of a
+    # pipeline thread itself, are done on the calling thread.
+    pool = pipeline_threads()
+    items = iter(items)
+    first = next(items, None)
+    if first is None:
+        return
+    second = next(items, None)
+    if pool is None or second is None or getattr(_local, 'in_pipeline', False):
+        yield func(first)
+        if second is not None:
+            yield func(second)
+            for item in items:
+                yield func(item)
+        return
+
+    max_ahead = max(2, max_ahead or worker_state().get('n_pipeline_threads', 4) + 1)
+    pending = deque([pool.apply_async(_run, (func, first)), pool.apply_async(_run, (func, second))])
+    for item in items:
+        pending.append(pool.apply_async(_run, (func, item)))
+        if len(pending) >= max_ahead:
+            yield pending.popleft().get()
+    while pending:
+        yield pending.popleft().get()
@@ -0,0 +1,79 @@
+from .models import ArchiveEntry
+
+
+
+"""
+Retention policy for the archive history, like the forget policies of restic and borg. The versions of each path are
+sorted newest first and the policy keeps:
+    keep_last   the n latest versions
+    hourly      the latest version in each of the n latest hours with a version
+    daily, weekly, monthly, yearly  likewise per day, iso week, month and year
+n = -1 keeps one version in every bucket. A version of a path is a history entry that was at the path, timed by its
+last logged event there (normally when it was replaced or removed). An entry is kept if any of its paths keeps it.
+"""
+BUCKETS = {
+    'hourly': lambda ts: (ts.year, ts.month, ts.day, ts.hour),
+    'daily': lambda ts: (ts.year, ts.month, ts.day),
+    'weekly': lambda ts: ts.isocalendar()[:2],
+    'monthly': lambda ts: (ts.year, ts.month),
+    'yearly': lambda ts: ts.year,
+}
+
+
+class RetentionPolicy():
+    def __init__(self, keep_last=0, hourly=0, daily=0, weekly=0, monthly=0, yearly=0):
+        self.keep_last = keep_last
+        self.buckets = {'hourly': hourly, 'daily': daily, 'weekly': weekly, 'monthly': monthly, 'yearly': yearly}
+
+    @classmethod
+    def from_config(cls, config:dict):
+        unknown = set(config) - {'keep_last'} - set(BUCKETS)
+        if unknown:
+            raise ValueError(f'Unknown retention keys: {sorted(unknown)}')
+        return cls(**config)
+
+    def __repr__(self):
+        rules = {'keep_last': self.keep_last, **self.buckets}
+        return ', '.join(f'{name}={n}' for name, n in rules.items() if n != 0) or 'nothing'
+
+    def keep_versions(self, versions:list) -> set:
+        # versions as (timestamp, checksum), returns the checksums to keep
+        versions = sorted(versions, reverse=True)
+        keep = set()
+        if self.keep_last < 0:
+            keep.update(checksum for _, checksum in versions)
+        else:
+            keep.update(checksum for _, checksum in versions[:self.keep_last])
+        for name, n in self.buckets.items():
+            if n == 0:
+                continue
+            bucket_of = BUCKETS[name]
+            last_bucket = None
+            n_buckets = 0
+            # newest first, so the first version in each bucket is the latest one
+            for ts, checksum in versions:
+                bucket = bucket_of(ts)
+                if bucket == last_bucket:
+                    continue
+                last_bucket = bucket
+                keep.add(checksum)
+                n_buckets += 1
+                if n_buckets == n:
+                    break
+        return keep
+
+    def select(self, history:dict[str, ArchiveEntry]) -> set:
+        # checksums of the history entries to keep
+        path_versions = {} # path : {checksum : last timestamp}
+        for checksum, entry in history.items():
+            for event in entry.log:
+                if event.path is None:
+                    continue
+                ts = event.datetime.astimezone()
+                versions = path_versions.setdefault(event.path, {})
+                if checksum not in versions or versions[checksum] < ts:
+                    versions[checksum] = ts
+        keep = set()
+        for versions in path_versions.values():
+            keep.update(self.keep_versions([(ts, checksum) for checksum, ts in versions.items()]))
+        return keep
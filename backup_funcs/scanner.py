@@ -1,51 +1,201 @@
 import os
-from multiprocessing import Pool
-from multiprocessing.pool import ThreadPool
-from .file_info import FileInfo
-from functools import partial
+import queue
+import threading
+import time
+from .file_info import FileInfo, file_checksum, DEFAULT_HASH_ALGO
+from .engine import ExecutionEngine, TaskQueue, worker_state, worker_threads
+from .metrics import count, timed
+from .logger import Logger
 
+logger = Logger()
 
+_DONE = None # end of stream marker in the queues
 
+
+
+"""
+Scans directory trees with parallel os.scandir walkers (reusing the DirEntry stat results) that stream the
+files through a bounded queue. Checksums are calculated by the engine's worker processes on batches of about
+equal size in bytes that are handed out as workers get free, so a few large files don't hold up the others.
+With a dir_index (see dir_index.py) directories that are unchanged since the last walk are not listed again.
+"""
 class Scanner():
-    def __init__(self, n_procs=None, n_threads_per_proc=None):
-        self.n_procs = max(1, os.cpu_count() // 2 if n_procs is None else n_procs)
-        self.n_threads_per_proc = max(1, 4 if n_threads_per_proc is None else n_threads_per_proc)
+    def __init__(self, engine:ExecutionEngine=None, n_walkers=8, batch_bytes=64*1024*1024, batch_files=1024, queue_size=10000, dir_index=None):
+        self.engine = engine or ExecutionEngine()
+        self.dir_index = dir_index
+        self.n_walkers = max(1, n_walkers)
+        self.batch_bytes = batch_bytes
+        self.batch_files = batch_files
+        self.queue_size = queue_size
         self.files = []
 
 
     def scan_directory_tree(self, root_path, with_checksum=True):
-        fpaths = []
-        for root,_,files in os.walk(root_path):
-            fpaths.extend([os.path.join(root, file) for file in files])
-        
-        file_entries = self.create_file_entries(fpaths, with_checksum=with_checksum)
-        self.files.extend(file_entries)
+        self.files.extend(self.iter_directory_tree(root_path, with_checksum=with_checksum))
 
 
-    def create_file_entries(self, fpaths, with_checksum=True):
+    def iter_directory_tree(self, root_path, with_checksum=True):
+        # yields the file infos as they are scanned (and checksummed), they are not added to self.files
+        finfos = self._walk(root_path)
+        if with_checksum:
+            finfos = self.iter_with_checksums(finfos)
+        yield from finfos
+
+
+    def calculate_checksums(self, finfos) -> list[FileInfo]:
+        # sets the checksum of the given file infos, files that could not be read are left out
+        return list(self.iter_with_checksums(iter(finfos)))
+
 
-        n_paths = len(fpaths)
-        n_paths_per_proc = n_paths // self.n_procs
-        jagged_fpaths = [fpaths[i*n_paths_per_proc:(i+1)*n_paths_per_proc] for i in range(self.n_procs-1)]
-        jagged_fpaths.append(fpaths[(self.n_procs-1)*n_paths_per_proc:])
-        
-        
-        _p_create_file_entries = partial(_create_file_entries, n_threads=self.n_threads_per_proc, with_checksum=with_checksum)
+    def create_file_entries(self, fpaths, with_checksum=True):
         finfos = []
-        with Pool(self.n_procs) as pool:
-            finfos = pool.map(_p_create_file_entries, jagged_fpaths)
-        # flatten list of lists
-        finfos = [item for sublist in finfos for item in sublist]
+        for fpath in fpaths:
+            try:
+                finfos.append(FileInfo(fpath))
+            except OSError as e:
+                logger.warning(f'Could not stat file, skipping: {fpath} ({e})')
+        if with_checksum:
+            finfos = self.calculate_checksums(finfos)
         return finfos
-        
 
 
-def _create_file_entry(path, with_checksum=True):
-    return FileInfo(path, calculate_checksum=with_checksum)
+    def _walk(self, root_path):
+        # yields FileInfo for all files under root_path, symlinks to directories are not followed (as os.walk)
+        dir_queue = queue.Queue()
+        file_queue = queue.Queue(maxsize=self.queue_size)
+        # set when the consumer stops, also early (an exception or the generator is closed), so that the walkers
+        # do not block on the full file queue forever
+        stop = threading.Event()
+
+        def put(item) -> bool:
+            while not stop.is_set():
+                try:
+                    file_queue.put(item, timeout=0.1)
+                    return True
+                except queue.Full:
+                    pass
+            return False
+
+        def walker():
+            while True:
+                dir_path = dir_queue.get()
+                if dir_path is _DONE:
+                    break
+                try:
+                    if stop.is_set():
+                        continue
+                    if self.dir_index is not None:
+                        dir_stat = os.stat(dir_path)
+                        listed_ns = time.time_ns()
+                        cached = self.dir_index.lookup(dir_path, dir_stat)
+                        if cached is not None:
+                            subdir_paths, finfos = cached
+                            for subdir_path in subdir_paths:
+                                dir_queue.put(subdir_path)
+                            for finfo in finfos:
+                                count('files_found')
+                                count('bytes_found', finfo.size)
+                                if not put(finfo):
+                                    break
+                            continue
+                        subdir_names, listed = [], []
+                    with os.scandir(dir_path) as it, timed('walk'):
+                        for entry in it:
+                            try:
+                                if entry.is_dir(follow_symlinks=False):
+                                    dir_queue.put(entry.path)
+                                    if self.dir_index is not None:
+                                        subdir_names.append(entry.name)
+                                elif not entry.is_dir():
+                                    with timed('stat'):
+                                        fstat = entry.stat()
+                                    count('files_found')
+                                    count('bytes_found', fstat.st_size)
+                                    finfo = FileInfo(entry.path, fstat=fstat)
+                                    if self.dir_index is not None:
+                                        listed.append(finfo)
+                                    if not put(finfo):
+                                        break
+                            except OSError as e:
+                                logger.warning(f'Could not stat file, skipping: {entry.path} ({e})')
+                    # a listing cut short by the consumer stopping is not recorded
+                    if self.dir_index is not None and not stop.is_set():
+                        self.dir_index.record(dir_path, dir_stat, listed_ns, subdir_names, listed)
+                except OSError as e:
+                    logger.warning(f'Could not list directory, skipping: {dir_path} ({e})')
+                finally:
+                    dir_queue.task_done()
+
+        def coordinator():
+            dir_queue.join()
+            for _ in walkers:
+                dir_queue.put(_DONE)
+            put(_DONE)
+
+        dir_queue.put(os.fspath(root_path))
+        walkers = [threading.Thread(target=walker, daemon=True) for _ in range(self.n_walkers)]
+        threads = walkers + [threading.Thread(target=coordinator, daemon=True)]
+        for thread in threads:
+            thread.start()
+
+        try:
+            while True:
+                finfo = file_queue.get()
+                if finfo is _DONE:
+                    break
+                yield finfo
+        finally:
+            stop.set()
+            for thread in threads:
+                thread.join()
+
+
+    def _batches(self, finfos):
+        # batches of about batch_bytes (or batch_files for many small files), a large file is a batch of its own
+        batch = []
+        batch_size = 0
+        for finfo in finfos:
+            batch.append(finfo)
+            batch_size += finfo.size
+            if batch_size >= self.batch_bytes or len(batch) >= self.batch_files:
+                yield batch
+                batch = []
+                batch_size = 0
+        if len(batch) > 0:
+            yield batch
+
+
+    def iter_with_checksums(self, finfos):
+        # yields the file infos with checksum as the batches are done, files that could not be read are left out
+        tasks = TaskQueue(self.engine)
+
+        def handle(batch, checksums, error):
+            if error is not None:
+                logger.error(f'Checksum calculation failed for {len(batch)} files: {error}')
+                return
+            for finfo, checksum in zip(batch, checksums):
+                if checksum is None:
+                    logger.warning(f'Could not read file, skipping: {finfo.path}')
+                    continue
+                finfo.checksum = checksum
+                yield finfo
+
+        for batch in self._batches(finfos):
+            # at most 2 batches per process are in flight so the walk does not pile up in memory
+            tasks.put(_calculate_checksums, ([finfo.path for finfo in batch],), tag=batch)
+            for done in tasks.completed():
+                yield from handle(*done)
+        for done in tasks.drain():
+            yield from handle(*done)
+
+
+
+def _calculate_checksum(path):
+    try:
+        return file_checksum(path, algo=worker_state().get('hash_algo', DEFAULT_HASH_ALGO))
+    except OSError:
+        return None
 
-def _create_file_entries(paths, n_threads=4, with_checksum=True):
-    entries = []
-    _p_create_file_entry = partial(_create_file_entry, with_checksum=with_checksum)
-    with ThreadPool(n_threads) as pool:
-        entries.extend(pool.map(_p_create_file_entry, paths))
-    return entries
\ No newline at end of file
+def _calculate_checksums(paths):
+    # only the checksums are sent back, the parent keeps the file infos
+    return worker_threads().map(_calculate_checksum, paths)
@@ -0,0 +1,288 @@
+from abc import ABC, abstractmethod
+import json
+import os
+import shutil
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+from .logger import Logger
+from .misc import pretty_size
+
+# optional, for s3 compatible object storage
+try:
+    import boto3
+    from boto3.s3.transfer import TransferConfig
+    from botocore.config import Config as BotoConfig
+except ImportError:
+    boto3 = None
+
+logger = Logger()
+
+
+
+class RateLimiter():
+    # paces the bytes of all threads sharing it to rate bytes per second
+    def __init__(self, rate):
+        self.rate = rate
+        self._next = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self, n_bytes):
+        with self._lock:
+            now = time.monotonic()
+            start = max(now, self._next)
+            self._next = start + n_bytes / self.rate
+        if start > now:
+            time.sleep(start - now)
+
+
+class _ThrottledReader():
+    def __init__(self, fin, limiter:RateLimiter, block_size=1024*1024):
+        self.fin = fin
+        self.limiter = limiter
+        self.block_size = block_size
+
+    def read(self, size=-1):
+        if size is None or size < 0 or size > self.block_size:
+            size = self.block_size
+        data = self.fin.read(size)
+        self.limiter.acquire(len(data))
+        return data
+
+    def seek(self, *args):
+        return self.fin.seek(*args)
+
+    def tell(self):
+        return self.fin.tell()
+
+
+
+"""
+Remote storage of the archive files, addressed by their path relative to file_dir (e.g. "ab/<checksum>.enc",
+"chunks/ab/<checksum>.enc", "packs/pack-<id>.pack"). Implementations are thread safe, the uploads and downloads of
+the archive run on a thread pool.
+"""
+class Storage(ABC):
+    @abstractmethod
+    def list(self) -> dict:
+        # key : size of all stored files
+        pass
+
+    @abstractmethod
+    def upload(self, local_path, key):
+        pass
+
+    @abstractmethod
+    def download(self, key, local_path):
+        pass
+
+    @abstractmethod
+    def delete(self, keys:list):
+        pass
+
+
+
+"""
+A directory used as remote, e.g. a mounted NAS or usb disk. Also the stand-in for object storage when testing.
+"""
+class LocalStorage(Storage):
+    def __init__(self, root, rate_limiter:RateLimiter=None):
+        self.root = Path(root)
+        self.rate_limiter = rate_limiter
+
+    def list(self):
+        files = {}
+        for dir_path, _, fnames in os.walk(self.root):
+            for fname in fnames:
+                if fname.endswith('.tmp'):
+                    continue
+                fpath = os.path.join(dir_path, fname)
+                files[Path(os.path.relpath(fpath, self.root)).as_posix()] = os.path.getsize(fpath)
+        return files
+
+    def upload(self, local_path, key):
+        dst_path = self.root / key
+        os.makedirs(dst_path.parent, exist_ok=True)
+        tmp_path = Path(f'{dst_path}.{os.getpid()}.{threading.get_ident()}.tmp')
+        with open(local_path, 'rb') as fin, open(tmp_path, 'wb') as fout:
+            shutil.copyfileobj(_ThrottledReader(fin, self.rate_limiter) if self.rate_limiter else fin, fout)
+        os.replace(tmp_path, dst_path)
+
+    def download(self, key, local_path):
+        shutil.copyfile(self.root / key, local_path)
+
+    def delete(self, keys):
+        for key in keys:
+            try:
+                os.remove(self.root / key)
+            except FileNotFoundError:
+                pass
+
+
+
+"""
+S3 compatible object storage (aws, minio, backblaze b2, wasabi, ...), needs the boto3 package. One client with a
+connection pool shared by all threads, files larger than multipart_chunk_size are uploaded and downloaded in parts
+by max_concurrency threads each. Credentials are taken from the config or the usual aws environment / files.
+"""
+class S3Storage(Storage):
+    def __init__(self, bucket, prefix='', endpoint_url=None, region=None, access_key=None, secret_key=None, max_concurrency=8,
+                 multipart_chunk_size=64*1024*1024, max_pool_connections=32, rate_limiter:RateLimiter=None):
+        if boto3 is None:
+            raise RuntimeError('S3 storage needs the boto3 package')
+        self.bucket = bucket
+        self.prefix = prefix.strip('/') + '/' if prefix.strip('/') else ''
+        self.rate_limiter = rate_limiter
+        self.client = boto3.client('s3', endpoint_url=endpoint_url, region_name=region, aws_access_key_id=access_key,
+                                   aws_secret_access_key=secret_key, config=BotoConfig(max_pool_connections=max_pool_connections))
+        self.transfer_config = TransferConfig(multipart_threshold=multipart_chunk_size, multipart_chunksize=multipart_chunk_size,
+                                              max_concurrency=max_concurrency, use_threads=True)
+
+    def list(self):
+        files = {}
+        paginator = self.client.get_paginator('list_objects_v2')
+        for page in paginator.paginate(Bucket=self.bucket, Prefix=self.prefix):
+            for obj in page.get('Contents', []):
+                files[obj['Key'][len(self.prefix):]] = obj['Size']
+        return files
+
+    def upload(self, local_path, key):
+        with open(local_path, 'rb') as fin:
+            reader = _ThrottledReader(fin, self.rate_limiter) if self.rate_limiter else fin
+            self.client.upload_fileobj(reader, self.bucket, self.prefix + key, Config=self.transfer_config)
+
+    def download(self, key, local_path):
+        self.client.download_file(self.bucket, self.prefix + key, os.fspath(local_path), Config=self.transfer_config)
+
+    def delete(self, keys):
+        keys = list(keys)
+        # at most 1000 keys per request
+        for i in range(0, len(keys), 1000):
+            objects = [{'Key': self.prefix + key} for key in keys[i:i+1000]]
+            self.client.delete_objects(Bucket=self.bucket, Delete={'Objects': objects, 'Quiet': True})
+
+
+
+"""
+Remote copy of the archive files. The listing of the storage (key : size) is cached in the table dir so that
+existence checks need no round trip, it is updated by the uploads and deletes of this archive and can be refreshed
+with a full listing (e.g. by gc). Uploads and downloads run on n_threads threads.
+"""
+class Remote():
+    def __init__(self, storage:Storage, listing_path, n_threads=4):
+        self.storage = storage
+        self.listing_path = Path(listing_path)
+        self.n_threads = n_threads
+        self.files = None
+        self._lock = threading.Lock()
+
+    def _listing(self) -> dict:
+        if self.files is None:
+            if self.listing_path.exists():
+                with open(self.listing_path) as fin:
+                    self.files = json.load(fin)
+            else:
+                self.refresh()
+        return self.files
+
+    def refresh(self):
+        logger.info('Listing remote storage...')
+        self.files = self.storage.list()
+        self._save()
+
+    def _save(self):
+        tmp_path = self.listing_path.with_suffix('.tmp')
+        with open(tmp_path, 'w') as fout:
+            json.dump(self.files, fout)
+        os.replace(tmp_path, self.listing_path)
+
+    def size(self, key):
+        # size of the remote file, None if not stored
+        return self._listing().get(key)
+
+    def __contains__(self, key):
+        return key in self._listing()
+
+    def files_under(self, prefix) -> dict:
+        # key : size of the files whose key starts with prefix
+        return {key: size for key, size in self._listing().items() if key.startswith(prefix)}
+
+    def upload(self, items) -> list:
+        # uploads [(local path, key)] in parallel, returns the keys that failed
+        files = self._listing()
+        failed = []
+        n_bytes = 0
+
+        def upload(item):
+            local_path, key = item
+            try:
+                size = os.path.getsize(local_path)
+                self.storage.upload(local_path, key)
+            except Exception as e:
+                logger.warning(f'Could not upload {key}: {e}')
+                return key, None
+            return key, size
+
+        if len(items) == 0:
+            return failed
+        logger.info(f'Uploading {len(items)} archive files...')
+        t0 = time.time()
+        with ThreadPoolExecutor(self.n_threads) as pool:
+            for key, size in pool.map(upload, items):
+                if size is None:
+                    failed.append(key)
+                    continue
+                with self._lock:
+                    files[key] = size
+                n_bytes += size
+        self._save()
+        logger.info(f'Uploaded {len(items) - len(failed)} archive files ({pretty_size(n_bytes)}) in {time.time() - t0:.1f} s, {len(failed)} failed.')
+        return failed
+
+    def download(self, items) -> list:
+        # downloads [(key, local path)] in parallel, returns the keys that failed
+        def download(item):
+            key, local_path = item
+            try:
+                os.makedirs(os.path.dirname(local_path), exist_ok=True)
+                tmp_path = f'{local_path}.{threading.get_ident()}.tmp'
+                self.storage.download(key, tmp_path)
+                os.replace(tmp_path, local_path)
+            except Exception as e:
+                logger.warning(f'Could not download {key}: {e}')
+                return key
+            return None
+
+        if len(items) == 0:
+            return []
+        with ThreadPoolExecutor(self.n_threads) as pool:
+            return [key for key in pool.map(download, items) if key is not None]
+
+    def delete(self, keys):
+        files = self._listing()
+        keys = [key for key in keys if key in files]
+        if len(keys) == 0:
+            return
+        self.storage.delete(keys)
+        for key in keys:
+            files.pop(key, None)
+        self._save()
+
+
+
+def open_remote(config:dict, listing_path, rate_limit=None, n_threads=4) -> Remote:
+    # config as in the "remote" entry of the config file, {"type": "local", "path": ...} or {"type": "s3", "bucket": ..., ...}
+    config = dict(config)
+    storage_type = config.pop('type')
+    rate_limiter = RateLimiter(rate_limit) if rate_limit else None
+    if storage_type == 'local':
+        storage = LocalStorage(Path(os.path.expandvars(config['path'])).expanduser(), rate_limiter=rate_limiter)
+    elif storage_type == 's3':
+        if 'multipart_chunk_mb' in config:
+            config['multipart_chunk_size'] = config.pop('multipart_chunk_mb')*1024*1024
+        storage = S3Storage(rate_limiter=rate_limiter, **config)
+    else:
+        raise ValueError(f'Unknown remote storage type: {storage_type}')
+    return Remote(storage, listing_path, n_threads=n_threads)
@@ -0,0 +1,200 @@
+import os
+
+from .engine import ExecutionEngine, TaskQueue
+from .crypto import _store_files, _store_chunked_files, _encrypt_files, _ingest_files, _ingest_small_files, _ingest_chunked_files
+from .packs import PackWriter
+from .models import BlobEvent, ArchiveLogEvent, ArchiveFilePointer, ArchiveEntry
+from .metrics import count
+from .logger import Logger
+
+logger = Logger()
+
+
+"""
+Stores new archive files on the engine while the caller keeps going, e.g. with scanning or calculating checksums of
+other files. Files are batched per kind: large files are split in chunks, small files are encrypted in the workers
+and appended to a pack file here and the rest are stored as one blob file each.
+add() stores a file with a known checksum. ingest() takes a file with unknown checksum that is checksummed,
+compressed and encrypted in the same read. The result is committed to its content address, or discarded if
+is_known(checksum) or the content was already stored in this run. If the partial checksum of an ingested file is
+one of the given candidates it is only hashed, and stored with a second read if it is not known after all.
+Stored files of known path are appended to the journal (if given) once they are durable, see journal.py.
+drain() waits for the tasks in flight and returns the ingested file infos (with checksum set), finish() also
+closes the pack file and returns checksum : (arch_size, chunks, pack, pack_offset), None if it failed.
+"""
+class StoreQueue():
+    def __init__(self, engine:ExecutionEngine, archived_fpath, chunk_dir, pack_dir, tmp_dir, is_known=None, pack_size=128*1024*1024,
+                 chunking_min_size=16*1024*1024, pack_max_file_size=1024*1024, batch_bytes=256*1024*1024, batch_files=256, journal=None):
+        self.tasks = TaskQueue(engine)
+        self.archived_fpath = archived_fpath
+        self.chunk_dir = chunk_dir
+        self.tmp_dir = tmp_dir
+        self.is_known = is_known or (lambda checksum: False)
+        self.pack_writer = PackWriter(pack_dir, pack_size)
+        self.chunking_min_size = chunking_min_size
+        self.pack_max_file_size = pack_max_file_size
+        self.batch_bytes = batch_bytes
+        self.batch_files = batch_files
+        self.results = {}
+        self.ingested = []
+        self.journal = journal
+        self._journal_entries = [] # entries of the results handled last, journaled together
+        self._finfos = {} # checksum : file info, for files that are stored after they were ingested
+        self._queued = set()
+        # (mode, kind) : [(checksum or file info, src_path, size, partial checksum candidates)]
+        self._pending = {(mode, kind): [] for mode in ('store', 'ingest') for kind in ('file', 'pack')}
+        self._pending_size = {key: 0 for key in self._pending}
+
+    def __contains__(self, checksum):
+        return checksum in self._queued
+
+    def __len__(self):
+        return len(self._queued)
+
+    def _kind(self, size):
+        if self.chunking_min_size is not None and size >= self.chunking_min_size:
+            return 'chunks'
+        if self.pack_max_file_size is not None and size <= self.pack_max_file_size:
+            return 'pack'
+        return 'file'
+
+    def _queue(self, mode, key, src_path, size, candidates=None):
+        kind = self._kind(size)
+        if kind == 'chunks' and mode == 'ingest':
+            self.tasks.put(_ingest_chunked_files, ([(src_path, candidates)], self.chunk_dir), tag=(mode, kind, [key]))
+        elif kind == 'chunks':
+            self.tasks.put(_store_chunked_files, ([(src_path, self.chunk_dir)],), tag=(mode, kind, [key]))
+        else:
+            self._pending[(mode, kind)].append((key, src_path, size, candidates))
+            self._pending_size[(mode, kind)] += size
+            if self._pending_size[(mode, kind)] >= self.batch_bytes or len(self._pending[(mode, kind)]) >= self.batch_files:
+                self._submit(mode, kind)
+        for done in self.tasks.completed():
+            self._handle(*done)
+
+    def add(self, checksum, src_path, size):
+        if checksum in self._queued:
+            return
+        self._queued.add(checksum)
+        self._queue('store', checksum, src_path, size)
+
+    def ingest(self, finfo, candidates=None):
+        self._queue('ingest', finfo, finfo.path.as_posix(), finfo.size, candidates)
+
+    def _submit(self, mode, kind):
+        batch = self._pending[(mode, kind)]
+        if len(batch) == 0:
+            return
+        self._pending[(mode, kind)] = []
+        self._pending_size[(mode, kind)] = 0
+        keys = [key for key, _, _, _ in batch]
+        src_paths = [src_path for _, src_path, _, _ in batch]
+        src_candidates_pairs = [(src_path, candidates) for _, src_path, _, candidates in batch]
+        if mode == 'ingest' and kind == 'pack':
+            self.tasks.put(_ingest_small_files, (src_candidates_pairs,), tag=(mode, kind, keys))
+        elif mode == 'ingest':
+            os.makedirs(self.tmp_dir, exist_ok=True)
+            self.tasks.put(_ingest_files, (src_candidates_pairs, self.tmp_dir), tag=(mode, kind, keys))
+        elif kind == 'pack':
+            self.tasks.put(_encrypt_files, (src_paths,), tag=(mode, kind, keys))
+        else:
+            srcdst_path_pairs = [(src_path, self.archived_fpath(checksum)) for checksum, src_path in zip(keys, src_paths)]
+            self.tasks.put(_store_files, (srcdst_path_pairs,), tag=(mode, kind, keys))
+
+    def _handle(self, tag, results, error):
+        mode, kind, keys = tag
+        if error is not None:
+            logger.error(f'Storing {len(keys)} files failed: {error}')
+            results = [None]*len(keys)
+        for key, result in zip(keys, results):
+            if mode == 'store':
+                self._handle_stored(key, kind, result)
+            else:
+                self._handle_ingested(key, kind, result)
+        self._write_journal()
+
+    def _journal_entry(self, finfo, checksum):
+        if self.journal is None or finfo is None or self.results.get(checksum) is None:
+            return
+        entry = ArchiveEntry.from_checksum(checksum)
+        entry.arch_size, entry.chunks, entry.pack, entry.pack_offset = self.results[checksum]
+        entry.fptrs.append(ArchiveFilePointer(path=finfo.path.as_posix(), ino=finfo.ino, mtime=finfo.mtime, size=finfo.size, dev=finfo.dev))
+        entry.log.append(ArchiveLogEvent.from_event(BlobEvent.ADDED, finfo.path))
+        entry.size = finfo.size
+        entry.partial = finfo.partial
+        self._journal_entries.append(entry)
+
+    def _write_journal(self):
+        if len(self._journal_entries) == 0:
+            return
+        if any([entry.pack is not None for entry in self._journal_entries]):
+            # packed blobs are only durable once the pack file is synced
+            self.pack_writer.sync()
+        self.journal.append(self._journal_entries)
+        self._journal_entries = []
+
+    def _handle_stored(self, checksum, kind, result):
+        if result is None:
+            self.results[checksum] = None
+        elif kind == 'chunks':
+            _, chunks, stored_size, _ = result
+            self.results[checksum] = (stored_size, chunks, None, 0)
+        elif kind == 'pack':
+            pack, pack_offset, arch_size = self.pack_writer.add(result)
+            self.results[checksum] = (arch_size, None, pack, pack_offset)
+        else:
+            self.results[checksum] = (result, None, None, 0)
+        self._journal_entry(self._finfos.pop(checksum, None), checksum)
+
+    def _handle_ingested(self, finfo, kind, result):
+        if result is None:
+            logger.warning(f'Could not read file, skipping: {finfo.path}')
+            return
+        checksum = result[0]
+        finfo.checksum = checksum
+        finfo.partial = result[-1]
+        self.ingested.append(finfo)
+        hashed_only = result[1] is None
+        # queued or stored in this run, unless storing it failed
+        in_run = checksum in self._queued and (checksum not in self.results or self.results[checksum] is not None)
+        if self.is_known(checksum) or in_run:
+            # same content as an archived file, the chunks of a chunked file are shared anyway
+            count('dedup_hits')
+            if kind == 'file' and not hashed_only:
+                os.remove(result[1])
+            return
+        if hashed_only:
+            # the partial checksum matched but the content is new
+            self._finfos[checksum] = finfo
+            self.add(checksum, finfo.path.as_posix(), finfo.size)
+            return
+        self._queued.add(checksum)
+        if kind == 'chunks':
+            _, chunks, stored_size, _ = result
+            self.results[checksum] = (stored_size, chunks, None, 0)
+        elif kind == 'pack':
+            pack, pack_offset, arch_size = self.pack_writer.add(result[1])
+            self.results[checksum] = (arch_size, None, pack, pack_offset)
+        else:
+            _, tmp_path, arch_size, _ = result
+            arch_path = self.archived_fpath(checksum)
+            os.makedirs(os.path.dirname(arch_path), exist_ok=True)
+            os.replace(tmp_path, arch_path)
+            self.results[checksum] = (arch_size, None, None, 0)
+        self._journal_entry(finfo, checksum)
+
+    def drain(self) -> list:
+        # handling results can queue more files (see _handle_ingested)
+        while True:
+            for mode, kind in self._pending:
+                self._submit(mode, kind)
+            if self.tasks.n_completed == self.tasks.n_submitted:
+                break
+            for done in self.tasks.drain():
+                self._handle(*done)
+        return self.ingested
+
+    def finish(self) -> dict:
+        self.drain()
+        self.pack_writer.close()
+        return self.results
@@ -0,0 +1,205 @@
+from abc import ABC, abstractmethod
+from pathlib import Path
+from typing import Optional
+import json
+import shutil
+import sqlite3
+
+from .models import ArchiveEntry, ArchiveEntryModel, ArchiveFilePointer
+from .logger import Logger
+
+logger = Logger()
+
+
+"""
+Storage of the archive table. A backend loads all entries as (active, history, meta) where meta holds the
+json serializable fields of the archive (backup roots, backup state etc.) and stores them again.
+`changed` is the set of checksums that have been added, modified or removed since the last store,
+None means that everything shall be written.
+"""
+class ArchiveTable(ABC):
+    @abstractmethod
+    def exists(self) -> bool:
+        pass
+
+    @abstractmethod
+    def load(self) -> Optional[tuple[list[ArchiveEntry], list[ArchiveEntry], dict]]:
+        pass
+
+    @abstractmethod
+    def store(self, active:dict, history:dict, meta:dict, changed:Optional[set]=None):
+        pass
+
+
+
+"""
+The original format, everything in one json file that is rewritten on each store
+"""
+class JsonArchiveTable(ArchiveTable):
+    def __init__(self, table_dir):
+        self.archive_path = Path(table_dir) / 'archive.json'
+        self.backup_path = Path(table_dir) / 'archive.json.bak'
+        self.failed_path = Path(table_dir) / 'archive.json.failed'
+
+    def exists(self) -> bool:
+        return self.archive_path.exists()
+
+    def load(self):
+        if not self.archive_path.exists():
+            return None
+
+        with open(self.archive_path, 'r') as fin:
+            archive = json.load(fin)
+
+        if not ('active' in archive and 'history' in archive and 'backup_roots' in archive):
+            return None
+
+        active = [ArchiveEntry.from_model(ArchiveEntryModel(**entry)) for entry in archive.pop('active')]
+        history = [ArchiveEntry.from_model(ArchiveEntryModel(**entry)) for entry in archive.pop('history')]
+        return active, history, archive
+
+
+    def store(self, active, history, meta, changed=None):
+        # checksum is in the entry so no need to store it twice
+        f_table = {
+            'active':  [entry.to_model().model_dump() for entry in active.values()],
+            'history': [entry.to_model().model_dump() for entry in history.values()],
+            **meta,
+        }
+
+        # backup old archive table
+        if self.archive_path.exists():
+            shutil.copyfile(self.archive_path, self.backup_path)
+
+        # serialize and store with json
+        with open(self.archive_path, 'w') as fout:
+            json.dump(f_table, fout)
+
+        # validate that the files are stored correctly, i.e. try to load them again
+        success = False
+        try:
+            success = self.load() is not None
+        except:
+            success = False
+        if not success:
+            # restore backup
+            if self.archive_path.exists():
+                shutil.copyfile(self.archive_path, self.failed_path)
+            if self.backup_path.exists():
+                shutil.copyfile(self.backup_path, self.archive_path)
+            raise ValueError('Could not store archive table correctly. Restoring backup.')
+
+
+
+"""
+SQLite table indexed by checksum, path and (dev, ino). Only changed entries are written, in one transaction.
+The file pointers are kept in a separate table for the indexes, the rest of the entry (log etc.) is stored as json,
+with the log events as [time, utc offset in minutes, event, path] (tables written before keep the iso timestamps).
+"""
+class SqliteArchiveTable(ArchiveTable):
+    def __init__(self, table_dir):
+        self.db_path = Path(table_dir) / 'archive.db'
+        self._con = None
+
+    def exists(self) -> bool:
+        return self.db_path.exists()
+
+    def _connect(self):
+        if self._con is None:
+            self._con = sqlite3.connect(self.db_path)
+            self._con.execute('PRAGMA journal_mode=WAL')
+            self._con.execute('PRAGMA synchronous=NORMAL')
+            with self._con:
+                self._con.execute('CREATE TABLE IF NOT EXISTS entries (checksum TEXT PRIMARY KEY, active INTEGER NOT NULL, arch_size INTEGER NOT NULL, data TEXT NOT NULL)')
+                self._con.execute('CREATE TABLE IF NOT EXISTS fptrs (checksum TEXT NOT NULL, path TEXT NOT NULL, dev INTEGER NOT NULL, ino INTEGER NOT NULL, mtime REAL NOT NULL, size INTEGER NOT NULL)')
+                self._con.execute('CREATE INDEX IF NOT EXISTS fptrs_checksum ON fptrs (checksum)')
+                self._con.execute('CREATE INDEX IF NOT EXISTS fptrs_path ON fptrs (path)')
+                self._con.execute('CREATE INDEX IF NOT EXISTS fptrs_dev_ino ON fptrs (dev, ino)')
+                self._con.execute('CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT NOT NULL)')
+        return self._con
+
+    def close(self):
+        if self._con is not None:
+            self._con.close()
+            self._con = None
+
+
+    def load(self):
+        if not self.db_path.exists():
+            return None
+        con = self._connect()
+
+        meta = {key: json.loads(value) for key, value in con.execute('SELECT key, value FROM meta')}
+        if 'backup_roots' not in meta:
+            return None
+
+        checksum2fptrs = {}
+        for checksum, path, dev, ino, mtime, size in con.execute('SELECT checksum, path, dev, ino, mtime, size FROM fptrs'):
+            checksum2fptrs.setdefault(checksum, []).append(ArchiveFilePointer(path=path, dev=dev, ino=ino, mtime=mtime, size=size))
+
+        active = []
+        history = []
+        for checksum, is_active, arch_size, data in con.execute('SELECT checksum, active, arch_size, data FROM entries'):
+            entry = ArchiveEntry.from_data(checksum, arch_size, checksum2fptrs.get(checksum, []), json.loads(data))
+            if is_active:
+                active.append(entry)
+            else:
+                history.append(entry)
+        return active, history, meta
+
+
+    def store(self, active, history, meta, changed=None):
+        con = self._connect()
+        if changed is None:
+            changed = set(active.keys()) | set(history.keys())
+            delete_all = True
+        else:
+            delete_all = False
+
+        entry_rows = []
+        fptr_rows = []
+        removed = []
+        for checksum in changed:
+            if checksum in active:
+                entry, is_active = active[checksum], 1
+            elif checksum in history:
+                entry, is_active = history[checksum], 0
+            else:
+                removed.append((checksum,))
+                continue
+            data = json.dumps(entry.data())
+            entry_rows.append((checksum, is_active, entry.arch_size, data))
+            fptr_rows.extend((checksum, fptr.path, fptr.dev, fptr.ino, fptr.mtime, fptr.size) for fptr in entry.fptrs)
+
+        # one transaction, rolled back on any error
+        with con:
+            if delete_all:
+                con.execute('DELETE FROM entries')
+                con.execute('DELETE FROM fptrs')
+            else:
+                con.executemany('DELETE FROM fptrs WHERE checksum = ?', [(checksum,) for checksum in changed])
+                con.executemany('DELETE FROM entries WHERE checksum = ?', removed)
+            con.executemany('INSERT OR REPLACE INTO entries (checksum, active, arch_size, data) VALUES (?, ?, ?, ?)', entry_rows)
+            con.executemany('INSERT INTO fptrs (checksum, path, dev, ino, mtime, size) VALUES (?, ?, ?, ?, ?, ?)', fptr_rows)
+            con.executemany('INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)', [(key, json.dumps(value)) for key, value in meta.items()])
+
+
+
+def open_archive_table(table_dir, backend='sqlite') -> ArchiveTable:
+    if backend == 'json':
+        return JsonArchiveTable(table_dir)
+    if backend != 'sqlite':
+        raise ValueError(f'Unknown archive table backend: {backend}')
+
+    table = SqliteArchiveTable(table_dir)
+    json_table = JsonArchiveTable(table_dir)
+    if not table.exists() and json_table.exists():
+        # one time migration from archive.json
+        logger.info(f'Migrating archive table {json_table.archive_path} to {table.db_path}...')
+        loaded = json_table.load()
+        if loaded is not None:
+            active, history, meta = loaded
+            table.store({entry.checksum: entry for entry in active}, {entry.checksum: entry for entry in history}, meta)
+            logger.info(f'Migrated {len(active)} active and {len(history)} history entries.')
+        json_table.archive_path.rename(json_table.archive_path.with_suffix('.json.migrated'))
+    return table
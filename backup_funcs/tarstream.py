@@ -0,0 +1,64 @@
+import tarfile
+
+
+BLOCK_SIZE = tarfile.BLOCKSIZE
+
+
+class _CountingWriter():
+    def __init__(self, out=None):
+        self.out = out
+        self.n_bytes = 0
+
+    def write(self, data):
+        if self.out is not None:
+            self.out.write(data)
+        self.n_bytes += len(data)
+        return len(data)
+
+
+def content_size(write_content) -> int:
+    # size of the content written by the callback, without keeping it
+    writer = _CountingWriter()
+    write_content(writer)
+    return writer.n_bytes
+
+
+
+"""
+Writes a tar stream to a non seekable file object (e.g. stdout) without temporary files. The size of each member
+must be known up front since it is in the header, the content is written by a callback that gets a file object.
+"""
+class TarStreamWriter():
+    def __init__(self, out):
+        self.out = out
+
+    def add(self, name, size, mtime, write_content, mode=0o644):
+        info = tarfile.TarInfo(name=name.lstrip('/'))
+        info.size = size
+        info.mtime = int(mtime)
+        info.mode = mode
+        self.out.write(info.tobuf(format=tarfile.PAX_FORMAT, encoding='utf-8', errors='surrogateescape'))
+        writer = _CountingWriter(self.out)
+        write_content(writer)
+        if writer.n_bytes != size:
+            # the stream can't be fixed afterwards
+            raise ValueError(f'Size mismatch for {name}: header {size} bytes, content {writer.n_bytes} bytes')
+        if size % BLOCK_SIZE != 0:
+            self.out.write(b'\0' * (BLOCK_SIZE - size % BLOCK_SIZE))
+
+    def close(self):
+        # end of archive marker
+        self.out.write(b'\0' * 2 * BLOCK_SIZE)
+        self.out.flush()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        # after a failed member the stream is left without the end marker, so that tar reports it as truncated
+        # instead of reading it as a complete archive, and the exception is raised
+        if exc_type is None:
+            self.close()
+        else:
+            self.out.flush()
+        return False
@@ -0,0 +1,379 @@
+import ctypes
+import ctypes.util
+import errno
+import json
+import os
+import select
+import struct
+import time
+import uuid
+from pathlib import Path
+
+from .logger import Logger
+
+# optional, to lock the change journal between the watcher and a backup
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+logger = Logger()
+
+
+
+"""
+Journal of the paths changed under the backup roots, written by the watcher (action watch, a long running process)
+so that a backup can scan only those instead of walking the whole tree. Records are json lines [kind, path]:
+    file      the file at path was created, modified, removed or renamed
+    dir       everything under the directory at path must be scanned again (created, removed or moved directories)
+    list      the files directly in the directory at path must be listed again (sweep mode, see Watcher)
+    overflow  changes were lost, the next backup walks the whole tree
+The watcher keeps its session id and a heartbeat in watcher.json. A backup takes the records (they stay in
+changes.taken.jsonl until the backup is done, see commit()) and only uses them if the same watcher session has been
+running since the previous backup, otherwise it walks the whole tree and starts over with the current session.
+"""
+class ChangeJournal():
+    def __init__(self, table_dir):
+        self.table_dir = Path(table_dir)
+        self.journal_path = self.table_dir / 'changes.jsonl'
+        self.taken_path = self.table_dir / 'changes.taken.jsonl'
+        self.state_path = self.table_dir / 'watcher.json'
+        self.lock_path = self.table_dir / 'changes.lock'
+
+    def _locked(self, func):
+        with open(self.lock_path, 'a') as lock:
+            if fcntl is not None:
+                fcntl.flock(lock.fileno(), fcntl.LOCK_EX)
+            try:
+                return func()
+            finally:
+                if fcntl is not None:
+                    fcntl.flock(lock.fileno(), fcntl.LOCK_UN)
+
+    def append(self, records):
+        if len(records) == 0:
+            return
+        lines = ''.join(json.dumps(record) + '\n' for record in records)
+
+        def write():
+            with open(self.journal_path, 'a') as fout:
+                fout.write(lines)
+                fout.flush()
+                os.fsync(fout.fileno())
+        self._locked(write)
+
+    def take(self) -> list:
+        # records since the last commit, new records go to a new journal
+        def move():
+            if not self.journal_path.exists():
+                return
+            with open(self.journal_path) as fin, open(self.taken_path, 'a') as fout:
+                for line in fin:
+                    fout.write(line)
+                fout.flush()
+                os.fsync(fout.fileno())
+            os.remove(self.journal_path)
+        self._locked(move)
+        records = []
+        if self.taken_path.exists():
+            with open(self.taken_path) as fin:
+                for line in fin:
+                    try:
+                        records.append(json.loads(line))
+                    except ValueError:
+                        # cut off by a crash of the watcher
+                        records.append(['overflow', None])
+        return records
+
+    def commit(self):
+        # the backup that took the records is stored
+        if self.taken_path.exists():
+            os.remove(self.taken_path)
+
+    def write_state(self, state:dict):
+        tmp_path = self.state_path.with_suffix('.tmp')
+        with open(tmp_path, 'w') as fout:
+            json.dump(state, fout)
+        os.replace(tmp_path, self.state_path)
+
+    def read_state(self) -> dict:
+        # None if no watcher has run
+        try:
+            with open(self.state_path) as fin:
+                return json.load(fin)
+        except (FileNotFoundError, ValueError):
+            return None
+
+
+
+"""
+The changes taken from the journal, with the paths as posix strings.
+"""
+class ChangeSet():
+    def __init__(self, records):
+        self.files = set()
+        self.dirs = set()
+        self.lists = set()
+        self.overflow = False
+        for kind, path in records:
+            if kind == 'overflow':
+                self.overflow = True
+            elif kind == 'file':
+                self.files.add(Path(path).as_posix())
+            elif kind == 'dir':
+                self.dirs.add(Path(path).as_posix())
+            elif kind == 'list':
+                self.lists.add(Path(path).as_posix())
+
+    def __len__(self):
+        return len(self.files) + len(self.dirs) + len(self.lists)
+
+
+
+# ------------------------------------ linux inotify by ctypes
+
+
+IN_MODIFY = 0x2
+IN_ATTRIB = 0x4
+IN_CLOSE_WRITE = 0x8
+IN_MOVED_FROM = 0x40
+IN_MOVED_TO = 0x80
+IN_CREATE = 0x100
+IN_DELETE = 0x200
+IN_DELETE_SELF = 0x400
+IN_MOVE_SELF = 0x800
+IN_Q_OVERFLOW = 0x4000
+IN_IGNORED = 0x8000
+IN_ONLYDIR = 0x1000000
+IN_DONT_FOLLOW = 0x2000000
+IN_ISDIR = 0x40000000
+IN_CLOEXEC = 0o2000000
+
+WATCH_MASK = (IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_DELETE_SELF |
+              IN_MOVE_SELF | IN_ONLYDIR | IN_DONT_FOLLOW)
+_EVENT_HEADER = struct.Struct('iIII') # wd, mask, cookie, length of the name
+
+
+def _load_libc():
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        libc.inotify_init1
+    except (OSError, AttributeError):
+        return None
+    return libc
+
+_libc = _load_libc()
+
+
+def inotify_available() -> bool:
+    return _libc is not None
+
+
+class Inotify():
+    def __init__(self):
+        self.fd = _libc.inotify_init1(IN_CLOEXEC)
+        if self.fd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err))
+
+    def add_watch(self, path, mask=WATCH_MASK) -> int:
+        wd = _libc.inotify_add_watch(self.fd, os.fsencode(path), mask)
+        if wd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err), path)
+        return wd
+
+    def rm_watch(self, wd):
+        _libc.inotify_rm_watch(self.fd, wd)
+
+    def read(self, timeout) -> list:
+        # [(wd, mask, name)] of the events within timeout seconds
+        readable, _, _ = select.select([self.fd], [], [], timeout)
+        if not readable:
+            return []
+        data = os.read(self.fd, 1024*1024)
+        events = []
+        offset = 0
+        while offset < len(data):
+            wd, mask, _, length = _EVENT_HEADER.unpack_from(data, offset)
+            offset += _EVENT_HEADER.size
+            name = os.fsdecode(data[offset:offset+length].rstrip(b'\0'))
+            offset += length
+            events.append((wd, mask, name))
+        return events
+
+    def close(self):
+        os.close(self.fd)
+
+
+
+"""
+Watches the backup roots and writes the changed paths to the change journal. mode 'inotify' (linux) watches every
+directory, the kernel limit fs.inotify.max_user_watches must be above the number of directories. mode 'sweep'
+lists the directories every sweep_interval seconds and compares their mtimes, which finds files that are created,
+removed or renamed (also files saved by writing a new file and renaming it, as most programs do), but not files
+modified in place, and reports changes up to sweep_interval late - the periodic full backups pick those up.
+mode 'auto' uses inotify where available and falls back to sweep, also when the watch limit is reached.
+"""
+class Watcher():
+    def __init__(self, roots, journal:ChangeJournal, mode='auto', sweep_interval=300, flush_interval=1.0, heartbeat_interval=10):
+        self.roots = [Path(root).as_posix() for root in roots]
+        self.journal = journal
+        self.mode = mode
+        self.sweep_interval = sweep_interval
+        self.flush_interval = flush_interval
+        self.heartbeat_interval = heartbeat_interval
+        self.session = uuid.uuid4().hex
+        self.started = time.time()
+        self._pending = {} # (kind, path) : None, ordered and without duplicates
+        self._last_heartbeat = 0
+        self._ready = False # the state is only published once all directories are watched or swept once
+
+    def _record(self, kind, path):
+        self._pending[(kind, path)] = None
+
+    def _flush(self):
+        if len(self._pending) > 0:
+            self.journal.append([list(record) for record in self._pending])
+            self._pending = {}
+        self._heartbeat()
+
+    def _heartbeat(self, force=False):
+        if not self._ready or (not force and time.time() - self._last_heartbeat < self.heartbeat_interval):
+            return
+        self._last_heartbeat = time.time()
+        self.journal.write_state({'session': self.session, 'mode': self.mode, 'roots': self.roots, 'pid': os.getpid(),
+                                  'started': self.started, 'heartbeat': self._last_heartbeat})
+
+    def run(self, stop=None):
+        # until stop (a threading.Event) is set, or forever
+        mode = self.mode
+        if mode == 'auto':
+            mode = 'inotify' if inotify_available() else 'sweep'
+        if mode == 'inotify':
+            try:
+                self._run_inotify(stop)
+                return
+            except OSError as e:
+                if self.mode != 'auto' or e.errno != errno.ENOSPC:
+                    raise
+                logger.warning(f'Inotify watch limit reached ({e}), raise fs.inotify.max_user_watches. Falling back to sweeping directories.')
+                self._ready = False
+                self.session = uuid.uuid4().hex
+        self.mode = 'sweep'
+        self._run_sweep(stop)
+
+    def _iter_dirs(self, root):
+        # root and all directories under it, symlinks are not followed
+        stack = [root]
+        while stack:
+            dir_path = stack.pop()
+            try:
+                with os.scandir(dir_path) as it:
+                    dir_stat = os.stat(dir_path, follow_symlinks=False)
+                    yield dir_path, dir_stat
+                    for entry in it:
+                        if entry.is_dir(follow_symlinks=False):
+                            stack.append(Path(entry.path).as_posix())
+            except OSError:
+                continue
+
+    def _run_inotify(self, stop):
+        inotify = Inotify()
+        wd2dir = {}
+        dir2wd = {}
+
+        def watch_tree(root):
+            for dir_path, _ in self._iter_dirs(root):
+                try:
+                    wd = inotify.add_watch(dir_path)
+                except OSError as e:
+                    # removed or replaced by a file since it was listed, the watch on its parent reports that
+                    if e.errno in (errno.ENOENT, errno.ENOTDIR):
+                        continue
+                    raise
+                wd2dir[wd] = dir_path
+                dir2wd[dir_path] = wd
+
+        def unwatch_tree(root):
+            # a moved directory is watched again under its new path
+            prefix = root + '/'
+            for dir_path in [dir_path for dir_path in dir2wd if dir_path == root or dir_path.startswith(prefix)]:
+                wd = dir2wd.pop(dir_path)
+                wd2dir.pop(wd, None)
+                inotify.rm_watch(wd)
+
+        try:
+            logger.info(f'Watching {len(self.roots)} backup roots with inotify...')
+            for root in self.roots:
+                watch_tree(root)
+            self._ready = True
+            logger.info(f'Watching {len(dir2wd)} directories.')
+            self._heartbeat(force=True)
+            while stop is None or not stop.is_set():
+                for wd, mask, name in inotify.read(self.flush_interval):
+                    if mask & IN_Q_OVERFLOW:
+                        logger.warning('Inotify queue overflow, the next backup walks the whole tree.')
+                        self._record('overflow', None)
+                        continue
+                    dir_path = wd2dir.get(wd)
+                    if dir_path is None:
+                        continue
+                    if mask & IN_IGNORED:
+                        wd2dir.pop(wd, None)
+                        if dir2wd.get(dir_path) == wd:
+                            dir2wd.pop(dir_path)
+                        continue
+                    path = dir_path + '/' + name if name else dir_path
+                    if mask & (IN_DELETE_SELF | IN_MOVE_SELF):
+                        if dir_path in self.roots:
+                            self._record('dir', dir_path)
+                    elif mask & IN_ISDIR and mask & (IN_CREATE | IN_MOVED_TO):
+                        watch_tree(path)
+                        self._record('dir', path)
+                    elif mask & IN_ISDIR and mask & (IN_DELETE | IN_MOVED_FROM):
+                        unwatch_tree(path)
+                        self._record('dir', path)
+                    elif not mask & IN_ISDIR:
+                        self._record('file', path)
+                self._flush()
+        finally:
+            self._flush()
+            inotify.close()
+
+    def _sweep(self, last_mtimes):
+        # directory : mtime, and records for the directories that are new, changed or gone since last_mtimes
+        mtimes = {}
+        for root in self.roots:
+            for dir_path, dir_stat in self._iter_dirs(root):
+                mtimes[dir_path] = dir_stat.st_mtime_ns
+                self._heartbeat()
+        if last_mtimes is not None:
+            for dir_path, mtime in mtimes.items():
+                last_mtime = last_mtimes.get(dir_path)
+                if last_mtime is None:
+                    self._record('dir', dir_path)
+                elif last_mtime != mtime:
+                    self._record('list', dir_path)
+            for dir_path in last_mtimes:
+                if dir_path not in mtimes:
+                    self._record('dir', dir_path)
+        return mtimes
+
+    def _run_sweep(self, stop):
+        logger.info(f'Watching {len(self.roots)} backup roots by sweeping directories every {self.sweep_interval} s...')
+        mtimes = self._sweep(None)
+        self._ready = True
+        logger.info(f'Watching {len(mtimes)} directories.')
+        self._heartbeat(force=True)
+        t_sweep = time.time()
+        while stop is None or not stop.is_set():
+            if time.time() - t_sweep >= self.sweep_interval:
+                t_sweep = time.time()
+                mtimes = self._sweep(mtimes)
+            self._flush()
+            if stop is not None:
+                stop.wait(self.flush_interval)
+            else:
+                time.sleep(self.flush_interval)
+        self._flush()
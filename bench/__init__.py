@@ -0,0 +1,2 @@
+from .trees import TREE_SHAPES, generate_tree
+from .suite import BenchmarkSuite, run_benchmarks
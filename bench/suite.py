@@ -0,0 +1,185 @@
+import base64
+import datetime as dt
+import json
+import multiprocessing
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+from backup_funcs.archive import Archive
+from backup_funcs.crypto import Crypto
+from backup_funcs.engine import ExecutionEngine
+from backup_funcs.file_info import file_checksum, DEFAULT_HASH_ALGO
+from backup_funcs.scanner import Scanner
+from backup_funcs.logger import Logger
+from backup_funcs.misc import pretty_size, pretty_time
+from .trees import generate_tree
+
+# not available on windows
+try:
+    import resource
+except ImportError:
+    resource = None
+
+logger = Logger()
+
+
+
+def _vm_hwm(pid):
+    # high water mark in bytes of a running process, None where there is no /proc (only linux has VmHWM)
+    try:
+        with open(f'/proc/{pid}/status') as fin:
+            for line in fin:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1])*1024
+    except (OSError, ValueError):
+        pass
+    return None
+
+
+def _peak_rss() -> tuple:
+    # high water mark in bytes of this process and of the largest worker process. The workers of the engine pools
+    # are still running, getrusage only counts children that have finished, so those are read from /proc
+    if resource is None:
+        return None, None
+    # kilobytes on linux, bytes on macos
+    factor = 1 if sys.platform == 'darwin' else 1024
+    rss_children = [resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss*factor]
+    rss_children += [_vm_hwm(process.pid) or 0 for process in multiprocessing.active_children()]
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss*factor, max(rss_children)
+
+
+def _git_commit():
+    try:
+        result = subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=Path(__file__).parent, capture_output=True, text=True, timeout=10)
+    except (OSError, subprocess.SubprocessError):
+        return None
+    return result.stdout.strip() or None
+
+
+
+"""
+Runs the benchmarks one after the other on the same synthetic tree, each result has the wall time, files/s,
+MB/s (of file content) and the peak RSS so far of this process and of the largest worker process, running or finished.
+"""
+class BenchmarkSuite():
+    def __init__(self, work_dir, shape='quick', scale=1.0, seed=0, compression='auto', hash_algo=DEFAULT_HASH_ALGO,
+                 n_procs=None, n_threads_per_proc=None):
+        self.work_dir = Path(work_dir)
+        self.shape = shape
+        self.scale = scale
+        self.seed = seed
+        self.compression = compression
+        self.hash_algo = hash_algo
+        self.n_procs = n_procs
+        self.n_threads_per_proc = n_threads_per_proc
+        self.key = base64.urlsafe_b64encode(os.urandom(32))
+        self.results = []
+
+    def measure(self, name, func, n_files, n_bytes):
+        t0 = time.perf_counter()
+        func()
+        seconds = time.perf_counter() - t0
+        rss, rss_children = _peak_rss()
+        result = {
+            'name': name,
+            'seconds': seconds,
+            'n_files': n_files,
+            'n_bytes': n_bytes,
+            'files_per_s': n_files / seconds if seconds > 0 else None,
+            'mb_per_s': n_bytes / (1024*1024) / seconds if seconds > 0 else None,
+            'peak_rss_mb': rss / (1024*1024) if rss is not None else None,
+            'peak_rss_workers_mb': rss_children / (1024*1024) if rss_children is not None else None,
+        }
+        self.results.append(result)
+        logger.info(f"bench {name}: {pretty_time(seconds)}, {result['files_per_s'] or 0:.0f} files/s, {result['mb_per_s'] or 0:.1f} MB/s")
+        return result
+
+    def _tree(self):
+        # generating millions of files is slow, so a tree is kept in the work dir and reused
+        tree_dir = self.work_dir / f'tree-{self.shape}-{self.scale}-{self.seed}'
+        done_marker = tree_dir / '.complete'
+        if not done_marker.exists():
+            shutil.rmtree(tree_dir, ignore_errors=True)
+            logger.info(f'Generating {self.shape} tree (scale {self.scale}) in {tree_dir}...')
+            generate_tree(tree_dir / 'src', self.shape, self.scale, self.seed)
+            done_marker.touch()
+        return tree_dir / 'src'
+
+    def run(self) -> dict:
+        src = self._tree()
+        run_dir = Path(tempfile.mkdtemp(prefix='run-', dir=self.work_dir))
+        engine = ExecutionEngine(key=self.key, n_procs=self.n_procs, n_threads_per_proc=self.n_threads_per_proc,
+                                 compression=self.compression, hash_algo=self.hash_algo)
+        try:
+            scanner = Scanner(engine)
+            finfos = list(scanner.iter_directory_tree(src, with_checksum=False))
+            n_files, n_bytes = len(finfos), sum([finfo.size for finfo in finfos])
+            logger.info(f'Benchmarking on {n_files} files, {pretty_size(n_bytes)}...')
+
+            self.measure('scan', lambda: list(scanner.iter_directory_tree(src, with_checksum=False)), n_files, 0)
+            self.measure('file_checksum', lambda: [file_checksum(finfo.path, algo=self.hash_algo) for finfo in finfos], n_files, n_bytes)
+            scanned = []
+            self.measure('scan_with_checksums', lambda: scanned.extend(scanner.iter_directory_tree(src, with_checksum=True)), n_files, n_bytes)
+
+            crypto = Crypto(self.key, compression=self.compression, hash_algo=self.hash_algo)
+            blob_dir = run_dir / 'blobs'
+            restore_dir = run_dir / 'restored'
+            os.makedirs(blob_dir)
+            os.makedirs(restore_dir)
+            self.measure('store_file', lambda: [crypto.store_file(finfo.path, blob_dir / f'{i}.enc') for i, finfo in enumerate(finfos)], n_files, n_bytes)
+            self.measure('restore_file', lambda: [crypto.restore_file(blob_dir / f'{i}.enc', restore_dir / str(i)) for i in range(n_files)], n_files, n_bytes)
+            shutil.rmtree(blob_dir)
+            shutil.rmtree(restore_dir)
+
+            archive_args = dict(compression=self.compression, hash_algo=self.hash_algo, n_procs=self.n_procs, n_threads_per_proc=self.n_threads_per_proc)
+            with Archive(run_dir / 'table', run_dir / 'files', self.key, **archive_args) as archive:
+                self.measure('update_archive', lambda: archive._update_archive(scanned), n_files, n_bytes)
+                self.measure('update_archive_unchanged', lambda: archive._update_archive(scanned), n_files, 0)
+                n_entries = len(archive.active) + len(archive.history)
+                def store_table():
+                    archive._changed = set(archive.active.keys()) | set(archive.history.keys())
+                    archive._store_archive_table()
+                self.measure('table_store', store_table, n_entries, 0)
+            loaded = []
+            self.measure('table_load', lambda: loaded.append(Archive(run_dir / 'table', run_dir / 'files', self.key, **archive_args)), n_entries, 0)
+            loaded[0].close()
+        finally:
+            engine.close()
+            shutil.rmtree(run_dir, ignore_errors=True)
+
+        return {
+            'timestamp': dt.datetime.now().astimezone().isoformat(),
+            'commit': _git_commit(),
+            'shape': self.shape,
+            'scale': self.scale,
+            'seed': self.seed,
+            'n_files': n_files,
+            'n_bytes': n_bytes,
+            'compression': self.compression,
+            'hash_algo': self.hash_algo,
+            'n_procs': engine.n_procs,
+            'n_threads_per_proc': engine.n_threads_per_proc,
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'cpu_count': os.cpu_count(),
+            'results': self.results,
+        }
+
+
+
+def run_benchmarks(work_dir=None, shape='quick', scale=1.0, out_path=None, **kwargs) -> dict:
+    # runs the suite, appends the report as a json line to out_path (to compare runs over time) and returns it
+    work_dir = Path(work_dir) if work_dir is not None else Path(tempfile.gettempdir()) / 'backup-ninja-bench'
+    os.makedirs(work_dir, exist_ok=True)
+    report = BenchmarkSuite(work_dir, shape=shape, scale=scale, **kwargs).run()
+    if out_path is not None:
+        with open(out_path, 'a') as fout:
+            fout.write(json.dumps(report) + '\n')
+        logger.info(f'Benchmark report appended to {out_path}')
+    return report
@@ -0,0 +1,76 @@
+import os
+import random
+from pathlib import Path
+
+
+
+"""
+Synthetic directory trees for the benchmarks. A shape gives the number and size of each kind of file:
+    tiny    small text files, e.g. source trees and mail directories
+    text    compressible documents
+    media   incompressible content like photos and videos
+    huge    a few large files, e.g. disk images
+and the share of files that are copies of other files (dup_ratio). The counts are multiplied by the scale.
+"""
+TREE_SHAPES = {
+    'quick': {'tiny': (2000, 2*1024), 'text': (200, 256*1024), 'media': (20, 4*1024*1024), 'huge': (1, 64*1024*1024), 'dup_ratio': 0.2},
+    'mixed': {'tiny': (50000, 2*1024), 'text': (2000, 512*1024), 'media': (200, 8*1024*1024), 'huge': (4, 512*1024*1024), 'dup_ratio': 0.2},
+    'tiny_files': {'tiny': (1000000, 1024), 'text': (0, 0), 'media': (0, 0), 'huge': (0, 0), 'dup_ratio': 0.1},
+    'huge_files': {'tiny': (0, 0), 'text': (0, 0), 'media': (0, 0), 'huge': (2, 1024*1024*1024), 'dup_ratio': 0.0},
+    'media': {'tiny': (0, 0), 'text': (0, 0), 'media': (1000, 8*1024*1024), 'huge': (0, 0), 'dup_ratio': 0.0},
+    'duplicates': {'tiny': (20000, 4*1024), 'text': (2000, 512*1024), 'media': (100, 8*1024*1024), 'huge': (0, 0), 'dup_ratio': 0.8},
+}
+
+FILES_PER_DIR = 500
+WORDS = [b'backup', b'archive', b'ninja', b'checksum', b'chunk', b'encrypt', b'restore', b'table', b'path', b'file']
+
+
+def _text(rnd:random.Random, size) -> bytes:
+    # compressible but not trivially so
+    out = bytearray()
+    while len(out) < size:
+        out += b' '.join(rnd.choices(WORDS, k=64)) + b'%d\n' % rnd.getrandbits(32)
+    return bytes(out[:size])
+
+
+def _write_random(fpath, size, rnd:random.Random, block_size=4*1024*1024):
+    with open(fpath, 'wb') as fout:
+        remaining = size
+        while remaining > 0:
+            n = min(block_size, remaining)
+            fout.write(rnd.randbytes(n))
+            remaining -= n
+
+
+def generate_tree(root, shape='quick', scale=1.0, seed=0) -> tuple[int, int]:
+    # writes the tree under root (which should be empty), returns (number of files, total size)
+    spec = TREE_SHAPES[shape]
+    rnd = random.Random(seed)
+    root = Path(root)
+    n_files, n_bytes = 0, 0
+    originals = []
+    for kind in ['tiny', 'text', 'media', 'huge']:
+        count, size = spec[kind]
+        count = max(1, round(count*scale)) if count > 0 else 0
+        for i in range(count):
+            dir_path = root / kind / f'd{i // FILES_PER_DIR:05d}'
+            if i % FILES_PER_DIR == 0:
+                os.makedirs(dir_path, exist_ok=True)
+            fpath = dir_path / f'f{i:07d}.{"bin" if kind in ("media", "huge") else "txt"}'
+            if originals and rnd.random() < spec['dup_ratio']:
+                # a copy of an earlier file of the same kind
+                src_path = rnd.choice(originals)
+                with open(src_path, 'rb') as fin, open(fpath, 'wb') as fout:
+                    fout.write(fin.read())
+                n_bytes += os.path.getsize(fpath)
+            else:
+                if kind in ('tiny', 'text'):
+                    fpath.write_bytes(_text(rnd, size))
+                else:
+                    _write_random(fpath, size, rnd)
+                n_bytes += size
+                if kind in ('tiny', 'text', 'media'):
+                    originals.append(fpath)
+            n_files += 1
+        originals = []
+    return n_files, n_bytes
@@ -0,0 +1,53 @@
+import base64
+import os
+import random
+from pathlib import Path
+
+import pytest
+
+from backup_funcs.archive import Archive
+
+
+@pytest.fixture
+def key():
+    return base64.urlsafe_b64encode(os.urandom(32))
+
+
+@pytest.fixture
+def open_archive(tmp_path, key):
+    # opens the archive in tmp_path (again) with a small engine, all archives are closed after the test
+    archives = []
+
+    def open_archive(**kwargs):
+        kwargs.setdefault('n_procs', 1)
+        kwargs.setdefault('n_threads_per_proc', 2)
+        archive = Archive(tmp_path / 'table', tmp_path / 'files', key, **kwargs)
+        archives.append(archive)
+        return archive
+
+    yield open_archive
+    for archive in archives:
+        archive.close()
+
+
+def make_tree(root:Path, n_small=20, seed=0):
+    # small files, a few duplicates, an empty file and two larger files
+    rnd = random.Random(seed)
+    for i in range(n_small):
+        d = root / f'd{i % 3}'
+        d.mkdir(parents=True, exist_ok=True)
+        (d / f'f{i}.txt').write_bytes((f'file {i} ' * rnd.randint(1, 2000)).encode())
+    (root / 'dup.txt').write_bytes((root / 'd1' / 'f1.txt').read_bytes())
+    (root / 'empty').write_bytes(b'')
+    (root / 'medium.bin').write_bytes(rnd.randbytes(2*1024*1024))
+    (root / 'large.bin').write_bytes(rnd.randbytes(3*1024*1024) + b'a'*3*1024*1024)
+
+
+def read_tree(root:Path) -> dict:
+    # relative posix path : content
+    return {path.relative_to(root).as_posix(): path.read_bytes() for path in sorted(root.rglob('*')) if path.is_file()}
+
+
+def restored_root(restore_dir:Path, root:Path) -> Path:
+    # where Archive.restore puts the files of root
+    return restore_dir / root.absolute().as_posix().lstrip('/')
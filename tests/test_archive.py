@@ -0,0 +1,446 @@
+import datetime as dt
+import os
+import time
+from pathlib import Path
+
+import pytest
+
+from backup_funcs import crypto
+from backup_funcs.crypto import Crypto
+from backup_funcs.file_info import file_checksum
+from backup_funcs.packs import list_packs
+from backup_funcs.storage import LocalStorage, open_remote
+
+from .conftest import make_tree, read_tree, restored_root
+
+
+def _restore(archive, tmp_path, name, src) -> dict:
+    restore_dir = tmp_path / name
+    archive.restore(restore_dir)
+    return read_tree(restored_root(restore_dir, src))
+
+
+def _checksums(archive) -> dict:
+    # path : checksum of the active entries
+    return {fptr.path: entry.checksum for entry in archive.active.values() for fptr in entry.fptrs}
+
+
+def test_backup_reload_restore_verify(tmp_path, open_archive):
+    src = tmp_path / 'src'
+    make_tree(src)
+    archive = open_archive(chunking_min_size=4*1024*1024)
+    archive.backup([src], full=True)
+    assert any(entry.pack is not None for entry in archive.active.values())
+    assert any(entry.chunks is not None for entry in archive.active.values())
+    assert any(entry.pack is None and entry.chunks is None for entry in archive.active.values())
+
+    archive = open_archive()
+    assert _restore(archive, tmp_path, 'restore0', src) == read_tree(src)
+    assert archive.verify(deep=True)['n_errors'] == 0
+    assert archive.verify(deep=False)['n_errors'] == 0
+
+    # incremental backup with a modified, a removed and a new file
+    (src / 'd0' / 'f0.txt').write_bytes(b'changed')
+    os.remove(src / 'd1' / 'f4.txt')
+    (src / 'new.txt').write_bytes(b'new file')
+    archive.backup([src], full=False)
+
+    archive = open_archive()
+    assert _restore(archive, tmp_path, 'restore1', src) == read_tree(src)
+    assert len(archive.history) == 2
+    assert archive.verify(deep=True)['n_errors'] == 0
+
+    # a modified blob is found by the deep check, a truncated one by both
+    entry = next(entry for entry in archive.active.values() if entry.pack is None and entry.chunks is None)
+    blob_path = archive._archived_fpath(entry.checksum)
+    blob = bytearray(blob_path.read_bytes())
+    blob[-100] ^= 1
+    blob_path.write_bytes(blob)
+    assert archive.verify(deep=True, restart=True)['n_errors'] == 1
+    blob_path.write_bytes(blob[:len(blob) // 2])
+    assert archive.verify(deep=False, restart=True)['n_errors'] == 1
+
+
+def test_incremental_backup_reuses_metadata(tmp_path, open_archive):
+    src = tmp_path / 'src'
+    make_tree(src)
+    open_archive().backup([src], full=True)
+
+    # same size and mtime, so an incremental backup takes the stored checksum
+    path = src / 'd0' / 'f0.txt'
+    stat = path.stat()
+    path.write_bytes(path.read_bytes().upper())
+    os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+    old_checksum = _checksums(open_archive())[path.as_posix()]
+    archive = open_archive()
+    archive.backup([src], full=False)
+    checksums = _checksums(open_archive())
+    assert checksums[path.as_posix()] == old_checksum
+    assert len(checksums) == len(read_tree(src))
+
+    # a changed mtime is picked up by an incremental backup, a full backup hashes every file
+    os.utime(src / 'd1' / 'f1.txt', ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+    (src / 'd1' / 'f1.txt').write_bytes(b'changed')
+    open_archive().backup([src], full=False)
+    assert _checksums(open_archive())[(src / 'd1' / 'f1.txt').as_posix()] == file_checksum(src / 'd1' / 'f1.txt')
+    open_archive().backup([src], full=True)
+    checksums = _checksums(open_archive())
+    assert checksums == {path.as_posix(): file_checksum(path) for path in src.rglob('*') if path.is_file()}
+
+
+def test_full_backup_due(tmp_path, open_archive):
+    src = tmp_path / 'src'
+    make_tree(src, n_small=3)
+    archive = open_archive()
+    assert archive.full_backup_due(3, 30)
+    archive.backup([src], full=True)
+
+    # every third backup is a full one, the state is kept in the archive table
+    for n_backups_since_full in [0, 1]:
+        archive = open_archive()
+        assert archive.n_backups_since_full == n_backups_since_full
+        assert not archive.full_backup_due(3, 30)
+        archive.backup([src], full=False)
+    archive = open_archive()
+    assert archive.n_backups_since_full == 2
+    assert archive.full_backup_due(3, 30)
+    assert not archive.full_backup_due(None, None)
+    archive.backup([src], full=True)
+    assert open_archive().n_backups_since_full == 0
+
+    # or once the last full backup is older than max_age_days
+    archive.last_full_backup = (dt.datetime.now().astimezone() - dt.timedelta(days=31)).isoformat()
+    assert archive.full_backup_due(None, 30)
+    assert not archive.full_backup_due(None, 40)
+
+
+def test_journal_replay_after_crash(tmp_path, open_archive, monkeypatch):
+    src = tmp_path / 'src'
+    make_tree(src)
+    archive = open_archive(chunking_min_size=4*1024*1024)
+
+    def crash():
+        raise RuntimeError('crash before the table is stored')
+
+    monkeypatch.setattr(archive, '_store_archive_table', crash)
+    with pytest.raises(RuntimeError):
+        archive.backup([src], full=True)
+    archive.close()
+    assert (tmp_path / 'table' / 'journal.jsonl').exists()
+
+    # the next run recovers the stored files and does not store them again
+    archive = open_archive(chunking_min_size=4*1024*1024)
+    assert not (tmp_path / 'table' / 'journal.jsonl').exists()
+    assert len(archive.active) == len(set(read_tree(src).values()))
+    stored = read_tree(archive.file_dir)
+    archive.backup([src], full=False)
+    assert read_tree(archive.file_dir) == stored
+    assert _restore(open_archive(), tmp_path, 'restore', src) == read_tree(src)
+
+
+def test_history_cleanup_and_gc(tmp_path, open_archive):
+    src = tmp_path / 'src'
+    make_tree(src)
+    archive = open_archive(chunking_min_size=4*1024*1024)
+    archive.backup([src], full=True)
+    old_blob = archive._archived_fpath(file_checksum(src / 'medium.bin'))
+    (src / 'medium.bin').write_bytes(os.urandom(2*1024*1024))
+    os.remove(src / 'large.bin')
+    archive.backup([src], full=False)
+
+    # the files of removed history entries are deleted after the table is stored
+    assert old_blob.exists()
+    archive.cleanup_delete_all_history()
+    assert not old_blob.exists()
+    assert len(open_archive().history) == 0
+
+    # unreferenced archive files, packs and stale temporary files are found by gc, a dry run keeps them
+    orphans = [archive.file_dir / 'ab' / ('ab'*32 + '.enc'), archive.pack_dir / 'pack-orphan.pack', archive.file_dir / 'ab' / 'stale.tmp']
+    orphans[0].parent.mkdir(exist_ok=True)
+    for orphan in orphans:
+        orphan.write_bytes(b'x'*10)
+    os.utime(orphans[2], (0, 0))
+    fresh_tmp = archive.file_dir / 'ab' / 'fresh.tmp'
+    fresh_tmp.write_bytes(b'x'*10)
+    archive = open_archive()
+    report = archive.collect_garbage(dry_run=True)
+    assert (report['n_orphans'], report['orphan_size'], report['n_missing']) == (3, 30, 0)
+    assert all(orphan.exists() for orphan in orphans)
+    archive.collect_garbage()
+    assert not any(orphan.exists() for orphan in orphans)
+    assert fresh_tmp.exists()
+    assert archive.collect_garbage(dry_run=True)['n_orphans'] == 0
+    assert _restore(open_archive(), tmp_path, 'restore', src) == read_tree(src)
+
+    # referenced files that are missing are reported
+    os.remove(archive._archived_fpath(file_checksum(src / 'medium.bin')))
+    assert archive.collect_garbage(dry_run=True)['n_missing'] == 1
+
+
+@pytest.mark.parametrize('hardlink_duplicates', [False, True])
+def test_restore_decodes_each_blob_once(tmp_path, open_archive, monkeypatch, hardlink_duplicates):
+    src = tmp_path / 'src'
+    make_tree(src, n_small=3)
+    for i in range(3):
+        (src / f'dup{i}.bin').write_bytes((src / 'medium.bin').read_bytes())
+    archive = open_archive()
+    archive.backup([src], full=True)
+
+    # the workers are forked after the patch, each decoded blob is logged to a file
+    decoded_log = tmp_path / 'decoded'
+    restore_file = crypto._restore_file
+
+    def logged_restore_file(srcdst_path_pair):
+        with open(decoded_log, 'a') as f:
+            f.write(f'{srcdst_path_pair[1]}\n')
+        return restore_file(srcdst_path_pair)
+
+    monkeypatch.setattr(crypto, '_restore_file', logged_restore_file)
+    archive = open_archive()
+    archive.restore(tmp_path / 'restore', hardlink_duplicates=hardlink_duplicates)
+    root = restored_root(tmp_path / 'restore', src)
+    assert read_tree(root) == read_tree(src)
+    assert len(decoded_log.read_text().splitlines()) == len(archive.active)
+
+    # duplicates are copies of the decoded file, or hardlinks to it
+    copies = [root / 'medium.bin'] + [root / f'dup{i}.bin' for i in range(3)]
+    for path in copies:
+        assert path.stat().st_nlink == (len(copies) if hardlink_duplicates else 1)
+
+
+def test_missing_chunk_is_stored_again(tmp_path, open_archive, key):
+    src = tmp_path / 'src'
+    make_tree(src, n_small=3)
+    archive = open_archive(chunking_min_size=4*1024*1024)
+    archive.backup([src], full=True)
+    entry = next(entry for entry in archive.active.values() if entry.chunks is not None)
+    os.remove(archive._chunk_fpaths(entry)[1])
+
+    # stored again as a single blob file, which the table must point to after a reload
+    archive = open_archive(chunking_min_size=None)
+    archive.backup([src], full=False)
+    archive = open_archive(chunking_min_size=None)
+    assert archive.active[entry.checksum].chunks is None
+    assert all(archive._check_archive_entry(entry) for entry in archive.active.values())
+    Crypto(key).restore_file(archive._archived_fpath(entry.checksum), tmp_path / 'large.bin')
+    assert (tmp_path / 'large.bin').read_bytes() == (src / 'large.bin').read_bytes()
+
+
+def test_missing_pack_is_stored_again(tmp_path, open_archive):
+    src = tmp_path / 'src'
+    src.mkdir()
+    for i in range(5):
+        (src / f'f{i}.txt').write_bytes(f'small file {i}'.encode())
+    archive = open_archive()
+    archive.backup([src], full=True)
+    packs = list_packs(archive.pack_dir)
+    assert len(packs) == 1
+    os.remove(archive.pack_dir / next(iter(packs)))
+
+    # the files are stored again into a new pack, which the table must point to after a reload
+    archive = open_archive()
+    archive.backup([src], full=False)
+    archive = open_archive()
+    assert {entry.pack for entry in archive.active.values()} == set(list_packs(archive.pack_dir))
+    assert _restore(archive, tmp_path, 'restore', src) == read_tree(src)
+
+
+def test_repack(tmp_path, open_archive):
+    src = tmp_path / 'src'
+    make_tree(src, n_small=40)
+    archive = open_archive()
+    archive.backup([src], full=True)
+    for i in range(0, 40, 2):
+        os.remove(src / f'd{i % 3}' / f'f{i}.txt')
+    archive.backup([src], full=False)
+    packs_before = list_packs(archive.pack_dir)
+
+    # removing the history leaves dead blobs in the pack, which is repacked
+    archive.cleanup_delete_all_history()
+    packs_after = list_packs(archive.pack_dir)
+    assert set(packs_after).isdisjoint(packs_before)
+    assert sum(packs_after.values()) < sum(packs_before.values())
+    assert _restore(open_archive(), tmp_path, 'restore', src) == read_tree(src)
+
+
+def test_repack_only_rewrites_packs_with_removed_data(tmp_path, open_archive):
+    src = tmp_path / 'src'
+    src.mkdir()
+    archive = open_archive()
+    for run in range(3):
+        for i in range(5):
+            (src / f'run{run}_f{i}.txt').write_bytes(f'run {run} file {i} '.encode() * 100)
+        archive.backup([src], full=False)
+    packs = list_packs(archive.pack_dir)
+    assert len(packs) == 3
+    archive.repack()
+    assert list_packs(archive.pack_dir) == packs
+
+    # only the pack with removed files is rewritten
+    for i in range(4):
+        os.remove(src / f'run1_f{i}.txt')
+    archive.backup([src], full=False, hard_remove=True)
+    repacked = list_packs(archive.pack_dir)
+    assert len(repacked) == 3
+    assert len(set(repacked) & set(packs)) == 2
+    assert _restore(open_archive(), tmp_path, 'restore', src) == read_tree(src)
+
+
+def test_repack_skips_packs_that_can_not_be_read(tmp_path, open_archive):
+    src = tmp_path / 'src'
+    src.mkdir()
+    archive = open_archive()
+    for run in range(2):
+        for i in range(4):
+            (src / f'run{run}_f{i}.txt').write_bytes(f'run {run} file {i} '.encode() * 100)
+        archive.backup([src], full=False)
+    packs = sorted(archive.pack_dir.glob('*.pack'), key=os.path.getmtime)
+    assert len(packs) == 2
+    for run in range(2):
+        for i in range(2):
+            os.remove(src / f'run{run}_f{i}.txt')
+    archive.backup([src], full=False)
+
+    # the first pack is cut off in its last live blob, it is kept and the other one is still repacked
+    archive = open_archive()
+    last_blob_end = max(entry.pack_offset + entry.arch_size for entry in archive.active.values() if entry.pack == packs[0].name)
+    os.truncate(packs[0], last_blob_end - 1)
+    archive.cleanup_delete_all_history()
+    assert packs[0].exists() and not packs[1].exists()
+    archive = open_archive()
+    new_packs = list_packs(archive.pack_dir)
+    for entry in archive.active.values():
+        if '/run0_' in entry.fptrs[0].path:
+            assert entry.pack == packs[0].name
+        else:
+            assert entry.pack in new_packs and entry.pack not in (packs[0].name, packs[1].name)
+
+
+def test_repack_skips_packs_that_can_not_be_fetched(tmp_path, open_archive, monkeypatch):
+    src = tmp_path / 'src'
+    src.mkdir()
+    remote_dir = tmp_path / 'remote'
+    remote = lambda: open_remote({'type': 'local', 'path': str(remote_dir)}, tmp_path / 'remote_listing.json')
+    archive = open_archive(remote=remote(), keep_local=False)
+    for run in range(2):
+        for i in range(4):
+            (src / f'run{run}_f{i}.txt').write_bytes(f'run {run} file {i} '.encode() * 100)
+        archive.backup([src], full=False)
+    packs = sorted(remote_dir.glob('packs/*.pack'), key=os.path.getmtime)
+    assert len(packs) == 2 and len(list_packs(archive.pack_dir)) == 0
+    for run in range(2):
+        for i in range(2):
+            os.remove(src / f'run{run}_f{i}.txt')
+    archive.backup([src], full=False)
+
+    # the download of the first pack fails for now, it is kept on the remote and the other one is still repacked
+    download = LocalStorage.download
+
+    def failing_download(self, key, local_path):
+        if key.endswith(packs[0].name):
+            raise OSError('connection reset')
+        return download(self, key, local_path)
+
+    monkeypatch.setattr(LocalStorage, 'download', failing_download)
+    archive = open_archive(remote=remote(), keep_local=False)
+    archive.cleanup_delete_all_history()
+    entries = [entry for entry in archive.active.values() if entry.fptrs[0].path.startswith((src / 'run0').as_posix())]
+    assert len(entries) == 2 and all(entry.pack == packs[0].name for entry in entries)
+    assert packs[0].exists() and not packs[1].exists()
+
+    monkeypatch.setattr(LocalStorage, 'download', download)
+    assert _restore(open_archive(remote=remote(), keep_local=False), tmp_path, 'restore', src) == read_tree(src)
+
+
+def test_changed_file_with_matching_partial_checksum_is_stored(tmp_path, open_archive):
+    src = tmp_path / 'src'
+    make_tree(src, n_small=3)
+    open_archive().backup([src], full=True)
+
+    # same size, start, middle and end as medium.bin, so only the full checksum tells them apart
+    data = bytearray((src / 'medium.bin').read_bytes())
+    data[500000] ^= 0xff
+    (src / 'copy.bin').write_bytes(data)
+    archive = open_archive()
+    assert archive.size_partials.get(len(data))
+    archive.backup([src], full=False)
+    checksum = _checksums(open_archive())[(src / 'copy.bin').as_posix()]
+    assert checksum == file_checksum(src / 'copy.bin')
+    assert checksum != file_checksum(src / 'medium.bin')
+    assert _restore(open_archive(), tmp_path, 'restore', src) == read_tree(src)
+
+
+def test_hash_algo_is_kept(tmp_path, open_archive):
+    src = tmp_path / 'src'
+    make_tree(src, n_small=3)
+    open_archive(hash_algo='blake2b').backup([src], full=True)
+
+    # the archive was made with blake2b, a configured sha256 is ignored
+    archive = open_archive()
+    assert archive.hash_algo == 'blake2b'
+    (src / 'new.txt').write_bytes(b'new file')
+    archive.backup([src], full=False)
+    checksums = _checksums(open_archive())
+    assert checksums == {path.as_posix(): file_checksum(path, algo='blake2b') for path in src.rglob('*') if path.is_file()}
+    archive = open_archive()
+    assert _restore(archive, tmp_path, 'restore', src) == read_tree(src)
+    assert archive.verify(deep=True)['n_errors'] == 0
+
+
+def test_select(tmp_path, open_archive):
+    src = tmp_path / 'src'
+    make_tree(src, n_small=6)
+    open_archive().backup([src], full=True)
+    before_change = dt.datetime.now().astimezone()
+    (src / 'd0' / 'f0.txt').write_bytes(b'changed')
+    os.remove(src / 'd1' / 'f1.txt')
+    archive = open_archive()
+    archive.backup([src], full=True)
+    archive = open_archive()
+
+    def paths(selected):
+        return sorted(Path(path).relative_to(src).as_posix() for path, _ in selected)
+
+    assert paths(archive.select()) == sorted(read_tree(src))
+    assert paths(archive.select(prefix=src / 'd0')) == ['d0/f0.txt', 'd0/f3.txt']
+    assert paths(archive.select(pattern='*.bin')) == ['large.bin', 'medium.bin']
+    assert paths(archive.select(pattern='d2/*')) == ['d2/f2.txt', 'd2/f5.txt']
+    assert paths(archive.select(prefix=src / 'd0', pattern='d2/*')) == []
+    assert paths(archive.select(checksum=file_checksum(src / 'dup.txt'))) == ['dup.txt']
+
+    # as it was before the second backup, with the old content of f0 and the deleted f1
+    selected = archive.select(as_of=before_change)
+    assert paths(selected) == sorted(list(read_tree(src)) + ['d1/f1.txt'])
+    checksums = {Path(path).relative_to(src).as_posix(): entry.checksum for path, entry in selected}
+    assert checksums['d0/f0.txt'] != file_checksum(src / 'd0' / 'f0.txt')
+    assert paths(archive.select(checksum=file_checksum(src / 'dup.txt'), as_of=before_change.isoformat())) == ['d1/f1.txt', 'dup.txt']
+    assert archive.select(as_of=before_change - dt.timedelta(days=1)) == []
+
+
+def test_dir_index(tmp_path, open_archive, monkeypatch):
+    src = tmp_path / 'src'
+    make_tree(src)
+    # directories changed an hour ago, so their listing is not within the mtime granularity
+    hour_ago = time.time() - 3600
+    for path in [src] + [path for path in src.rglob('*') if path.is_dir()]:
+        os.utime(path, (hour_ago, hour_ago))
+    open_archive(dir_index=True).backup([src], full=True)
+
+    listed = []
+    scandir = os.scandir
+    monkeypatch.setattr(os, 'scandir', lambda path='.': listed.append(Path(path)) or scandir(path))
+
+    # unchanged directories are taken from the index and their files from the table
+    listed.clear()
+    archive = open_archive(dir_index=True)
+    archive.backup([src], full=False)
+    assert [path for path in listed if path.is_relative_to(src)] == []
+    assert _checksums(open_archive()) == {path.as_posix(): file_checksum(path) for path in src.rglob('*') if path.is_file()}
+
+    # an added file changes the mtime of its directory, which is listed again
+    (src / 'd1' / 'added.txt').write_bytes(b'added')
+    os.utime(src / 'd1', (hour_ago + 10, hour_ago + 10))
+    listed.clear()
+    open_archive(dir_index=True).backup([src], full=False)
+    assert [path for path in listed if path.is_relative_to(src)] == [src / 'd1']
+    assert _checksums(open_archive()) == {path.as_posix(): file_checksum(path) for path in src.rglob('*') if path.is_file()}
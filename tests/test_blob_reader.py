@@ -0,0 +1,72 @@
+import io
+import os
+import random
+
+import pytest
+
+from backup_funcs.blob_reader import ChunkCache, open_blob
+from backup_funcs.crypto import Crypto, chunk_fpath
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+
+def _n_open_fds():
+    return len(os.listdir('/proc/self/fd'))
+
+
+@pytest.fixture
+def chunked_file(tmp_path, key):
+    # (crypto, chunk paths, content) of a file stored as about a hundred content defined chunks
+    crypto = Crypto(key)
+    data = random.Random(0).randbytes(6*1024*1024)
+    (tmp_path / 'big.bin').write_bytes(data)
+    _, chunks, _, _ = crypto.store_chunked_file(tmp_path / 'big.bin', tmp_path / 'chunks', avg_chunk_size=64*1024)
+    assert len(chunks) > 50
+    return crypto, [chunk_fpath(tmp_path / 'chunks', chunk) for chunk in chunks], data
+
+
+@pytest.mark.parametrize('known_size', [False, True])
+def test_chunked_reader(chunked_file, known_size):
+    crypto, chunk_paths, data = chunked_file
+    with open_blob(crypto, chunk_paths, size=len(data) if known_size else None, cache=ChunkCache()) as f:
+        assert f.read() == data
+        assert f.seek(0, io.SEEK_END) == len(data)
+        for pos in [len(data) - 10, 12345, 3*1024*1024, 0]:
+            f.seek(pos)
+            assert f.read(100000) == data[pos:pos+100000]
+        f.seek(len(data) + 5)
+        assert f.read(10) == b''
+
+
+@pytest.mark.skipif(not os.path.isdir('/proc/self/fd'), reason='needs /proc/self/fd')
+def test_chunked_reader_opens_one_chunk_at_a_time(chunked_file):
+    crypto, chunk_paths, data = chunked_file
+    n_fds = _n_open_fds()
+    with open_blob(crypto, chunk_paths, buffer_size=4096) as f:
+        assert _n_open_fds() <= n_fds + 1
+        f.seek(len(data) - 100)
+        assert f.read() == data[-100:]
+        assert _n_open_fds() <= n_fds + 1
+        f.seek(0)
+        while f.read(50000):
+            assert _n_open_fds() <= n_fds + 1
+    assert _n_open_fds() == n_fds
+
+
+@pytest.mark.skipif(resource is None or not os.path.isdir('/proc/self/fd'), reason='needs resource and /proc/self/fd')
+def test_chunked_reader_with_few_file_descriptors(chunked_file):
+    # far fewer file descriptors than chunks left, as for a multi-GB file under the usual limit of 1024
+    crypto, chunk_paths, data = chunked_file
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    resource.setrlimit(resource.RLIMIT_NOFILE, (_n_open_fds() + 10, hard))
+    try:
+        for size in [None, len(data)]:
+            with open_blob(crypto, chunk_paths, size=size) as f:
+                assert f.read() == data
+                f.seek(-1000, io.SEEK_END)
+                assert f.read() == data[-1000:]
+    finally:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (soft, hard))
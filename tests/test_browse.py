@@ -0,0 +1,78 @@
+import http.client
+import threading
+from http.server import ThreadingHTTPServer
+
+import pytest
+
+from backup_funcs.browse import ArchiveView, ArchivedFile, _BrowseHandler, _parse_range
+
+from .conftest import make_tree
+
+
+@pytest.fixture
+def server(tmp_path, open_archive):
+    # (port, source tree) of an http browser on an archive of a small tree
+    src = tmp_path / 'src'
+    make_tree(src, n_small=3)
+    archive = open_archive()
+    archive.backup([src], full=True)
+    view = ArchiveView(open_archive())
+    server = ThreadingHTTPServer(('127.0.0.1', 0), type('BrowseHandler', (_BrowseHandler,), {'view': view}))
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server.server_address[1], src
+    server.shutdown()
+    server.server_close()
+
+
+def _get(port, path, headers=None):
+    con = http.client.HTTPConnection('127.0.0.1', port, timeout=10)
+    con.request('GET', path, headers=headers or {})
+    response = con.getresponse()
+    result = response.status, dict(response.getheaders()), response.read()
+    con.close()
+    return result
+
+
+def test_http_ranges(server):
+    port, src = server
+    data = (src / 'medium.bin').read_bytes()
+    path = '/current' + (src / 'medium.bin').as_posix()
+    status, _, body = _get(port, path)
+    assert (status, body) == (200, data)
+    status, headers, body = _get(port, path, {'Range': 'bytes=10-19'})
+    assert (status, body, headers['Content-Range']) == (206, data[10:20], f'bytes 10-19/{len(data)}')
+    assert _get(port, path, {'Range': 'bytes=-5'})[::2] == (206, data[-5:])
+    assert _get(port, path, {'Range': 'bytes=100-'})[::2] == (206, data[100:])
+    assert _get(port, path, {'Range': f'bytes={len(data)}-'})[0] == 416
+    assert _get(port, path, {'Range': 'bytes=-0'})[0] == 416
+    # malformed or multiple ranges are ignored
+    for range_header in ['bytes=abc-', 'bytes=-', 'bytes=5-2', 'bytes=1-2,4-5', 'items=1-2', 'bytes=-x']:
+        assert _get(port, path, {'Range': range_header})[::2] == (200, data)
+
+
+def test_parse_range():
+    assert _parse_range('bytes=0-99', 1000) == (0, 99)
+    assert _parse_range('bytes=900-2000', 1000) == (900, 999)
+    assert _parse_range('bytes=-100', 1000) == (900, 999)
+    assert _parse_range('bytes=-2000', 1000) == (0, 999)
+    assert _parse_range('bytes=abc-', 1000) is None
+    assert _parse_range('bytes=١-', 1000) is None
+
+
+def test_file_size_is_kept(tmp_path, open_archive, monkeypatch):
+    src = tmp_path / 'src'
+    make_tree(src, n_small=3)
+    archive = open_archive(chunking_min_size=4*1024*1024)
+    archive.backup([src], full=True)
+    view = ArchiveView(archive)
+    entry = next(entry for entry in archive.active.values() if entry.chunks is not None)
+    # as in tables from before the size was recorded
+    size, entry.size = entry.size, None
+    n_opened = []
+    open_file = view.open_file
+    monkeypatch.setattr(view, 'open_file', lambda archived_file: n_opened.append(1) or open_file(archived_file))
+    archived_file = ArchivedFile(entry, None, None)
+    assert view.file_size(archived_file) == size
+    assert view.file_size(archived_file) == size
+    assert len(n_opened) == 1
@@ -0,0 +1,53 @@
+import hashlib
+import io
+import random
+
+import pytest
+
+from backup_funcs.chunker import iter_chunks
+
+AVG_SIZE = 64*1024
+
+
+def _chunks(data, **kwargs) -> list:
+    return list(iter_chunks(io.BytesIO(data), avg_size=AVG_SIZE, **kwargs))
+
+
+def _digests(chunks) -> list:
+    return [hashlib.sha256(chunk).hexdigest() for chunk in chunks]
+
+
+@pytest.mark.parametrize('read_size', [None, 100*1024, 1024*1024])
+def test_chunk_sizes(read_size):
+    data = random.Random(0).randbytes(4*1024*1024)
+    chunks = _chunks(data, read_size=read_size)
+    assert b''.join(chunks) == data
+    assert all(AVG_SIZE // 4 <= len(chunk) <= AVG_SIZE * 4 for chunk in chunks[:-1])
+    assert 0 < len(chunks[-1]) <= AVG_SIZE * 4
+    # the boundaries do not depend on how the file is read
+    assert _digests(chunks) == _digests(_chunks(data))
+    assert _chunks(b'') == []
+
+
+@pytest.mark.parametrize('edit', ['insert', 'delete', 'overwrite'])
+def test_boundaries_are_stable(edit):
+    rnd = random.Random(1)
+    data = rnd.randbytes(4*1024*1024)
+    pos = 2*1024*1024 + 12345
+    if edit == 'insert':
+        edited = data[:pos] + rnd.randbytes(100) + data[pos:]
+    elif edit == 'delete':
+        edited = data[:pos] + data[pos+100:]
+    else:
+        edited = data[:pos] + rnd.randbytes(100) + data[pos+100:]
+    chunks = _digests(_chunks(data))
+    edited_chunks = _digests(_chunks(edited))
+    assert len(chunks) > 20
+
+    # only the chunks around the edit change, the ones before and after it are the same
+    changed = set(edited_chunks) - set(chunks)
+    assert 1 <= len(changed) <= 2
+    assert len(set(chunks) - set(edited_chunks)) <= 2
+    n_before = next(i for i, (a, b) in enumerate(zip(chunks, edited_chunks)) if a != b)
+    n_after = next(i for i, (a, b) in enumerate(zip(chunks[::-1], edited_chunks[::-1])) if a != b)
+    assert n_before + n_after >= len(chunks) - 2
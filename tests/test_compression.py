@@ -0,0 +1,50 @@
+import os
+
+import pytest
+
+from backup_funcs.compression import CODEC_NAMES, CODEC_NONE, choose_codec, default_codec
+from backup_funcs.crypto import MAGIC, Crypto
+
+TEXT = b''.join(f'line {i} of a text file\n'.encode() for i in range(50000))
+
+
+def _codec_id(blob_path) -> int:
+    return blob_path.read_bytes()[len(MAGIC) + 1]
+
+
+@pytest.mark.parametrize('name', sorted(CODEC_NAMES))
+def test_codec_from_header(tmp_path, key, name):
+    (tmp_path / 'in.txt').write_bytes(TEXT)
+    Crypto(key, compression=name).store_file(tmp_path / 'in.txt', tmp_path / 'blob.enc', chunk_size=256*1024)
+    assert _codec_id(tmp_path / 'blob.enc') == CODEC_NAMES[name].codec_id
+    if name != 'none':
+        assert (tmp_path / 'blob.enc').stat().st_size < len(TEXT) // 2
+
+    # restored by the codec in the header, whatever compression the reader is configured with
+    for compression in ['auto', 'none', 'zlib-best']:
+        Crypto(key, compression=compression).restore_file(tmp_path / 'blob.enc', tmp_path / 'out.txt')
+        assert (tmp_path / 'out.txt').read_bytes() == TEXT
+
+
+def test_unknown_codec_id(tmp_path, key):
+    (tmp_path / 'in.txt').write_bytes(TEXT)
+    Crypto(key).store_file(tmp_path / 'in.txt', tmp_path / 'blob.enc')
+    blob = bytearray((tmp_path / 'blob.enc').read_bytes())
+    blob[len(MAGIC) + 1] = 200
+    (tmp_path / 'bad.enc').write_bytes(blob)
+    with pytest.raises(ValueError):
+        Crypto(key).restore_file(tmp_path / 'bad.enc', tmp_path / 'out.txt')
+
+
+def test_choose_codec():
+    data = os.urandom(100*1024)
+    assert choose_codec('.txt', TEXT) == default_codec()
+    assert choose_codec('.JPG', TEXT).codec_id == CODEC_NONE
+    # pdf is decided by the sample, it often holds uncompressed text
+    assert choose_codec('.pdf', TEXT) == default_codec()
+    assert choose_codec('.pdf', data).codec_id == CODEC_NONE
+    assert choose_codec(None, data).codec_id == CODEC_NONE
+    assert choose_codec('.txt', TEXT, 'lzma').name == 'lzma'
+    assert choose_codec('.txt', TEXT, 'none').codec_id == CODEC_NONE
+    with pytest.raises(ValueError):
+        default_codec('brotli')
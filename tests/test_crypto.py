@@ -0,0 +1,104 @@
+import gzip
+import hashlib
+import os
+import struct
+
+import pytest
+from cryptography.exceptions import InvalidTag
+
+from backup_funcs.compression import CODEC_ZLIB, get_codec
+from backup_funcs.crypto import Crypto, HEADER_SIZE, MAGIC, SALT_SIZE, _chunk_nonce
+
+
+def _restore(crypto, blob_path, tmp_path) -> bytes:
+    crypto.restore_file(blob_path, tmp_path / 'out')
+    return (tmp_path / 'out').read_bytes()
+
+
+@pytest.mark.parametrize('size', [0, 1, 1024*1024, 3*1024*1024 + 17])
+def test_round_trip(tmp_path, key, size):
+    crypto = Crypto(key)
+    data = os.urandom(size // 2) + b'z' * (size - size // 2)
+    (tmp_path / 'in.txt').write_bytes(data)
+    crypto.store_file(tmp_path / 'in.txt', tmp_path / 'blob.enc', chunk_size=1024*1024)
+    assert _restore(crypto, tmp_path / 'blob.enc', tmp_path) == data
+    crypto.check_structure(tmp_path / 'blob.enc')
+    crypto.check_content(tmp_path / 'blob.enc', hashlib.sha256(data).hexdigest())
+    with pytest.raises(ValueError):
+        crypto.check_content(tmp_path / 'blob.enc', hashlib.sha256(data + b'x').hexdigest())
+
+
+def _chunks(blob) -> tuple:
+    # the length prefixed chunks between the header and the trailer with the chunk index, and the trailer
+    index_size = struct.unpack('<I', blob[-4:])[0]
+    end = len(blob) - 4 - index_size
+    chunks = []
+    pos = HEADER_SIZE
+    while pos < end:
+        length = struct.unpack('<I', blob[pos:pos+4])[0]
+        chunks.append(blob[pos:pos+4+length])
+        pos += 4 + length
+    return chunks, blob[end:]
+
+
+def test_modified_blob_is_detected(tmp_path, key):
+    crypto = Crypto(key)
+    (tmp_path / 'in.bin').write_bytes(os.urandom(3*1024*1024 + 5))
+    crypto.store_file(tmp_path / 'in.bin', tmp_path / 'blob.enc', chunk_size=1024*1024)
+    blob = (tmp_path / 'blob.enc').read_bytes()
+    chunks, trailer = _chunks(blob)
+    assert len(chunks) == 4
+
+    flipped = bytearray(blob)
+    flipped[100] ^= 1
+    header = bytearray(blob[:HEADER_SIZE])
+    header[-1] ^= 1
+    for name, modified in [('flipped', bytes(flipped)),
+                           ('header', bytes(header) + blob[HEADER_SIZE:]),
+                           ('reordered', blob[:HEADER_SIZE] + chunks[1] + chunks[0] + b''.join(chunks[2:]) + trailer)]:
+        (tmp_path / f'{name}.enc').write_bytes(modified)
+        with pytest.raises(InvalidTag):
+            _restore(crypto, tmp_path / f'{name}.enc', tmp_path)
+
+    # a dropped chunk or a cut off blob does not match the chunk index
+    for name, modified in [('truncated', blob[:HEADER_SIZE] + b''.join(chunks[:-1]) + trailer),
+                           ('cut', blob[:len(blob) // 2])]:
+        (tmp_path / f'{name}.enc').write_bytes(modified)
+        with pytest.raises((InvalidTag, ValueError)):
+            _restore(crypto, tmp_path / f'{name}.enc', tmp_path)
+        with pytest.raises(ValueError):
+            crypto.check_structure(tmp_path / f'{name}.enc')
+
+
+def test_legacy_v1_blob(tmp_path, key):
+    # gzip stream of length prefixed fernet tokens of gzip compressed chunks
+    crypto = Crypto(key)
+    chunks = [os.urandom(1000), b'legacy ' * 500]
+    raw = b''
+    for chunk in chunks:
+        token = crypto.fernet.encrypt(gzip.compress(chunk))
+        raw += struct.pack('<I', len(token)) + token
+    (tmp_path / 'v1.enc').write_bytes(gzip.compress(raw))
+    assert _restore(crypto, tmp_path / 'v1.enc', tmp_path) == b''.join(chunks)
+    crypto.check_structure(tmp_path / 'v1.enc')
+
+
+def test_legacy_v2_blob(tmp_path, key):
+    # as version 3 without the chunk index, the end of the blob marks the last chunk
+    crypto = Crypto(key)
+    chunks = [os.urandom(1000), b'version 2 ' * 500, b'end']
+    salt = os.urandom(SALT_SIZE)
+    header = MAGIC + bytes([2, CODEC_ZLIB]) + salt
+    cipher = crypto._blob_cipher(salt)
+    blob = b''
+    for index, chunk in enumerate(chunks):
+        enc = cipher.encrypt(_chunk_nonce(index, index == len(chunks) - 1), get_codec(CODEC_ZLIB).compress(chunk), header)
+        blob += struct.pack('<I', len(enc)) + enc
+    (tmp_path / 'v2.enc').write_bytes(header + blob)
+    assert _restore(crypto, tmp_path / 'v2.enc', tmp_path) == b''.join(chunks)
+    crypto.check_structure(tmp_path / 'v2.enc')
+
+    # dropping the last chunk is detected by its nonce
+    (tmp_path / 'cut.enc').write_bytes(header + blob[:-(4 + len(enc))])
+    with pytest.raises(InvalidTag):
+        _restore(crypto, tmp_path / 'cut.enc', tmp_path)
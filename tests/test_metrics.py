@@ -0,0 +1,60 @@
+import threading
+
+from backup_funcs.engine import ExecutionEngine, worker_threads
+from backup_funcs.metrics import Metrics, count, take_stats, timed
+
+
+def _count_items(batch):
+    # task counting on the threads of a worker process
+    def count_item(item):
+        count('items')
+        count('item_bytes', item)
+        with timed('work'):
+            pass
+    worker_threads().map(count_item, batch)
+    return len(batch)
+
+
+def test_thread_counters_are_summed():
+    take_stats()
+    threads = [threading.Thread(target=lambda: [count('hits') for _ in range(1000)]) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    count('hits', 5)
+    assert take_stats() == {'hits': 4005}
+    # only what was counted since the last call
+    count('hits')
+    assert take_stats() == {'hits': 1}
+    assert take_stats() == {}
+
+
+def test_worker_counters_are_merged():
+    take_stats()
+    batches = [list(range(i, i + 10)) for i in range(0, 100, 10)]
+    with ExecutionEngine(n_procs=2, n_threads_per_proc=3) as engine:
+        count('items', 1000) # counted here before the workers are forked, not again by them
+        assert engine.map(_count_items, batches) == [10]*10
+        assert sum(engine.imap(_count_items, batches)) == 100
+        values = engine.metrics.collect()
+    assert values['items'] == 1000 + 200
+    assert values['item_bytes'] == 2*sum(range(100))
+    assert values['work_seconds'] > 0
+
+
+def test_prometheus_format(tmp_path):
+    metrics = Metrics()
+    metrics.merge({'bytes_read': 1024, 'hash_seconds': 0.5})
+    metrics.merge({'bytes_read': 1024})
+    metrics.write_prometheus(tmp_path / 'backup.prom', archive='home')
+    lines = (tmp_path / 'backup.prom').read_text().splitlines()
+    assert lines[:4] == ['# TYPE backup_ninja_bytes_read gauge', 'backup_ninja_bytes_read{archive="home"} 2048',
+                         '# TYPE backup_ninja_hash_seconds gauge', 'backup_ninja_hash_seconds{archive="home"} 0.5']
+    assert lines[4] == '# TYPE backup_ninja_last_run_timestamp_seconds gauge'
+    assert lines[5].startswith('backup_ninja_last_run_timestamp_seconds{archive="home"} ')
+    assert len(lines) == 6
+    assert list(tmp_path.iterdir()) == [tmp_path / 'backup.prom']
+
+    metrics.write_prometheus(tmp_path / 'plain.prom')
+    assert (tmp_path / 'plain.prom').read_text().splitlines()[1] == 'backup_ninja_bytes_read 2048'
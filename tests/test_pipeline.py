@@ -0,0 +1,73 @@
+import threading
+import time
+
+import pytest
+
+from backup_funcs import engine
+from backup_funcs.pipeline import ordered_map
+
+
+@pytest.fixture
+def pipeline_state(monkeypatch):
+    # a worker state of its own, so that each test gets a fresh pool of pipeline threads
+    def set_threads(n_threads):
+        monkeypatch.setattr(engine, '_worker_state', {'n_pipeline_threads': n_threads})
+    yield set_threads
+    pool = engine._worker_state.get('pipeline_threads')
+    if pool is not None:
+        pool.close()
+        pool.join()
+
+
+def test_results_in_input_order(pipeline_state):
+    pipeline_state(4)
+    finished = []
+    n_consumed = 0
+
+    def work(i):
+        # the earlier items take longer, so they finish after the later ones
+        time.sleep(0.01 * (5 - i % 5))
+        finished.append(i)
+        return i * i
+
+    def items():
+        nonlocal n_consumed
+        for i in range(20):
+            n_consumed += 1
+            yield i
+
+    results = []
+    for result in ordered_map(work, items(), max_ahead=5):
+        # at most max_ahead items are in flight ahead of the result
+        assert n_consumed <= len(results) + 5
+        results.append(result)
+    assert results == [i * i for i in range(20)]
+    assert sorted(finished) == list(range(20)) and finished != list(range(20))
+
+
+def test_serial_without_pipeline_threads(pipeline_state):
+    pipeline_state(0)
+    threads = set()
+
+    def work(i):
+        threads.add(threading.get_ident())
+        return -i
+
+    assert list(ordered_map(work, range(10))) == [-i for i in range(10)]
+    assert threads == {threading.get_ident()}
+    assert engine._worker_state['pipeline_threads'] is None
+
+
+def test_nested_map_runs_on_the_pipeline_thread(pipeline_state):
+    # the items of a pipeline thread are done on it, so that the pool can not deadlock on itself
+    pipeline_state(2)
+
+    def outer(i):
+        return list(ordered_map(lambda j: (i, j, threading.get_ident()), range(3)))
+
+    results = list(ordered_map(outer, range(4)))
+    assert [[(i, j) for i, j, _ in inner] for inner in results] == [[(i, j) for j in range(3)] for i in range(4)]
+    for inner in results:
+        assert len({ident for _, _, ident in inner}) == 1
+    assert list(ordered_map(str, [])) == []
+    assert list(ordered_map(str, [1])) == ['1']
@@ -0,0 +1,70 @@
+import datetime as dt
+
+import pytest
+
+from backup_funcs.models import ArchiveEntry, ArchiveLogEvent, BlobEvent
+from backup_funcs.retention import BUCKETS, RetentionPolicy
+
+
+def _entry(checksum, path_times) -> ArchiveEntry:
+    # history entry that was removed from each path at the given time
+    entry = ArchiveEntry.from_checksum(checksum)
+    for path, ts in path_times:
+        entry.log.append(ArchiveLogEvent.from_timestamp((ts - dt.timedelta(minutes=1)).isoformat(), BlobEvent.ADDED.name, path))
+        entry.log.append(ArchiveLogEvent.from_timestamp(ts.isoformat(), BlobEvent.REMOVED.name, path))
+    return entry
+
+
+def _versions(bucket_name, n_buckets=4, n_per_bucket=3) -> list:
+    # (timestamp, checksum) with n_per_bucket versions in each of n_buckets buckets, checksum is 'bucket.version'
+    start = dt.datetime(2024, 1, 1, 0, 0) # a monday
+    versions = []
+    for k in range(n_buckets):
+        for m in range(n_per_bucket):
+            ts = {'hourly': start + dt.timedelta(hours=k, minutes=10*m),
+                  'daily': start + dt.timedelta(days=k, hours=m),
+                  'weekly': start + dt.timedelta(weeks=k, days=m),
+                  'monthly': start.replace(month=1 + k, day=1 + m),
+                  'yearly': start.replace(year=2024 + k, month=1 + m)}[bucket_name]
+            versions.append((ts, f'{k}.{m}'))
+    assert len({BUCKETS[bucket_name](ts) for ts, _ in versions}) == n_buckets
+    return versions
+
+
+def test_keep_last():
+    versions = [(dt.datetime(2024, 1, 1, 12, 0) + dt.timedelta(seconds=i), str(i)) for i in range(5)]
+    assert RetentionPolicy(keep_last=2).keep_versions(versions) == {'3', '4'}
+    assert RetentionPolicy(keep_last=10).keep_versions(versions) == {str(i) for i in range(5)}
+    assert RetentionPolicy(keep_last=-1).keep_versions(versions) == {str(i) for i in range(5)}
+    assert RetentionPolicy().keep_versions(versions) == set()
+
+
+@pytest.mark.parametrize('bucket_name', list(BUCKETS))
+def test_buckets(bucket_name):
+    versions = _versions(bucket_name)
+    # the latest version in each of the n latest buckets, -1 for all buckets
+    assert RetentionPolicy(**{bucket_name: 2}).keep_versions(versions) == {'3.2', '2.2'}
+    assert RetentionPolicy(**{bucket_name: -1}).keep_versions(versions) == {'3.2', '2.2', '1.2', '0.2'}
+    assert RetentionPolicy(**{bucket_name: 2}, keep_last=1).keep_versions(versions) == {'3.2', '2.2'}
+    assert RetentionPolicy(**{bucket_name: 1}, keep_last=2).keep_versions(versions) == {'3.2', '3.1'}
+
+
+def test_entry_kept_through_one_path():
+    t0 = dt.datetime(2024, 3, 1, 12, 0).astimezone()
+    history = {entry.checksum: entry for entry in [
+        # the latest version of /a, but replaced at /b by a later one
+        _entry('shared', [('/a', t0 + dt.timedelta(hours=2)), ('/b', t0 + dt.timedelta(hours=1))]),
+        _entry('old_a', [('/a', t0)]),
+        _entry('new_b', [('/b', t0 + dt.timedelta(hours=3))]),
+    ]}
+    assert RetentionPolicy(keep_last=1).select(history) == {'shared', 'new_b'}
+    assert RetentionPolicy(keep_last=2).select(history) == set(history)
+    assert RetentionPolicy(yearly=-1).select(history) == {'shared', 'new_b'}
+
+
+def test_from_config():
+    policy = RetentionPolicy.from_config({'keep_last': 3, 'daily': 7, 'yearly': -1})
+    assert (policy.keep_last, policy.buckets['daily'], policy.buckets['yearly'], policy.buckets['hourly']) == (3, 7, -1, 0)
+    assert repr(policy) == 'keep_last=3, daily=7, yearly=-1'
+    with pytest.raises(ValueError, match='keep_latest'):
+        RetentionPolicy.from_config({'keep_latest': 3, 'daily': 7})
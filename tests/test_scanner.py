@@ -0,0 +1,57 @@
+import threading
+
+import pytest
+
+from backup_funcs.engine import ExecutionEngine
+from backup_funcs.file_info import file_checksum
+from backup_funcs.scanner import Scanner
+
+from .conftest import make_tree
+
+
+def _tree(root, n_dirs=20, n_files=50):
+    for i in range(n_dirs):
+        d = root / f'd{i}' / 'sub'
+        d.mkdir(parents=True)
+        for j in range(n_files):
+            (d / f'f{j}.txt').write_bytes(f'{i} {j}'.encode())
+    return n_dirs * n_files
+
+
+def test_scan_directory_tree(tmp_path):
+    src = tmp_path / 'src'
+    make_tree(src)
+    (src / 'link').symlink_to(src / 'd0', target_is_directory=True)
+    files = [path for path in src.rglob('*') if path.is_file() and not path.is_symlink() and 'link' not in path.parts]
+    with ExecutionEngine(n_procs=2, n_threads_per_proc=2) as engine:
+        scanner = Scanner(engine, batch_bytes=1024*1024, batch_files=5)
+        scanner.scan_directory_tree(src, with_checksum=True)
+    assert sorted(finfo.path.as_posix() for finfo in scanner.files) == sorted(path.as_posix() for path in files)
+    assert {finfo.path.as_posix(): finfo.checksum for finfo in scanner.files} == {path.as_posix(): file_checksum(path) for path in files}
+
+    scanner = Scanner()
+    scanner.scan_directory_tree(src, with_checksum=False)
+    assert len(scanner.files) == len(files) and all(finfo.checksum is None for finfo in scanner.files)
+
+
+@pytest.mark.parametrize('how', ['close', 'exception'])
+def test_walk_stops_with_the_consumer(tmp_path, how):
+    n_files = _tree(tmp_path / 'src')
+    n_threads = threading.active_count()
+    scanner = Scanner(n_walkers=4, queue_size=10)
+    walk = scanner._walk(tmp_path / 'src')
+    assert len([finfo for finfo, _ in zip(walk, range(5))]) == 5
+    assert threading.active_count() > n_threads
+
+    # the walkers are blocked on the full queue until the consumer stops
+    if how == 'close':
+        walk.close()
+    else:
+        with pytest.raises(RuntimeError):
+            for finfo in walk:
+                raise RuntimeError('consumer failed')
+        del walk
+    assert threading.active_count() == n_threads
+
+    assert len(list(Scanner(n_walkers=4, queue_size=10)._walk(tmp_path / 'src'))) == n_files
+    assert threading.active_count() == n_threads
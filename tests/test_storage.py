@@ -0,0 +1,223 @@
+import os
+import threading
+import time
+
+import pytest
+
+from backup_funcs import storage
+from backup_funcs.storage import LocalStorage, RateLimiter, Remote, Storage, _ThrottledReader, open_remote
+
+
+
+"""
+In memory stand-in for a boto3 s3 client with the calls S3Storage makes, listings come in pages of page_size keys
+and delete_objects takes at most 1000 keys as on s3.
+"""
+class FakeS3Client():
+    def __init__(self, page_size=1000, **kwargs):
+        self.page_size = page_size
+        self.kwargs = kwargs
+        self.objects = {} # (bucket, key) : bytes
+        self.calls = []
+        self._lock = threading.Lock()
+
+    def get_paginator(self, operation):
+        assert operation == 'list_objects_v2'
+        return self
+
+    def paginate(self, Bucket, Prefix):
+        with self._lock:
+            keys = sorted(key for bucket, key in self.objects if bucket == Bucket and key.startswith(Prefix))
+            self.calls.append(('list', len(keys)))
+            for i in range(0, max(len(keys), 1), self.page_size):
+                page = {'KeyCount': len(keys[i:i+self.page_size])}
+                if len(keys) > 0:
+                    page['Contents'] = [{'Key': key, 'Size': len(self.objects[(Bucket, key)])} for key in keys[i:i+self.page_size]]
+                self.calls.append(('page', page['KeyCount']))
+                yield page
+
+    def upload_fileobj(self, fileobj, bucket, key, Config=None):
+        # reads in parts of the multipart chunk size, as the transfer manager does
+        read_sizes = []
+        parts = []
+        while True:
+            data = fileobj.read(Config.kwargs['multipart_chunksize'])
+            if not data:
+                break
+            read_sizes.append(len(data))
+            parts.append(data)
+        with self._lock:
+            self.objects[(bucket, key)] = b''.join(parts)
+            self.calls.append(('upload', key, read_sizes))
+
+    def download_file(self, bucket, key, filename, Config=None):
+        with self._lock:
+            if (bucket, key) not in self.objects:
+                raise KeyError(f'no such key {key}')
+            data = self.objects[(bucket, key)]
+        with open(filename, 'wb') as fout:
+            fout.write(data)
+
+    def delete_objects(self, Bucket, Delete):
+        assert len(Delete['Objects']) <= 1000
+        with self._lock:
+            self.calls.append(('delete', len(Delete['Objects']), Delete['Quiet']))
+            for obj in Delete['Objects']:
+                self.objects.pop((Bucket, obj['Key']), None)
+
+
+class _Recorded():
+    def __init__(self, **kwargs):
+        self.kwargs = kwargs
+
+
+@pytest.fixture
+def fake_s3(monkeypatch):
+    # the fake client that S3Storage gets from boto3.client
+    client = FakeS3Client(page_size=3)
+
+    class FakeBoto3():
+        @staticmethod
+        def client(service, **kwargs):
+            assert service == 's3'
+            client.kwargs = kwargs
+            return client
+
+    monkeypatch.setattr(storage, 'boto3', FakeBoto3)
+    monkeypatch.setattr(storage, 'TransferConfig', _Recorded, raising=False)
+    monkeypatch.setattr(storage, 'BotoConfig', _Recorded, raising=False)
+    return client
+
+
+def _write_files(root, n_files) -> list:
+    # [(local path, key)]
+    items = []
+    for i in range(n_files):
+        fpath = root / f'f{i}.enc'
+        fpath.parent.mkdir(parents=True, exist_ok=True)
+        fpath.write_bytes(f'file {i} '.encode() * (i + 1))
+        items.append((fpath, f'{i % 4:02x}/f{i}.enc'))
+    return items
+
+
+def test_s3_storage(tmp_path, fake_s3):
+    config = {'type': 's3', 'bucket': 'bucket', 'prefix': '/backups/host/', 'endpoint_url': 'http://minio:9000',
+              'max_concurrency': 3, 'multipart_chunk_mb': 8, 'max_pool_connections': 16}
+    remote = open_remote(config, tmp_path / 'listing.json')
+    s3 = remote.storage
+    assert fake_s3.kwargs['endpoint_url'] == 'http://minio:9000'
+    assert fake_s3.kwargs['config'].kwargs == {'max_pool_connections': 16}
+    assert s3.transfer_config.kwargs == {'multipart_threshold': 8*1024*1024, 'multipart_chunksize': 8*1024*1024,
+                                         'max_concurrency': 3, 'use_threads': True}
+
+    items = _write_files(tmp_path / 'local', 10)
+    assert remote.upload(items) == []
+    assert {key for _, key in fake_s3.objects} == {'backups/host/' + key for _, key in items}
+    # the listing is paged, 10 keys in pages of 3
+    assert s3.list() == {key: os.path.getsize(local_path) for local_path, key in items}
+    assert [call for call in fake_s3.calls if call[0] == 'page'][-4:] == [('page', 3), ('page', 3), ('page', 3), ('page', 1)]
+
+    assert remote.download([(key, tmp_path / 'restore' / key) for _, key in items] + [('ff/missing.enc', tmp_path / 'restore' / 'missing')]) == ['ff/missing.enc']
+    for local_path, key in items:
+        assert (tmp_path / 'restore' / key).read_bytes() == local_path.read_bytes()
+    assert not os.path.exists(tmp_path / 'restore' / 'missing')
+
+    remote.delete([key for _, key in items[:4]] + ['not/stored.enc'])
+    assert s3.list() == remote.files == {key: os.path.getsize(local_path) for local_path, key in items[4:]}
+
+
+def test_s3_delete_in_batches_of_1000(fake_s3):
+    s3 = storage.S3Storage('bucket', prefix='p')
+    for i in range(2500):
+        fake_s3.objects[('bucket', f'p/k{i}')] = b'x'
+    fake_s3.objects[('bucket', 'other/k0')] = b'x'
+    s3.delete(f'k{i}' for i in range(2500))
+    assert [call for call in fake_s3.calls if call[0] == 'delete'] == [('delete', 1000, True), ('delete', 1000, True), ('delete', 500, True)]
+    assert list(fake_s3.objects) == [('bucket', 'other/k0')]
+    assert s3.list() == {}
+
+
+def test_s3_throttled_upload(tmp_path, fake_s3):
+    s3 = storage.S3Storage('bucket', multipart_chunk_size=8*1024*1024, rate_limiter=RateLimiter(20*1024*1024))
+    data = os.urandom(5*1024*1024 + 10)
+    (tmp_path / 'blob.enc').write_bytes(data)
+    t0 = time.monotonic()
+    s3.upload(tmp_path / 'blob.enc', 'blob.enc')
+    # 5 MB at 20 MB/s, the first block is not delayed
+    assert time.monotonic() - t0 >= 0.18
+    assert fake_s3.objects[('bucket', 'blob.enc')] == data
+    _, _, read_sizes = fake_s3.calls[-1]
+    assert max(read_sizes) == 1024*1024
+
+
+def test_s3_needs_boto3(tmp_path, monkeypatch):
+    monkeypatch.setattr(storage, 'boto3', None)
+    with pytest.raises(RuntimeError):
+        open_remote({'type': 's3', 'bucket': 'bucket'}, tmp_path / 'listing.json')
+    with pytest.raises(ValueError):
+        open_remote({'type': 'ftp'}, tmp_path / 'listing.json')
+
+
+def test_storage_is_abstract():
+    with pytest.raises(TypeError):
+        Storage()
+
+
+def test_local_storage(tmp_path):
+    local = LocalStorage(tmp_path / 'remote')
+    items = _write_files(tmp_path / 'local', 5)
+    for local_path, key in items:
+        local.upload(local_path, key)
+    # leftovers of interrupted uploads are not listed
+    (tmp_path / 'remote' / '00' / 'f0.enc.123.456.tmp').write_bytes(b'partial')
+    assert local.list() == {key: os.path.getsize(local_path) for local_path, key in items}
+    local.download(items[2][1], tmp_path / 'copy')
+    assert (tmp_path / 'copy').read_bytes() == items[2][0].read_bytes()
+    local.delete([items[0][1], 'not/stored.enc'])
+    assert items[0][1] not in local.list()
+
+
+def test_throttled_reader(tmp_path):
+    limiter = RateLimiter(10*1024*1024)
+    (tmp_path / 'in.bin').write_bytes(b'x' * (3*1024*1024))
+    with open(tmp_path / 'in.bin', 'rb') as fin:
+        reader = _ThrottledReader(fin, limiter, block_size=1024*1024)
+        t0 = time.monotonic()
+        sizes = [len(reader.read()) for _ in range(4)]
+        elapsed = time.monotonic() - t0
+    assert sizes == [1024*1024]*3 + [0]
+    # 3 MB at 10 MB/s, the first block is not delayed
+    assert 0.18 <= elapsed < 2
+
+
+def test_remote_listing_cache(tmp_path):
+    listing_path = tmp_path / 'listing.json'
+
+    class CountingStorage(LocalStorage):
+        n_lists = 0
+
+        def list(self):
+            CountingStorage.n_lists += 1
+            return super().list()
+
+    remote = Remote(CountingStorage(tmp_path / 'remote'), listing_path)
+    items = _write_files(tmp_path / 'local', 6)
+    failed = remote.upload(items + [(tmp_path / 'local' / 'missing.enc', 'ff/missing.enc')])
+    assert failed == ['ff/missing.enc']
+    assert CountingStorage.n_lists == 1
+    assert items[1][1] in remote and 'ff/missing.enc' not in remote
+    assert remote.size(items[1][1]) == os.path.getsize(items[1][0])
+    assert remote.files_under('01/') == {items[1][1]: os.path.getsize(items[1][0]), items[5][1]: os.path.getsize(items[5][0])}
+
+    # the listing is loaded from the table dir, not from the storage
+    remote = Remote(CountingStorage(tmp_path / 'remote'), listing_path)
+    remote.delete([items[0][1]])
+    assert items[0][1] not in remote
+    assert CountingStorage.n_lists == 1
+
+    # files changed by others are only seen after a refresh
+    os.remove(tmp_path / 'remote' / items[1][1])
+    assert items[1][1] in Remote(CountingStorage(tmp_path / 'remote'), listing_path)
+    remote.refresh()
+    assert CountingStorage.n_lists == 2
+    assert items[1][1] not in Remote(CountingStorage(tmp_path / 'remote'), listing_path)
@@ -0,0 +1,109 @@
+import pytest
+
+from backup_funcs.models import ArchiveEntry, ArchiveFilePointer, ArchiveLogEvent, BlobEvent
+from backup_funcs.table import ArchiveTable, JsonArchiveTable, SqliteArchiveTable, open_archive_table
+
+from .conftest import make_tree
+
+
+def _entry(i, n_fptrs=1) -> ArchiveEntry:
+    entry = ArchiveEntry.from_checksum(f'{i:064x}')
+    entry.arch_size = 100 + i
+    for j in range(n_fptrs):
+        path = f'/data/d{i}/f{j}.txt'
+        entry.fptrs.append(ArchiveFilePointer(path=path, ino=1000*i + j, mtime=1.5*i, size=10*i, dev=7))
+        entry.log.append(ArchiveLogEvent.from_event(BlobEvent.ADDED, path))
+    return entry
+
+
+def _table(n_active=5, n_history=3):
+    active = {entry.checksum: entry for entry in [_entry(i, n_fptrs=1 + i % 3) for i in range(n_active)]}
+    history = {entry.checksum: entry for entry in [_entry(n_active + i, n_fptrs=0) for i in range(n_history)]}
+    meta = {'backup_roots': ['/data'], 'backup_state': {'last_full_backup': None, 'n_backups_since_full': 2}}
+    return active, history, meta
+
+
+def _models(entries) -> dict:
+    # the entries are compared through their pydantic models
+    return {entry.checksum: entry.to_model() for entry in entries}
+
+
+def _load(table) -> tuple:
+    active, history, meta = table.load()
+    return _models(active), _models(history), meta
+
+
+def test_archive_table_is_abstract():
+    with pytest.raises(TypeError):
+        ArchiveTable()
+
+
+def test_sqlite_round_trip(tmp_path):
+    table = SqliteArchiveTable(tmp_path)
+    assert not table.exists() and table.load() is None
+    active, history, meta = _table()
+    table.store(active, history, meta)
+    table.close()
+    assert _load(SqliteArchiveTable(tmp_path)) == (_models(active.values()), _models(history.values()), meta)
+
+
+def test_sqlite_writes_only_changed_entries(tmp_path):
+    table = SqliteArchiveTable(tmp_path)
+    active, history, meta = _table()
+    table.store(active, history, meta)
+    changed, unchanged, removed, to_history = list(active)[:4]
+
+    # a new path for one entry, an entry moved to history and a removed one
+    active[changed].fptrs.append(ArchiveFilePointer(path='/data/new.txt', ino=1, mtime=2.0, size=30, dev=7))
+    history[to_history] = active.pop(to_history)
+    active.pop(removed)
+    # not in changed, so not written
+    active[unchanged].arch_size = 1
+    table.store(active, history, meta, changed={changed, removed, to_history})
+    loaded_active, loaded_history, _ = _load(SqliteArchiveTable(tmp_path))
+    assert loaded_active[changed] == active[changed].to_model()
+    assert loaded_active[unchanged].arch_size == 100 + 1
+    assert removed not in loaded_active and removed not in loaded_history
+    assert to_history in loaded_history and to_history not in loaded_active
+    assert set(loaded_active) == set(active)
+
+
+def test_archive_stores_only_changed_entries(tmp_path, open_archive, monkeypatch):
+    src = tmp_path / 'src'
+    make_tree(src)
+    archive = open_archive()
+    archive.backup([src], full=True)
+    old_checksum = next(entry.checksum for entry in archive.active.values() if entry.fptrs[0].path.endswith('/f0.txt'))
+
+    stored = []
+    store = archive.table.store
+    monkeypatch.setattr(archive.table, 'store', lambda active, history, meta, changed=None: stored.append(set(changed)) or store(active, history, meta, changed))
+    (src / 'd0' / 'f0.txt').write_bytes(b'changed')
+    archive.backup([src], full=False)
+    new_checksum = next(entry.checksum for entry in archive.active.values() if entry.fptrs[0].path.endswith('/f0.txt'))
+    assert stored == [{old_checksum, new_checksum}]
+    assert _load(SqliteArchiveTable(tmp_path / 'table'))[:2] == (_models(archive.active.values()), _models(archive.history.values()))
+
+
+def test_json_table_is_migrated(tmp_path, open_archive):
+    active, history, meta = _table()
+    JsonArchiveTable(tmp_path).store(active, history, meta)
+    assert (tmp_path / 'archive.json').exists()
+
+    table = open_archive_table(tmp_path)
+    assert isinstance(table, SqliteArchiveTable)
+    assert not (tmp_path / 'archive.json').exists()
+    assert (tmp_path / 'archive.json.migrated').exists()
+    assert _load(table) == (_models(active.values()), _models(history.values()), meta)
+    # only once
+    assert _load(open_archive_table(tmp_path)) == (_models(active.values()), _models(history.values()), meta)
+
+    # an archive backed up with the json table continues on sqlite
+    src = tmp_path / 'src'
+    make_tree(src)
+    archive = open_archive(table_backend='json')
+    archive.backup([src], full=True)
+    archive = open_archive()
+    assert (tmp_path / 'table' / 'archive.db').exists() and (tmp_path / 'table' / 'archive.json.migrated').exists()
+    assert archive.n_backups_since_full == 0
+    assert {fptr.path for entry in archive.active.values() for fptr in entry.fptrs} == {path.as_posix() for path in src.rglob('*') if path.is_file()}
@@ -0,0 +1,38 @@
+import io
+import tarfile
+
+import pytest
+
+from backup_funcs.tarstream import TarStreamWriter, content_size
+
+
+def test_tar_stream():
+    out = io.BytesIO()
+    with TarStreamWriter(out) as tar_writer:
+        tar_writer.add('/a/b.txt', 5, 1700000000, lambda fout: fout.write(b'hello'))
+        tar_writer.add('/a/empty', 0, 1700000000, lambda fout: None)
+        tar_writer.add('/c.bin', 1000, 1700000000, lambda fout: fout.write(b'x'*1000))
+    out.seek(0)
+    with tarfile.open(fileobj=out, mode='r:') as tar:
+        assert tar.getnames() == ['a/b.txt', 'a/empty', 'c.bin']
+        assert tar.extractfile('c.bin').read() == b'x'*1000
+        assert tar.getmember('a/b.txt').mtime == 1700000000
+    assert content_size(lambda fout: fout.write(b'abc')) == 3
+
+
+def test_failed_tar_stream_has_no_end_marker():
+    out = io.BytesIO()
+
+    def fail(fout):
+        fout.write(b'partial')
+        raise OSError('archive file missing')
+
+    with pytest.raises(OSError):
+        with TarStreamWriter(out) as tar_writer:
+            tar_writer.add('/a.txt', 5, 1700000000, lambda fout: fout.write(b'hello'))
+            tar_writer.add('/b.txt', 100, 1700000000, fail)
+    out.seek(0)
+    with pytest.raises(tarfile.ReadError):
+        with tarfile.open(fileobj=out, mode='r:') as tar:
+            for member in tar:
+                tar.extractfile(member).read()
@@ -0,0 +1,60 @@
+import os
+import shutil
+import threading
+import time
+
+import pytest
+
+from backup_funcs import watcher
+from backup_funcs.watcher import ChangeJournal, Watcher, inotify_available
+
+
+def _wait_for(condition, timeout=10):
+    deadline = time.time() + timeout
+    while not condition():
+        assert time.time() < deadline, 'timed out'
+        time.sleep(0.05)
+
+
+@pytest.mark.skipif(not inotify_available(), reason='needs inotify')
+@pytest.mark.parametrize('replace_with_file', [False, True])
+def test_directory_removed_during_initial_watch(tmp_path, monkeypatch, replace_with_file):
+    src = tmp_path / 'src'
+    for name in ['a', 'b', 'gone']:
+        (src / name / 'sub').mkdir(parents=True)
+    gone = (src / 'gone').as_posix()
+    add_watch = watcher.Inotify.add_watch
+
+    def add_watch_after_removal(self, path, *args):
+        # the directory is removed (or replaced by a file) after it was listed and before it is watched
+        if path == gone:
+            shutil.rmtree(path)
+            if replace_with_file:
+                (src / 'gone').write_bytes(b'now a file')
+        return add_watch(self, path, *args)
+
+    monkeypatch.setattr(watcher.Inotify, 'add_watch', add_watch_after_removal)
+    journal = ChangeJournal(tmp_path)
+    stop = threading.Event()
+    errors = []
+
+    def run():
+        try:
+            Watcher([src], journal, mode='inotify', flush_interval=0.05).run(stop)
+        except Exception as e:
+            errors.append(e)
+
+    thread = threading.Thread(target=run, daemon=True)
+    thread.start()
+    try:
+        _wait_for(lambda: journal.read_state() is not None or not thread.is_alive())
+        assert errors == [] and thread.is_alive()
+        # the other directories are still watched
+        (src / 'b' / 'sub' / 'new.txt').write_bytes(b'new')
+        _wait_for(lambda: os.path.exists(journal.journal_path))
+        time.sleep(0.2)
+    finally:
+        stop.set()
+        thread.join(10)
+    assert errors == []
+    assert ['file', (src / 'b' / 'sub' / 'new.txt').as_posix()] in journal.take()